@@ -0,0 +1,179 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import server
+
+HOST = '127.0.0.1'
+
+# what the client sends per sendall, the content does not matter
+SEND_CHUNK = memoryview(bytes(1024 * 1024))
+
+
+class RecvServer(server.Server):
+    # the previous receive loop: a new bytes object for every recv of the file body
+    def handle_client(self, sock):
+        upload = self.uploads[sock]
+        if upload.state != server.RECEIVING_BODY:
+            super().handle_client(sock)
+            return
+
+        end = upload.range[1] if upload.range else upload.file_size
+        try:
+            data = sock.recv(min(len(self.receive_buffer), end - upload.received))
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b''
+        if not data:
+            self.close_client(sock)
+        else:
+            self.write_body(upload, data, sock)
+
+
+def send_upload(port, file_size):
+    # uploads file_size zero bytes like the client does, through the command and the header
+    with socket.create_connection((HOST, port)) as sock:
+        sock.sendall(b"upload benchmark.bin")
+        sock.recv(server.BUFFER_SIZE)
+        sock.sendall(f"file-name: benchmark.bin,\r\nfile-size: {file_size}\r\n\r\n".encode())
+        remaining = file_size
+        while remaining:
+            size = min(len(SEND_CHUNK), remaining)
+            sock.sendall(SEND_CHUNK[:size])
+            remaining -= size
+        sock.recv(server.BUFFER_SIZE)
+
+
+def measure(file_size, upload_dir, buffer_size, use_recv_into):
+    port = free_port()
+    server_class = server.Server if use_recv_into else RecvServer
+    server_process = multiprocessing.Process(target=serve_quietly, args=(port, upload_dir, buffer_size, server_class))
+    server_process.start()
+    wait_for_port(port)
+
+    # the time includes hashing the content and moving it into the store, as start() does it
+    start = time.perf_counter()
+    send_upload(port, file_size)
+    elapsed = time.perf_counter() - start
+
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join()
+    return file_size / elapsed / (1024 * 1024)
+
+
+def benchmark_receive(file_size, upload_dir=None):
+    """Compare upload throughput of Server.start with the old recv loop and with recv_into at several buffer sizes."""
+    runs = [
+        ('recv (previous)', 1024, False),
+        ('recv_into', 1024, True),
+        ('recv_into', 64 * 1024, True),
+        ('recv_into', 256 * 1024, True),
+        ('recv_into', 1024 * 1024, True),
+    ]
+
+    print(f'{file_size / (1024 ** 3):.2f} GiB upload over loopback to Server.start, {os.cpu_count()} cores')
+    print(f"{'receive':>16} {'buffer':>10} {'MiB/s':>10}")
+    results = []
+    for name, buffer_size, use_recv_into in runs:
+        # every run stores into an empty directory, so no run finds the content stored already
+        with tempfile.TemporaryDirectory(dir=upload_dir) as run_dir:
+            rate = measure(file_size, run_dir, buffer_size, use_recv_into)
+        results.append((name, buffer_size, rate))
+        print(f'{name:>16} {buffer_size // 1024:>7} KiB {rate:>10.0f}')
+    return results
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def serve_quietly(port, upload_dir, buffer_size=server.RECEIVE_BUFFER_SIZE, server_class=server.Server):
+    # runs in a child process until it gets SIGINT, per upload logging would only add noise
+    sys.stdout = open(os.devnull, 'w')
+    server_class(HOST, port, buffer_size, upload_dir).start()
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def send_range(port, file_size, start, end):
+    # runs in a child process, sends one range of the parallel upload
+    with socket.create_connection((HOST, port)) as sock:
+        sock.sendall(b"upload benchmark.bin")
+        sock.recv(server.BUFFER_SIZE)
+        sock.sendall(f"file-name: benchmark.bin,\r\nfile-size: {file_size}\r\nfile-range: {start}-{end}\r\n\r\n".encode())
+        remaining = end - start
+        while remaining:
+            size = min(len(SEND_CHUNK), remaining)
+            sock.sendall(SEND_CHUNK[:size])
+            remaining -= size
+        sock.recv(server.BUFFER_SIZE)
+
+
+def measure_parallel(file_size, streams, upload_dir):
+    port = free_port()
+    server_process = multiprocessing.Process(target=serve_quietly, args=(port, upload_dir))
+    server_process.start()
+    wait_for_port(port)
+
+    bounds = [file_size * i // streams for i in range(streams + 1)]
+    senders = [
+        multiprocessing.Process(target=send_range, args=(port, file_size, start, end))
+        for start, end in zip(bounds, bounds[1:])
+    ]
+    start = time.perf_counter()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    elapsed = time.perf_counter() - start
+
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join()
+    return file_size / elapsed / (1024 * 1024)
+
+
+def benchmark_parallel(file_size, stream_counts=(1, 2, 4, 8)):
+    """Measure one upload split into byte ranges over a varying number of connections."""
+    print(f'{file_size / (1024 ** 3):.2f} GiB parallel upload over loopback, {os.cpu_count()} cores')
+    print(f"{'streams':>8} {'MiB/s':>10}")
+    results = []
+    for streams in stream_counts:
+        # the time includes the final hash and the move into the store
+        with tempfile.TemporaryDirectory() as upload_dir:
+            rate = measure_parallel(file_size, streams, upload_dir)
+        results.append((streams, rate))
+        print(f'{streams:>8} {rate:>10.0f}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure file upload throughput of the file-upload server.')
+    parser.add_argument('benchmark', choices=['receive', 'parallel'])
+    parser.add_argument('--size', type=float, default=2, help='upload size in GiB')
+    parser.add_argument('--dir', default=None,
+                        help='receive: directory the uploads are stored under, a temporary directory by default')
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='parallel: connection counts to compare')
+    args = parser.parse_args()
+    if args.benchmark == 'receive':
+        benchmark_receive(int(args.size * 1024 ** 3), args.dir)
+    else:
+        benchmark_parallel(int(args.size * 1024 ** 3), args.streams)
@@ -1,6 +1,8 @@
+import hashlib
 import os
 from unittest.mock import patch, MagicMock
 import socket
+import threading
 import unittest
 import sys
 from io import StringIO
@@ -41,6 +43,74 @@ class Client:
         # 7. Close the connection
         self.socket.close()
 
+    def get_offset(self, filename):
+        # 8. Ask the server how much of an interrupted upload it already has
+        response = self.send_message(f"offset {filename}")
+        return int(response.decode().split(':', 1)[1])
+
+    def check_upload(self, digest, filename):
+        # 9. Ask whether the server stores this content already, if so it files it under filename
+        response = self.send_message(f"upload-check {digest} {filename}")
+        return response.decode().strip() == "File already stored"
+
+    def receive(self):
+        # 10. Receive a response from the server without sending anything
+        return self.socket.recv(1024)
+
+
+def send_range(client, filename, file_content, start, end, responses):
+    # send the bytes start to end of the file on this client's own connection
+    client.connect()
+    client.send_message(f"upload {filename}")
+    header = f"file-name: {filename},\r\nfile-size: {len(file_content)}\r\nfile-range: {start}-{end}\r\n\r\n".encode()
+    client.sendall(header + file_content[start:end])
+    responses.append(client.receive().decode().strip())
+    client.disconnect()
+
+
+def upload_parallel(host, port, filename, streams):
+    # split the file into one byte range per stream and send them all at once
+    file_content = files[filename].encode()
+    bounds = sorted({len(file_content) * i // streams for i in range(streams + 1)})
+    responses = []
+    threads = [
+        threading.Thread(target=send_range, args=(Client(host, port), filename, file_content, start, end, responses))
+        for start, end in zip(bounds, bounds[1:])
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def upload_deduplicated(client, filename):
+    # send the file only when the server does not have its content yet
+    file_content = files[filename].encode()
+    if client.check_upload(hashlib.sha256(file_content).hexdigest(), filename):
+        print("File already stored")
+        return False
+
+    response = client.send_message(f"upload {filename}")
+    print(response.decode().strip())
+    header = f"file-name: {filename},\r\nfile-size: {len(file_content)}\r\n\r\n".encode()
+    client.sendall(header + file_content)
+    return True
+
+
+def resume_upload(client, filename):
+    # continue an interrupted upload from the offset the server has committed
+    file_content = files[filename].encode()
+    offset = client.get_offset(filename)
+
+    response = client.send_message(f"upload {filename}")
+    print(response.decode().strip())
+
+    # the header says where the content starts, only the rest of the file is sent
+    header = f"file-name: {filename},\r\nfile-size: {len(file_content)}\r\nfile-offset: {offset}\r\n\r\n".encode()
+    client.sendall(header + file_content[offset:])
+    return offset
+
 
 def start_client():
     # 1. Create a Client object
@@ -142,6 +212,60 @@ class TestClient(unittest.TestCase):
         print(f"close called with: {mock_socket.return_value.close.call_args}")
         print()
 
+    @patch('socket.socket')
+    def test_resume_upload(self, mock_socket):
+        print('Testing resume upload ...')
+        client_socket_instance = mock_socket.return_value
+        client_socket_instance.recv.side_effect = [b'offset: 7', b'Ready to receive file']
+        client = Client('localhost', 65432)
+
+        offset = resume_upload(client, '729.txt')
+
+        assert_equal(offset, 7)
+        client_socket_instance.send.assert_any_call(b'offset 729.txt')
+        header = f"file-name: 729.txt,\r\nfile-size: {len(files['729.txt'])}\r\nfile-offset: 7\r\n\r\n".encode()
+        client_socket_instance.sendall.assert_called_with(header + files['729.txt'][7:].encode())
+        print(f"sendall called with: {client_socket_instance.sendall.call_args}")
+        print()
+
+    @patch('socket.socket')
+    def test_upload_deduplicated(self, mock_socket):
+        print('Testing deduplicated upload ...')
+        client_socket_instance = mock_socket.return_value
+        client = Client('localhost', 65432)
+        digest = hashlib.sha256(files['729.txt'].encode()).hexdigest()
+
+        # the server has the content, nothing is sent
+        client_socket_instance.recv.side_effect = [b'File already stored']
+        assert_equal(upload_deduplicated(client, '729.txt'), False)
+        client_socket_instance.send.assert_called_with(f'upload-check {digest} 729.txt'.encode())
+        client_socket_instance.sendall.assert_not_called()
+
+        # the server does not, the file is uploaded
+        client_socket_instance.recv.side_effect = [b'File not stored', b'Ready to receive file']
+        assert_equal(upload_deduplicated(client, '729.txt'), True)
+        client_socket_instance.sendall.assert_called_once()
+        print()
+
+    @patch('socket.socket')
+    def test_upload_parallel(self, mock_socket):
+        print('Testing parallel upload ...')
+        client_socket_instance = mock_socket.return_value
+        client_socket_instance.recv.return_value = b'Range received successfully'
+
+        responses = upload_parallel('localhost', 65432, '729.txt', 3)
+
+        assert_equal(len(responses), 3)
+        # the ranges put back together in order are the whole file
+        ranges = {}
+        for call in client_socket_instance.sendall.call_args_list:
+            header, content = call.args[0].split(b'\r\n\r\n', 1)
+            start, end = header.split(b'file-range: ')[1].split(b'-')
+            assert_equal(int(end) - int(start), len(content))
+            ranges[int(start)] = content
+        self.assertEqual(b''.join(ranges[start] for start in sorted(ranges)), files['729.txt'].encode())
+        print()
+
     @patch('builtins.input', return_value='upload 729.txt')
     @patch('socket.socket')
     def test_start_client(self, mock_socket, mock_input):
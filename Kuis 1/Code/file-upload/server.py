@@ -1,20 +1,129 @@
+import contextlib
+import hashlib
+import json
 import os
+import re
 import socket
 import select
 import unittest
 import sys
+import tempfile
+import time
 from unittest.mock import patch, MagicMock
 from io import StringIO
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 BUFFER_SIZE = 1024
 
+# the file body is received into one preallocated buffer of this size
+RECEIVE_BUFFER_SIZE = 256 * 1024
+
+# the blank line between the header and the file content
+HEADER_END = b'\r\n\r\n'
+
+# a header that has not ended after this many bytes is rejected
+MAX_HEADER_SIZE = 64 * 1024
+
+# a file is received as <name>.part until it is complete, next to a
+# <name>.checkpoint that records how much of it is safely on disk
+PART_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+# how many received bytes go to disk between two checkpoints, each checkpoint
+# syncs the file on the loop, so every client waits for it, a longer interval
+# means fewer waits but more content to send again after a crash
+CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+
+# a file on disk is hashed this many bytes per upload in one pass of the
+# loop, so hashing a long file never holds up the other clients for long
+HASH_STEP = 16 * 1024 * 1024
+
+# complete files are stored once per content, as .store/objects/<sha256>, and every
+# file name is a hard link to its object, recorded in .store/index.json, the store
+# is a hidden directory of its own so no uploaded file name can replace it
+STORE_DIR = '.store'
+OBJECTS_DIR = 'objects'
+INDEX_FILE = 'index.json'
+DIGEST_PATTERN = re.compile('[0-9a-f]{64}')
+
+# a parallel upload sends the byte range start-end (end exclusive) of the file
+# on each connection, the header names it as "file-range: start-end"
+RANGE_PATTERN = re.compile(r'(\d+)-(\d+)')
+
+# a parallel upload that no connection has sent a range of for this many
+# seconds is given up, the ranges it has are dropped and its name is free again
+RANGE_TIMEOUT = 60.0
+
+# what a client connection is waiting for
+AWAITING_COMMAND = 'awaiting command'
+AWAITING_HEADER = 'awaiting header'
+HASHING = 'hashing'
+RECEIVING_BODY = 'receiving body'
+
+
+class Upload:
+    def __init__(self):
+        # state of one client connection, start() moves it along as data arrives
+        self.state = AWAITING_COMMAND
+
+        # header bytes received so far, while hashing the content that came after the header
+        self.pending = b''
+
+        # the file being received and how much of it has arrived,
+        # received counts from the start of the file, not of this connection
+        self.file = None
+        self.file_path = None
+        self.file_size = 0
+        self.received = 0
+
+        # offset recorded by the last checkpoint
+        self.committed = 0
+
+        # SHA-256 of the content received so far, and how much of the file on
+        # disk it has seen while it catches up in the HASHING state
+        self.hasher = None
+        self.hashed = 0
+
+        # for a parallel upload: the file shared by all its connections and the
+        # range this connection sends, received then stops at the range end
+        self.ranged = None
+        self.range = None
+
+
+class RangedFile:
+    def __init__(self, fd, file_size):
+        # a file that several connections write at their own offsets with os.pwrite
+        self.fd = fd
+        self.file_size = file_size
+
+        # ranges being sent or already written, as (start, end), they never overlap
+        self.claimed = []
+
+        # how many connections are sending a range right now, and since when
+        # none has been while the file is incomplete, the ranges that are
+        # written stay until the upload is given up after RANGE_TIMEOUT
+        self.sending = 0
+        self.idle_since = None
+
+        # how many bytes of complete ranges are written
+        self.committed = 0
+
+
 class Server:
-    def __init__(self, host="127.0.0.1", port=65432):
+    def __init__(self, host="127.0.0.1", port=65432, buffer_size=RECEIVE_BUFFER_SIZE, upload_dir=BASE_DIR,
+                 hash_step=HASH_STEP, range_timeout=RANGE_TIMEOUT):
         # define host and port
         self.host = host
         self.port = port
 
+        # directory the uploaded files are saved in
+        self.upload_dir = upload_dir
+
+        # reusable buffer for the file body, recv_into fills it in place
+        self.receive_buffer = memoryview(bytearray(buffer_size))
+        self.hash_step = hash_step
+        self.range_timeout = range_timeout
+
         # create socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -30,6 +139,19 @@ class Server:
         # list for select
         # the first element is the server socket
         self.input_socket = [self.server_socket]
+
+        # key: client socket, value: its Upload state
+        self.uploads = {}
+
+        # key: file name, value: SHA-256 of its content, read from INDEX_FILE on first use
+        self.index = None
+
+        # key: file path, value: RangedFile of a parallel upload in progress
+        self.ranged_files = {}
+
+        # key: file path, value: socket of the plain or resumed upload writing it,
+        # a second upload of the same file is refused while it runs
+        self.active_uploads = {}
     
     def parse_header(self, header_content):
         # Parse the header and return the file name, size, and content
@@ -46,12 +168,39 @@ class Server:
             if line.startswith('file-name:'):
                 filename = line.split(':', 1)[1].strip().rstrip(',')
             elif line.startswith('file-size:'):
-                filesize = int(line.split(':', 1)[1].strip())
+                # a size that is not a number is left as None, the header is then invalid
+                try:
+                    filesize = int(line.split(':', 1)[1].strip())
+                except ValueError:
+                    filesize = None
         
         return filename, filesize, content 
-    
+
+    def parse_offset(self, header_content):
+        # a resumed upload names the offset its content starts at, None if it is not a number
+        for line in header_content.split('\r\n'):
+            if line.startswith('file-offset:'):
+                try:
+                    return int(line.split(':', 1)[1].strip())
+                except ValueError:
+                    return None
+        return 0
+
+    def parse_range(self, header_content):
+        # return (start, end) of a parallel upload's range, or None
+        for line in header_content.split('\r\n'):
+            if line.startswith('file-range:'):
+                match = RANGE_PATTERN.fullmatch(line.split(':', 1)[1].strip())
+                if match:
+                    return int(match.group(1)), int(match.group(2))
+        return None
+
     def receive_file(self, first_chunk, file_path, file_size, sock):
-        # Receive the file from the server and save it
+        # Receive the file from the client and save it, the content is written as raw bytes
+        if isinstance(first_chunk, str):
+            first_chunk = first_chunk.encode()
+        first_chunk = first_chunk[:file_size]
+
         total_received = 0
         content_length = len(first_chunk)
             
@@ -63,34 +212,451 @@ class Server:
                 total_received = content_length
 
                 # write first chunk of data to file
-                f.write(first_chunk.encode())
+                f.write(first_chunk)
 
             # Receive and save the file
             # while total recived data is less than file size
             while total_received < file_size:
-                # receive data
-                # use min(BUFFER_SIZE, file_size - total_received) if necessary
-                chunk = sock.recv(min(BUFFER_SIZE, file_size - total_received))
-                if not chunk:
+                # receive data into the reusable buffer, no new bytes object per chunk
+                # use min(buffer size, file_size - total_received) to stop at the end of the file
+                received = sock.recv_into(self.receive_buffer, min(len(self.receive_buffer), file_size - total_received))
+                if not received:
                     break
 
-                # write chunk to file
-                f.write(chunk)
+                # write the received part of the buffer to file
+                f.write(self.receive_buffer[:received])
 
                 # total received is equal to total received plus chunk length
-                total_received += len(chunk)
+                total_received += received
             
             print(f"[+] File {file_path} received successfully!")
 
             # Send confirmation to the client
             sock.sendall(b"File received successfully")
     
+    def handle_client(self, sock):
+        upload = self.uploads[sock]
+        try:
+            if upload.state == RECEIVING_BODY:
+                # file content goes through the reusable buffer
+                end = upload.range[1] if upload.range else upload.file_size
+                size = min(len(self.receive_buffer), end - upload.received)
+                received = sock.recv_into(self.receive_buffer, size)
+                data = self.receive_buffer[:received]
+            else:
+                data = sock.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b''
+
+        if not data:
+            self.close_client(sock)
+        elif upload.state == AWAITING_COMMAND:
+            self.handle_command(upload, data, sock)
+        elif upload.state == AWAITING_HEADER:
+            self.handle_header(upload, data, sock)
+        else:
+            self.write_body(upload, data, sock)
+
+    def upload_path(self, file_name):
+        # only the base name is used, a client cannot write outside the upload directory,
+        # None for a name that is not a file of its own there
+        name = os.path.basename(file_name)
+        if name in ('', '.', '..', STORE_DIR):
+            return None
+        return os.path.join(self.upload_dir, name)
+
+    def load_checkpoint(self, file_path):
+        # return the file size and committed offset of an interrupted upload, or (None, 0)
+        try:
+            part_size = os.path.getsize(file_path + PART_SUFFIX)
+            with open(file_path + CHECKPOINT_SUFFIX) as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None, 0
+
+        # a checkpoint past the end of the file belongs to content the file no longer holds
+        if checkpoint['offset'] > part_size:
+            return None, 0
+        return checkpoint['file-size'], checkpoint['offset']
+
+    def remove_checkpoint(self, file_path):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path + CHECKPOINT_SUFFIX)
+
+    def save_checkpoint(self, upload):
+        # the data reaches the disk first, a checkpoint never points past what the file holds,
+        # fdatasync skips the metadata a resume does not need, like the modification time
+        upload.file.flush()
+        sync = getattr(os, 'fdatasync', os.fsync)
+        sync(upload.file.fileno())
+
+        # write a new checkpoint and rename it over the old one, so there is always a whole one
+        checkpoint_path = upload.file_path + CHECKPOINT_SUFFIX
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'file-size': upload.file_size, 'offset': upload.received}, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        upload.committed = upload.received
+
+    def object_path(self, digest):
+        return os.path.join(self.upload_dir, STORE_DIR, OBJECTS_DIR, digest)
+
+    def load_index(self):
+        if self.index is None:
+            try:
+                with open(os.path.join(self.upload_dir, STORE_DIR, INDEX_FILE)) as f:
+                    self.index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self.index = {}
+        return self.index
+
+    def link_name(self, file_path, digest):
+        # point the file name at the stored content, replacing what the name held before
+        link_path = file_path + '.link'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(link_path)
+        os.link(self.object_path(digest), link_path)
+        os.replace(link_path, file_path)
+
+        # record it in the index, written next to it and renamed so it is always whole
+        index = self.load_index()
+        index[os.path.basename(file_path)] = digest
+        index_path = os.path.join(self.upload_dir, STORE_DIR, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def store_file(self, part_path, file_path, digest):
+        # keep one copy per content, a file whose content is already stored is dropped
+        object_path = self.object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path):
+            os.remove(part_path)
+        else:
+            os.replace(part_path, object_path)
+        self.link_name(file_path, digest)
+
+    def handle_check(self, parts, sock):
+        # upload-check <sha256> [file_name]: whether the content is stored already,
+        # if it is and a name is given, the name gets that content without any upload
+        digest = parts[1].lower()
+        if not DIGEST_PATTERN.fullmatch(digest) or not os.path.exists(self.object_path(digest)):
+            sock.sendall(b"File not stored")
+            return
+
+        if len(parts) == 3:
+            file_path = self.upload_path(parts[2])
+            if file_path is None:
+                sock.sendall(b"Invalid file name")
+                return
+            self.link_name(file_path, digest)
+        sock.sendall(b"File already stored")
+
+    def handle_command(self, upload, data, sock):
+        # get command and filename, use split string
+        parts = data.decode('utf-8', 'replace').strip().split()
+        print(*parts)
+
+        if len(parts) == 2 and parts[0] == 'offset':
+            # tell the client where to resume an interrupted upload from
+            file_path = self.upload_path(parts[1])
+            if file_path is None:
+                sock.sendall(b"Invalid file name")
+                return
+            _, offset = self.load_checkpoint(file_path)
+            sock.sendall(f"offset: {offset}".encode())
+            return
+
+        if len(parts) in (2, 3) and parts[0] == 'upload-check':
+            self.handle_check(parts, sock)
+            return
+
+        if len(parts) != 2 or parts[0] != 'upload':
+            # send 'Unknown command'
+            sock.sendall(b"Unknown command. The commands are: upload file_name, offset file_name, "
+                         b"upload-check sha256 [file_name]")
+            return
+
+        # Send acknowledgement to start receiving file
+        # send 'Ready to receive file'
+        sock.sendall(b"Ready to receive file")
+        upload.state = AWAITING_HEADER
+
+    def handle_header(self, upload, data, sock):
+        # the header may arrive in pieces, wait for the blank line that ends it
+        upload.pending += data
+        if HEADER_END not in upload.pending:
+            if len(upload.pending) > MAX_HEADER_SIZE:
+                self.close_client(sock)
+            return
+
+        header, _, content = upload.pending.partition(HEADER_END)
+        upload.pending = b''
+        header = header.decode('utf-8', 'replace')
+        file_name, file_size, _ = self.parse_header(header)
+        offset = self.parse_offset(header)
+        file_path = self.upload_path(file_name) if file_name else None
+        if file_path is None or file_size is None or file_size < 0 or offset is None or offset < 0:
+            sock.sendall(b"Invalid header")
+            upload.state = AWAITING_COMMAND
+            return
+
+        upload.file_path = file_path
+        file_range = self.parse_range(header)
+
+        # ranges of one parallel upload share the file, anything else gets it alone
+        if upload.file_path in self.active_uploads or (file_range is None and upload.file_path in self.ranged_files):
+            sock.sendall(b"Upload in progress")
+            upload.state = AWAITING_COMMAND
+            return
+
+        if file_range is not None:
+            self.start_range(upload, file_size, file_range, content, sock)
+            return
+
+        part_path = upload.file_path + PART_SUFFIX
+        if offset:
+            # resume only from data the checkpoint says is on disk, for the same file size
+            checkpoint_size, committed = self.load_checkpoint(upload.file_path)
+            if checkpoint_size != file_size or not 0 < offset <= committed:
+                sock.sendall(f"Invalid offset, resume from offset: {committed}".encode())
+                upload.state = AWAITING_COMMAND
+                return
+            upload.file = open(part_path, 'r+b')
+            upload.file.truncate(offset)
+            upload.hasher = hashlib.sha256()
+            upload.hashed = 0
+        else:
+            # the checkpoint of an earlier upload goes before the file is emptied,
+            # it must never describe content the new upload has not written
+            self.remove_checkpoint(upload.file_path)
+            upload.file = open(part_path, 'wb')
+            upload.hasher = hashlib.sha256()
+        self.active_uploads[upload.file_path] = sock
+
+        upload.file_size = file_size
+        upload.received = upload.committed = offset
+
+        # whatever came after the header is the content from the offset on
+        if offset:
+            # a hash cannot be saved in a checkpoint, the part on disk is hashed
+            # again by continue_hashing before any more content is received
+            upload.file.seek(offset)
+            upload.pending = content[:file_size - offset]
+            upload.state = HASHING
+            return
+        upload.state = RECEIVING_BODY
+        self.write_body(upload, content[:file_size - offset], sock)
+
+    def start_range(self, upload, file_size, file_range, content, sock):
+        ranged = self.ranged_files.get(upload.file_path)
+        start, end = file_range
+        if (not 0 <= start < end <= file_size
+                or ranged is not None and ranged.file_size != file_size
+                or ranged is not None and any(start < claimed_end and claimed_start < end
+                                              for claimed_start, claimed_end in ranged.claimed)):
+            sock.sendall(b"Invalid range")
+            upload.state = AWAITING_COMMAND
+            return
+
+        if ranged is None:
+            # the first range of the file creates it with its whole size allocated,
+            # so positional writes from every connection never extend it, ranges
+            # are not resumed so a checkpoint of an earlier upload is dropped
+            self.remove_checkpoint(upload.file_path)
+            part_path = upload.file_path + PART_SUFFIX
+            fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, file_size)
+                else:
+                    os.ftruncate(fd, file_size)
+            except OSError:
+                # no room for the file, nothing of it is kept
+                os.close(fd)
+                os.remove(part_path)
+                raise
+            ranged = self.ranged_files[upload.file_path] = RangedFile(fd, file_size)
+
+        ranged.claimed.append(file_range)
+        ranged.sending += 1
+        ranged.idle_since = None
+        upload.ranged = ranged
+        upload.range = file_range
+        upload.file_size = file_size
+        upload.received = start
+        upload.state = RECEIVING_BODY
+
+        # whatever came after the header is the start of the range
+        self.write_body(upload, content[:end - start], sock)
+
+    def write_range(self, upload, data, sock):
+        os.pwrite(upload.ranged.fd, data, upload.received)
+        upload.received += len(data)
+        if upload.received < upload.range[1]:
+            return
+
+        ranged = upload.ranged
+        ranged.committed += upload.range[1] - upload.range[0]
+        ranged.sending -= 1
+        upload.range = None
+        if ranged.committed < ranged.file_size:
+            if not ranged.sending:
+                ranged.idle_since = time.monotonic()
+            upload.ranged = None
+            upload.state = AWAITING_COMMAND
+            sock.sendall(b"Range received successfully")
+            return
+
+        # every range is written, the ranges arrived out of order so the content
+        # is hashed now, by continue_hashing on the connection of the last range
+        upload.hasher = hashlib.sha256()
+        upload.hashed = 0
+        upload.state = HASHING
+
+    def finish_ranged(self, upload, sock):
+        ranged = upload.ranged
+        upload.ranged = None
+        upload.state = AWAITING_COMMAND
+        os.close(ranged.fd)
+        del self.ranged_files[upload.file_path]
+
+        digest = upload.hasher.hexdigest()
+        self.store_file(upload.file_path + PART_SUFFIX, upload.file_path, digest)
+        print(f"[+] File {upload.file_path} received successfully! sha256: {digest}")
+        sock.sendall(b"File received successfully")
+
+    def hash_more(self, upload, fd, end):
+        # hash at most hash_step more bytes of the file, return True once all end bytes are hashed
+        stop = min(end, upload.hashed + self.hash_step)
+        while upload.hashed < stop:
+            read = os.preadv(fd, [self.receive_buffer[:stop - upload.hashed]], upload.hashed)
+            if not read:
+                raise OSError(f"{upload.file_path} ends before offset {end}")
+            upload.hasher.update(self.receive_buffer[:read])
+            upload.hashed += read
+        return upload.hashed >= end
+
+    def continue_hashing(self, sock):
+        # a complete parallel upload is stored once it is hashed
+        upload = self.uploads[sock]
+        if upload.ranged is not None:
+            if self.hash_more(upload, upload.ranged.fd, upload.ranged.file_size):
+                self.finish_ranged(upload, sock)
+            return
+
+        # a resumed upload receives the rest of the file once its prefix is hashed
+        if not self.hash_more(upload, upload.file.fileno(), upload.received):
+            return
+        content, upload.pending = upload.pending, b''
+        upload.state = RECEIVING_BODY
+        self.write_body(upload, content, sock)
+
+    def write_body(self, upload, data, sock):
+        if upload.ranged is not None:
+            self.write_range(upload, data, sock)
+            return
+
+        # the content is hashed as it arrives, there is no second pass over the file
+        upload.hasher.update(data)
+        upload.file.write(data)
+        upload.received += len(data)
+        if upload.received >= upload.file_size:
+            self.finish_upload(upload, sock)
+        elif upload.received - upload.committed >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint(upload)
+
+    def finish_upload(self, upload, sock):
+        upload.file.close()
+        upload.file = None
+        del self.active_uploads[upload.file_path]
+
+        # the complete file goes into the store under its name, the checkpoint is no longer needed
+        digest = upload.hasher.hexdigest()
+        self.store_file(upload.file_path + PART_SUFFIX, upload.file_path, digest)
+        self.remove_checkpoint(upload.file_path)
+        print(f"[+] File {upload.file_path} received successfully! sha256: {digest}")
+
+        # Send confirmation to the client, it may upload another file
+        sock.sendall(b"File received successfully")
+        upload.state = AWAITING_COMMAND
+
+    def close_client(self, sock):
+        # a partially received file is kept with a checkpoint, the client can resume it
+        upload = self.uploads.pop(sock)
+        if upload.file is not None:
+            try:
+                self.save_checkpoint(upload)
+            except OSError as error:
+                # the previous checkpoint stays, it never points past what is on disk
+                print(f"[-] Checkpoint of {upload.file_path} not saved: {error}")
+            upload.file.close()
+            del self.active_uploads[upload.file_path]
+
+        # an unfinished range is given up, the client can send it again on another
+        # connection, the ranges already written are kept for RANGE_TIMEOUT
+        if upload.range is not None:
+            upload.ranged.claimed.remove(upload.range)
+            upload.ranged.sending -= 1
+            if not upload.ranged.sending:
+                upload.ranged.idle_since = time.monotonic()
+        elif upload.ranged is not None:
+            # the last range was written but hashing the file failed, the whole upload is given up
+            self.drop_ranged(upload.file_path)
+
+        # close socket
+        sock.close()
+
+        # remove socket from list for select
+        self.input_socket.remove(sock)
+
+    def drop_ranged(self, file_path):
+        # forget a parallel upload that will not be completed, its name can be uploaded again
+        os.close(self.ranged_files.pop(file_path).fd)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path + PART_SUFFIX)
+
+    def drop_abandoned(self, now=None):
+        # give up the parallel uploads nobody sent a range of for range_timeout seconds,
+        # return the seconds until the next one would be given up, or None
+        if now is None:
+            now = time.monotonic()
+        wait = None
+        for file_path, ranged in list(self.ranged_files.items()):
+            if ranged.idle_since is None:
+                continue
+            left = ranged.idle_since + self.range_timeout - now
+            if left <= 0:
+                print(f"[-] Parallel upload of {file_path} abandoned")
+                self.drop_ranged(file_path)
+            elif wait is None or left < wait:
+                wait = left
+        return wait
+
+    def serve_client(self, step, sock):
+        # a client that fails is dropped and the other uploads go on
+        try:
+            step(sock)
+        except OSError as error:
+            print(f"[-] Client {sock} failed: {error}")
+            if sock in self.uploads:
+                self.close_client(sock)
+
     def start(self):
         print(f"[+] Listening from {self.host}:{self.port}")
         try:
             while True:
+                # a client that is being hashed is not read, select only polls
+                # while there is hashing left so it goes on right away
+                hashing = [sock for sock, upload in self.uploads.items() if upload.state == HASHING]
+                readers = [sock for sock in self.input_socket if sock not in hashing]
+
+                # otherwise it wakes up in time to give up an abandoned parallel upload
+                wait = self.drop_abandoned()
+
                 # use select technique
-                read_ready, _, _ = select.select(self.input_socket, [], [])
+                read_ready, _, _ = select.select(readers, [], [], 0 if hashing else wait)
                 
                 for read_ready_socket in read_ready:
                     # if socket ready is the server socket
@@ -99,44 +665,19 @@ class Server:
                         client_socket, client_address = self.server_socket.accept()
                         print(f"[+] New client {client_socket} is connected.")
 
+                        # the client is only read when select reports data, so one
+                        # slow upload never holds up the others
+                        client_socket.setblocking(False)
+
                         # append client socket to list for select
                         self.input_socket.append(client_socket)
+                        self.uploads[client_socket] = Upload()
                     else:
-                        try:
-                            # Receive command and filename from client
-                            data = read_ready_socket.recv(BUFFER_SIZE)
-                        except ConnectionResetError:
-                            # close socket
-                            read_ready_socket.close()
-
-                            # remove socket from list for select
-                            self.input_socket.remove(read_ready_socket)
-                            break
-
-                        # get command and filename, use split string
-                        command, filename = data.decode().strip().split()
-                        print(command, filename)
-
-                        if command != "upload":
-                            # send 'Unknown command'
-                            read_ready_socket.sendall(b"Unknown command. The correct command is: upload file_name")
-                            continue
-                        
-                        elif command == 'upload':
-                            # Send acknowledgement to start receiving file
-                            # send 'Ready to receive file'
-                            read_ready_socket.sendall(b"Ready to receive file")
-
-                            # receive data again
-                            header_data = read_ready_socket.recv(BUFFER_SIZE).decode()
-
-                            # parse header, use parse_header method
-                            file_name, file_size, content = self.parse_header(header_data)
-                            file_path = os.path.join(BASE_DIR, file_name)
-
-                            # receive_file
-                            self.receive_file(content, file_path, file_size, read_ready_socket)
+                        # move this client's upload along with whatever it sent
+                        self.serve_client(self.handle_client, read_ready_socket)
 
+                for sock in hashing:
+                    self.serve_client(self.continue_hashing, sock)
 
         except KeyboardInterrupt:
             # close server socket
@@ -159,6 +700,20 @@ def assert_equal(parameter1, parameter2):
         print(f'test attribute failed: {parameter1} is not equal to {parameter2}')
 
 
+def feed_recv_into(mock_socket, *chunks):
+    # make a mock socket's recv_into copy the given chunks into the caller's buffer
+    chunks = list(chunks)
+
+    def recv_into(buffer, nbytes=0):
+        if not chunks:
+            return 0
+        chunk = chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    mock_socket.recv_into.side_effect = recv_into
+
+
 class TestServer(unittest.TestCase):
     @patch('socket.socket')
     def setUp(self, mock_socket):
@@ -181,7 +736,7 @@ class TestServer(unittest.TestCase):
     def test_receive_file(self, mock_socket, mock_open):
         print('Testing receive file ...')
         mock_sock_instance = MagicMock()
-        mock_sock_instance.recv = MagicMock(side_effect=[b"More content", b""])
+        feed_recv_into(mock_sock_instance, b"More content")
         
         first_chunk = "Initial content"
         file_path = "/fakepath/testfile.txt"
@@ -200,27 +755,509 @@ class TestServer(unittest.TestCase):
         print(f"sendall called with: {mock_sock_instance.sendall.call_args}")
         print()
 
+    def test_receive_binary_file(self):
+        print('Testing receive binary file ...')
+        mock_sock_instance = MagicMock()
+        feed_recv_into(mock_sock_instance, b"\x00\xfe", b"\xff\x80")
+        file_path = os.path.join(BASE_DIR, 'test-binary-upload.bin')
+
+        try:
+            self.server.receive_file(b"\x89PN", file_path, 7, mock_sock_instance)
+            with open(file_path, 'rb') as f:
+                self.assertEqual(f.read(), b"\x89PN\x00\xfe\xff\x80")
+        finally:
+            os.remove(file_path)
+        print()
+
+    def test_concurrent_uploads(self):
+        print('Testing concurrent uploads ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            first, second = MagicMock(), MagicMock()
+            for client in (first, second):
+                self.server.uploads[client] = Upload()
+                self.server.input_socket.append(client)
+
+            # both clients send their command and header before either file is complete
+            first.recv.side_effect = [b"upload a.bin", b"file-name: a.bin,\r\nfile-size: 4\r\n\r\nAA"]
+            second.recv.side_effect = [b"upload b.bin", b"file-name: ../b.bin,\r\nfile-size: 3\r\n\r\n"]
+            feed_recv_into(first, b"AA")
+            feed_recv_into(second, b"BBB")
+            for client in (first, second, first, second, first, second):
+                self.server.handle_client(client)
+
+            with open(os.path.join(upload_dir, 'a.bin'), 'rb') as f:
+                self.assertEqual(f.read(), b"AAAA")
+            with open(os.path.join(upload_dir, 'b.bin'), 'rb') as f:
+                self.assertEqual(f.read(), b"BBB")
+            for client in (first, second):
+                client.sendall.assert_called_with(b"File received successfully")
+                assert_equal(self.server.uploads[client].state, AWAITING_COMMAND)
+        print()
+
+    def test_resume_interrupted_upload(self):
+        print('Testing resume upload ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            file_path = os.path.join(upload_dir, 'big.bin')
+
+            # the first connection drops after 6 of 10 bytes
+            client = MagicMock()
+            self.server.uploads[client] = Upload()
+            self.server.input_socket.append(client)
+            client.recv.side_effect = [b"upload big.bin", b"file-name: big.bin,\r\nfile-size: 10\r\n\r\n0123", b""]
+            feed_recv_into(client, b"45")
+            for _ in range(4):
+                self.server.handle_client(client)
+            assert_equal(self.server.load_checkpoint(file_path), (10, 6))
+
+            # the second connection asks for the offset and sends the rest
+            client = MagicMock()
+            self.server.uploads[client] = Upload()
+            self.server.input_socket.append(client)
+            client.recv.side_effect = [
+                b"offset big.bin",
+                b"upload big.bin",
+                b"file-name: big.bin,\r\nfile-size: 10\r\nfile-offset: 6\r\n\r\n67",
+            ]
+            feed_recv_into(client, b"89")
+            self.server.handle_client(client)
+            client.sendall.assert_called_with(b"offset: 6")
+            for _ in range(2):
+                self.server.handle_client(client)
+
+            # the 6 bytes on disk are hashed again 4 at a time before the rest is received
+            self.server.hash_step = 4
+            self.server.continue_hashing(client)
+            assert_equal(self.server.uploads[client].state, HASHING)
+            self.server.continue_hashing(client)
+            assert_equal(self.server.uploads[client].state, RECEIVING_BODY)
+            self.server.handle_client(client)
+
+            with open(file_path, 'rb') as f:
+                self.assertEqual(f.read(), b"0123456789")
+            assert_equal(self.server.load_index()['big.bin'], hashlib.sha256(b"0123456789").hexdigest())
+            self.assertFalse(os.path.exists(file_path + CHECKPOINT_SUFFIX))
+            self.assertFalse(os.path.exists(file_path + PART_SUFFIX))
+        print()
+
+    def test_duplicate_content_is_stored_once(self):
+        print('Testing deduplicated store ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            for name in ('first.bin', 'second.bin'):
+                client = MagicMock()
+                self.server.uploads[client] = Upload()
+                client.recv.side_effect = [f"upload {name}".encode(), f"file-name: {name},\r\nfile-size: 4\r\n\r\ndata".encode()]
+                self.server.handle_client(client)
+                self.server.handle_client(client)
+
+            digest = hashlib.sha256(b"data").hexdigest()
+            assert_equal(os.listdir(os.path.join(upload_dir, STORE_DIR, OBJECTS_DIR)), [digest])
+            assert_equal(self.server.load_index(), {'first.bin': digest, 'second.bin': digest})
+            self.assertTrue(os.path.samefile(os.path.join(upload_dir, 'first.bin'), os.path.join(upload_dir, 'second.bin')))
+            with open(os.path.join(upload_dir, STORE_DIR, INDEX_FILE)) as f:
+                self.assertEqual(json.load(f), self.server.index)
+        print()
+
+    def test_upload_check(self):
+        print('Testing upload-check ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            digest = hashlib.sha256(b"data").hexdigest()
+            client = MagicMock()
+            upload = Upload()
+
+            self.server.handle_command(upload, f"upload-check {digest} copy.bin".encode(), client)
+            client.sendall.assert_called_with(b"File not stored")
+
+            os.makedirs(os.path.join(upload_dir, STORE_DIR, OBJECTS_DIR))
+            with open(self.server.object_path(digest), 'wb') as f:
+                f.write(b"data")
+            self.server.handle_command(upload, f"upload-check {digest} copy.bin".encode(), client)
+            client.sendall.assert_called_with(b"File already stored")
+            with open(os.path.join(upload_dir, 'copy.bin'), 'rb') as f:
+                self.assertEqual(f.read(), b"data")
+
+            # not a digest, it must not reach the file system
+            self.server.handle_command(upload, b"upload-check ../index.json", client)
+            client.sendall.assert_called_with(b"File not stored")
+
+            # the name of the store itself is not a file name
+            self.server.handle_command(upload, f"upload-check {digest} {STORE_DIR}".encode(), client)
+            client.sendall.assert_called_with(b"Invalid file name")
+        print()
+
+    def test_store_names_are_plain_files(self):
+        print('Testing file names of the store ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+
+            # files named like the index and the objects directory do not touch the store
+            for name, content in ((INDEX_FILE, b"{}"), (OBJECTS_DIR, b"data")):
+                client = MagicMock()
+                self.server.uploads[client] = Upload()
+                client.recv.side_effect = [f"upload {name}".encode(),
+                                           f"file-name: {name},\r\nfile-size: {len(content)}\r\n\r\n".encode() + content]
+                self.server.handle_client(client)
+                self.server.handle_client(client)
+                client.sendall.assert_called_with(b"File received successfully")
+                with open(os.path.join(upload_dir, name), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+
+            self.server.index = None
+            assert_equal(self.server.load_index(), {INDEX_FILE: hashlib.sha256(b"{}").hexdigest(),
+                                                    OBJECTS_DIR: hashlib.sha256(b"data").hexdigest()})
+        print()
+
+    def test_reserved_names_are_refused(self):
+        print('Testing reserved file names ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            for name in ('.', '..', 'a/..', STORE_DIR):
+                upload = Upload()
+                upload.state = AWAITING_HEADER
+                client = MagicMock()
+                self.server.uploads[client] = upload
+
+                self.server.handle_header(upload, f"file-name: {name},\r\nfile-size: 1\r\n\r\nx".encode(), client)
+                client.sendall.assert_called_with(b"Invalid header")
+                assert_equal(upload.state, AWAITING_COMMAND)
+
+                self.server.handle_command(upload, f"offset {name}".encode(), client)
+                client.sendall.assert_called_with(b"Invalid file name")
+            self.assertEqual(os.listdir(upload_dir), [])
+        print()
+
+    def test_parallel_ranges(self):
+        print('Testing parallel ranges ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            content = b"0123456789"
+            clients = []
+            for start, end in ((6, 10), (0, 3), (3, 6)):
+                client = MagicMock()
+                self.server.uploads[client] = Upload()
+                header = f"file-name: big.bin,\r\nfile-size: 10\r\nfile-range: {start}-{end}\r\n\r\n".encode()
+                client.recv.side_effect = [b"upload big.bin", header + content[start:start + 1]]
+                feed_recv_into(client, content[start + 1:end])
+                clients.append(client)
+
+            # all three ranges are in flight before any of them completes
+            for client in clients + clients:
+                self.server.handle_client(client)
+            part_path = os.path.join(upload_dir, 'big.bin' + PART_SUFFIX)
+            assert_equal(os.path.getsize(part_path), 10)
+
+            for client in clients:
+                self.server.handle_client(client)
+            clients[0].sendall.assert_called_with(b"Range received successfully")
+
+            # the last range makes the file complete, it is hashed 4 bytes at a time
+            self.server.hash_step = 4
+            for _ in range(3):
+                assert_equal(self.server.uploads[clients[2]].state, HASHING)
+                self.server.continue_hashing(clients[2])
+            clients[2].sendall.assert_called_with(b"File received successfully")
+            assert_equal(self.server.uploads[clients[2]].state, AWAITING_COMMAND)
+
+            with open(os.path.join(upload_dir, 'big.bin'), 'rb') as f:
+                self.assertEqual(f.read(), content)
+            assert_equal(self.server.load_index()['big.bin'], hashlib.sha256(content).hexdigest())
+            self.assertEqual(self.server.ranged_files, {})
+        print()
+
+    def test_overlapping_range_is_refused(self):
+        print('Testing overlapping range ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            first, second = MagicMock(), MagicMock()
+            for client, file_range in ((first, "0-6"), (second, "4-10")):
+                upload = Upload()
+                upload.state = AWAITING_HEADER
+                self.server.uploads[client] = upload
+                self.server.input_socket.append(client)
+                header = f"file-name: big.bin,\r\nfile-size: 10\r\nfile-range: {file_range}\r\n\r\n"
+                self.server.handle_header(upload, header.encode(), client)
+
+            second.sendall.assert_called_with(b"Invalid range")
+
+            # once the first connection drops its range can be sent again
+            self.server.close_client(first)
+            file_path = os.path.join(upload_dir, 'big.bin')
+            self.assertEqual(self.server.ranged_files[file_path].claimed, [])
+            self.server.drop_ranged(file_path)
+        print()
+
+    def start_ranges(self, *ranges):
+        # open a connection per range of a 10 byte big.bin, each sends its first two bytes
+        senders = []
+        for file_range in ranges:
+            upload = Upload()
+            upload.state = AWAITING_HEADER
+            client = MagicMock()
+            self.server.uploads[client] = upload
+            self.server.input_socket.append(client)
+            header = f"file-name: big.bin,\r\nfile-size: 10\r\nfile-range: {file_range}\r\n\r\n01"
+            self.server.handle_header(upload, header.encode(), client)
+            senders.append(client)
+        return senders
+
+    def upload_again(self, file_path):
+        # a plain upload of the same name, the server answers it right away
+        upload = Upload()
+        upload.state = AWAITING_HEADER
+        client = MagicMock()
+        self.server.uploads[client] = upload
+        self.server.handle_header(upload, b"file-name: big.bin,\r\nfile-size: 4\r\n\r\ndata", client)
+        return client
+
+    def test_abandoned_parallel_upload_is_dropped(self):
+        print('Testing abandoned parallel upload ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            file_path = os.path.join(upload_dir, 'big.bin')
+            complete, dropped = self.start_ranges("0-2", "2-10")
+            ranged = self.server.ranged_files[file_path]
+            fd = ranged.fd
+            assert_equal(self.server.uploads[complete].state, AWAITING_COMMAND)
+
+            # the sender of the second range drops, the range that is written stays
+            self.server.close_client(complete)
+            self.server.close_client(dropped)
+            self.assertIs(self.server.ranged_files[file_path], ranged)
+            assert_equal((ranged.claimed, ranged.committed), ([(0, 2)], 2))
+            assert_equal(self.server.drop_abandoned(ranged.idle_since + 10), self.server.range_timeout - 10)
+
+            # nobody sends a range for range_timeout seconds, the upload is given up
+            assert_equal(self.server.drop_abandoned(ranged.idle_since + self.server.range_timeout), None)
+            self.assertEqual(self.server.ranged_files, {})
+            self.assertFalse(os.path.exists(file_path + PART_SUFFIX))
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+
+            # the same name is uploaded again as a whole
+            client = self.upload_again(file_path)
+            client.sendall.assert_called_with(b"File received successfully")
+            with open(file_path, 'rb') as f:
+                self.assertEqual(f.read(), b"data")
+        print()
+
+    def test_incomplete_parallel_upload_is_dropped(self):
+        print('Testing incomplete parallel upload ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            file_path = os.path.join(upload_dir, 'big.bin')
+
+            # every range that was sent is complete, but 2-10 never is
+            (sender,) = self.start_ranges("0-2")
+            sender.sendall.assert_called_with(b"Range received successfully")
+            self.server.close_client(sender)
+            ranged = self.server.ranged_files[file_path]
+            self.assertIsNotNone(ranged.idle_since)
+
+            client = self.upload_again(file_path)
+            client.sendall.assert_called_with(b"Upload in progress")
+
+            # a later range of the same upload keeps it alive until it is sent
+            (late,) = self.start_ranges("2-10")
+            self.assertIsNone(ranged.idle_since)
+            self.server.drop_abandoned(time.monotonic() + self.server.range_timeout)
+            self.assertIn(file_path, self.server.ranged_files)
+            self.server.close_client(late)
+
+            self.server.drop_abandoned(ranged.idle_since + self.server.range_timeout)
+            self.assertEqual(self.server.ranged_files, {})
+            client = self.upload_again(file_path)
+            client.sendall.assert_called_with(b"File received successfully")
+        print()
+
+    def test_failed_allocation_closes_the_file(self):
+        print('Testing failed allocation ...')
+        with tempfile.TemporaryDirectory() as upload_dir, \
+             patch('os.posix_fallocate', side_effect=OSError(28, 'No space left on device'), create=True), \
+             patch('os.close', wraps=os.close) as mock_close:
+            self.server.upload_dir = upload_dir
+            upload = Upload()
+            upload.state = AWAITING_HEADER
+            client = MagicMock()
+
+            with self.assertRaises(OSError):
+                self.server.handle_header(upload, b"file-name: big.bin,\r\nfile-size: 10\r\nfile-range: 0-5\r\n\r\n", client)
+
+            mock_close.assert_called_once()
+            self.assertEqual(self.server.ranged_files, {})
+            self.assertEqual(os.listdir(upload_dir), [])
+        print()
+
+    def test_resume_past_checkpoint_is_refused(self):
+        print('Testing resume past checkpoint ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            upload = Upload()
+            client = MagicMock()
+            self.server.uploads[client] = upload
+            upload.state = AWAITING_HEADER
+
+            self.server.handle_header(upload, b"file-name: big.bin,\r\nfile-size: 10\r\nfile-offset: 6\r\n\r\n", client)
+
+            client.sendall.assert_called_with(b"Invalid offset, resume from offset: 0")
+            assert_equal(upload.state, AWAITING_COMMAND)
+        print()
+
+    def test_restarted_upload_drops_the_old_checkpoint(self):
+        print('Testing restarted upload ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            file_path = os.path.join(upload_dir, 'a.bin')
+            with open(file_path + PART_SUFFIX, 'wb') as f:
+                f.write(b"0123456789")
+            with open(file_path + CHECKPOINT_SUFFIX, 'w') as f:
+                json.dump({'file-size': 20, 'offset': 10}, f)
+
+            # the upload starts again and the server stops after 3 bytes, before any checkpoint
+            upload = Upload()
+            upload.state = AWAITING_HEADER
+            client = MagicMock()
+            self.server.uploads[client] = upload
+            self.server.handle_header(upload, b"file-name: a.bin,\r\nfile-size: 20\r\n\r\nabc", client)
+            upload.file.close()
+            assert_equal(self.server.load_checkpoint(file_path), (None, 0))
+
+            # a checkpoint past the end of the part file is not trusted either
+            with open(file_path + CHECKPOINT_SUFFIX, 'w') as f:
+                json.dump({'file-size': 20, 'offset': 10}, f)
+            assert_equal(self.server.load_checkpoint(file_path), (None, 0))
+
+            upload = Upload()
+            upload.state = AWAITING_HEADER
+            self.server.active_uploads.clear()
+            self.server.handle_header(upload, b"file-name: a.bin,\r\nfile-size: 20\r\nfile-offset: 10\r\n\r\nABCDEFGHIJ", client)
+            client.sendall.assert_called_with(b"Invalid offset, resume from offset: 0")
+            self.assertFalse(os.path.exists(file_path))
+        print()
+
+    def test_upload_in_progress_is_refused(self):
+        print('Testing upload in progress ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            clients = [MagicMock() for _ in range(4)]
+            for client in clients:
+                upload = Upload()
+                upload.state = AWAITING_HEADER
+                self.server.uploads[client] = upload
+                self.server.input_socket.append(client)
+            first, second, ranged, resumed = clients
+
+            self.server.handle_header(self.server.uploads[first], b"file-name: a.bin,\r\nfile-size: 10\r\n\r\nAAAAAA", first)
+
+            # neither a second plain upload nor a range may write the same file
+            for client, header in ((second, b"file-name: a.bin,\r\nfile-size: 10\r\n\r\n"),
+                                   (ranged, b"file-name: a.bin,\r\nfile-size: 10\r\nfile-range: 0-5\r\n\r\n")):
+                self.server.handle_header(self.server.uploads[client], header, client)
+                client.sendall.assert_called_with(b"Upload in progress")
+                assert_equal(self.server.uploads[client].state, AWAITING_COMMAND)
+
+            # once the first connection closed, its checkpoint lets the file be resumed
+            self.server.close_client(first)
+            self.server.handle_header(self.server.uploads[resumed],
+                                      b"file-name: a.bin,\r\nfile-size: 10\r\nfile-offset: 6\r\n\r\nBBBB", resumed)
+            self.server.continue_hashing(resumed)
+            resumed.sendall.assert_called_with(b"File received successfully")
+            with open(os.path.join(upload_dir, 'a.bin'), 'rb') as f:
+                self.assertEqual(f.read(), b"AAAAAABBBB")
+            self.assertEqual(self.server.active_uploads, {})
+        print()
+
+    def test_invalid_header_fields(self):
+        print('Testing invalid header fields ...')
+        with tempfile.TemporaryDirectory() as upload_dir:
+            self.server.upload_dir = upload_dir
+            for fields in ("file-size: ten", "file-size: -1", "file-size: 10\r\nfile-offset: x",
+                           "file-size: 10\r\nfile-offset: -4"):
+                upload = Upload()
+                upload.state = AWAITING_HEADER
+                client = MagicMock()
+                self.server.uploads[client] = upload
+
+                self.server.handle_header(upload, f"file-name: a.bin,\r\n{fields}\r\n\r\n".encode(), client)
+
+                client.sendall.assert_called_with(b"Invalid header")
+                assert_equal(upload.state, AWAITING_COMMAND)
+            self.assertEqual(os.listdir(upload_dir), [])
+        print()
+
+    def test_closed_connection_is_removed(self):
+        print('Testing closed connection ...')
+        client = MagicMock()
+        client.recv.return_value = b""
+        self.server.uploads[client] = Upload()
+        self.server.input_socket.append(client)
+
+        self.server.handle_client(client)
+
+        client.close.assert_called_once()
+        self.assertNotIn(client, self.server.uploads)
+        self.assertNotIn(client, self.server.input_socket)
+        print()
+
+    def test_failing_client_is_dropped(self):
+        print('Testing failing client ...')
+        with tempfile.TemporaryDirectory() as upload_dir, patch('select.select') as mock_select:
+            self.server.upload_dir = upload_dir
+            failing, other = MagicMock(), MagicMock()
+            for client in (failing, other):
+                self.server.uploads[client] = Upload()
+                self.server.input_socket.append(client)
+
+            # the first client is gone when the server answers it, the second one uploads a file
+            failing.recv.side_effect = [b"upload a.bin"]
+            failing.sendall.side_effect = BrokenPipeError
+            other.recv.side_effect = [b"upload b.bin", b"file-name: b.bin,\r\nfile-size: 3\r\n\r\nBBB"]
+            mock_select.side_effect = [([failing, other], [], []), ([other], [], []), KeyboardInterrupt]
+
+            with self.assertRaises(SystemExit):
+                self.server.start()
+
+            failing.close.assert_called_once()
+            self.assertNotIn(failing, self.server.uploads)
+            self.assertNotIn(failing, self.server.input_socket)
+            other.sendall.assert_called_with(b"File received successfully")
+        print()
+
     def test_start(self):
         print('Testing start ...')
         with patch('select.select') as mock_select, \
-             patch.object(Server, 'receive_file') as mock_receive_file, \
-             patch('socket.socket') as mock_socket:
-            # Mock select to immediately return a socket ready to read
-            mock_socket_instance = mock_socket.return_value
-            mock_socket_instance.accept.return_value = (mock_socket_instance, ('127.0.0.1', 12345))
-            mock_select.return_value = ([mock_socket_instance], [], [])
-            
-            # Simulate receiving "upload command" and then interrupt to stop the loop
-            mock_socket_instance.recv.side_effect = [
-                b"upload testfile.txt",
-                b"file-name: testfile.txt,\r\nfile-size: 1024\r\n\r\nContent",
+             patch('builtins.open', new_callable=unittest.mock.mock_open) as mock_open:
+            # the server socket accepts a client, which then sends a whole upload
+            server_socket = self.server.server_socket
+            client = MagicMock()
+            server_socket.accept.return_value = (client, ('127.0.0.1', 12345))
+            mock_select.side_effect = [
+                ([server_socket], [], []),
+                ([client], [], []),
+                ([client], [], []),
+                ([client], [], []),
                 KeyboardInterrupt
             ]
+            client.recv.side_effect = [
+                b"upload testfile.txt",
+                b"file-name: testfile.txt,\r\nfile-size: 11\r\n\r\nContent",
+            ]
+            feed_recv_into(client, b" end")
 
-            with self.assertRaises(SystemExit):
+            with patch.object(Server, 'store_file') as mock_store_file, self.assertRaises(SystemExit):
                 self.server.start()
 
-            mock_receive_file.assert_called()
+            file_path = os.path.join(BASE_DIR, 'testfile.txt')
+            client.setblocking.assert_called_once_with(False)
+            mock_open.assert_called_once_with(file_path + PART_SUFFIX, 'wb')
+            digest = hashlib.sha256(b"Content end").hexdigest()
+            mock_store_file.assert_called_once_with(file_path + PART_SUFFIX, file_path, digest)
+            handle = mock_open()
+            handle.write.assert_any_call(b"Content")
+            handle.write.assert_any_call(b" end")
+            client.sendall.assert_called_with(b"File received successfully")
             # print()
             
 
@@ -0,0 +1,426 @@
+import asyncio
+import unittest
+from io import StringIO
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from server import (
+    DEFAULT_ROOM,
+    FRAME_HEADER,
+    HIGH_WATERMARK,
+    HISTORY_SIZE,
+    HOST,
+    MAX_FRAME,
+    MAX_ROOM_NAME,
+    PORT,
+    Room,
+    encode_frame,
+)
+
+
+class AsyncClient:
+    def __init__(self, reader, writer, max_outbound=HIGH_WATERMARK):
+        self.reader = reader
+        self.writer = writer
+
+        # nickname and the encoded "user: " prefix, set by the first message
+        self.user = None
+        self.prefix = None
+
+        # name of the room the client is in
+        self.room = None
+
+        # messages waiting for the writer task, as (buffers, size)
+        self.outbound = asyncio.Queue()
+        self.outbound_size = 0
+        self.max_outbound = max_outbound
+        self.closed = False
+
+
+class AsyncChatServer:
+    def __init__(self, host=HOST, port=PORT, max_outbound=HIGH_WATERMARK, history_size=HISTORY_SIZE):
+        # define host and port
+        self.host = host
+        self.port = port
+
+        # a client whose pending output grows past this many bytes is disconnected
+        self.max_outbound = max_outbound
+
+        # key: room name, value: Room with its members and recent messages
+        self.rooms = {}
+        self.history_size = history_size
+        self.server = None
+
+        # tasks of the connected clients, cancelled by shutdown, which sets closing
+        # so they end quietly instead of raising into the streams layer
+        self.tasks = set()
+        self.closing = False
+
+    async def start(self):
+        """Start listening inside the running event loop and return the asyncio server."""
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        print(f'Listening for connections on {self.host}:{self.port}...')
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        """Stop accepting, then cancel every client task and wait until they are finished."""
+        self.closing = True
+        self.server.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def read_frame(self, reader):
+        # a 4 byte big-endian length followed by the payload
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME:
+            raise ConnectionError(f'frame of {length} bytes is too large')
+        return await reader.readexactly(length)
+
+    async def handle_connection(self, reader, writer):
+        client = AsyncClient(reader, writer, self.max_outbound)
+        writer_task = asyncio.create_task(self.write_loop(client))
+        task = asyncio.current_task()
+        self.tasks.add(task)
+
+        try:
+            # the first message from a client is its nickname
+            user = await self.read_frame(reader)
+            client.user = user.decode('utf-8', 'replace')
+            client.prefix = memoryview(f'{client.user}: '.encode('utf-8'))
+            print('Accepted new connection from {}:{}, nickname: {}'.format(*writer.get_extra_info('peername'), client.user))
+            self.join_room(client, DEFAULT_ROOM)
+
+            while not client.closed:
+                payload = await self.read_frame(reader)
+                if payload.startswith(b'/'):
+                    self.handle_command(client, payload)
+                else:
+                    self.handle_message(client, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if client.user is not None:
+                print('Closed connection from: {}'.format(client.user))
+        except asyncio.CancelledError:
+            # a cancellation goes on to whoever cancelled the task, unless
+            # it is the server shutting down, which waits for the task itself
+            if not self.closing:
+                raise
+        finally:
+            self.tasks.discard(task)
+            self.close_client(client)
+            writer_task.cancel()
+
+    async def write_loop(self, client):
+        # the only place that writes to the client, drain() holds it back
+        # while the peer is slow without stalling anybody else
+        while True:
+            buffers, size = await client.outbound.get()
+            client.writer.writelines(buffers)
+
+            # pick up everything that queued meanwhile before waiting
+            while not client.outbound.empty():
+                more, more_size = client.outbound.get_nowait()
+                client.writer.writelines(more)
+                size += more_size
+
+            try:
+                await client.writer.drain()
+            except ConnectionError:
+                self.close_client(client)
+                return
+            client.outbound_size -= size
+
+    def handle_command(self, client, payload):
+        command, _, argument = payload.decode('utf-8', 'replace').strip().partition(' ')
+        argument = argument.strip()
+
+        if command == '/join' and argument and len(argument.encode('utf-8')) <= MAX_ROOM_NAME:
+            self.join_room(client, argument)
+        elif command == '/leave':
+            self.join_room(client, DEFAULT_ROOM)
+        else:
+            self.notify(client, 'Unknown command. The commands are: /join room_name, /leave')
+
+    def join_room(self, client, name):
+        # a client is in one room at a time, joining a room leaves the current one
+        self.leave_room(client)
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(self.history_size)
+        room.members.add(client)
+        client.room = name
+
+        # the notice and the recent messages go out in one write
+        notice = memoryview(encode_frame(f'You are in room {name}\n'.encode('utf-8')))
+        buffers = (notice,) + room.history.snapshot()
+        self.send_to(client, buffers, len(notice) + room.history.size)
+
+    def leave_room(self, client):
+        if client.room is None:
+            return
+        room = self.rooms[client.room]
+        room.members.discard(client)
+
+        # forget rooms nobody is in anymore, their history included
+        if not room.members:
+            del self.rooms[client.room]
+        client.room = None
+
+    def notify(self, client, text):
+        # a message from the server itself, only for this client
+        notice = memoryview(encode_frame(f'{text}\n'.encode('utf-8')))
+        self.send_to(client, (notice,), len(notice))
+
+    def handle_message(self, client, message):
+        # with the nickname in front it still has to fit the frames clients accept
+        if len(client.prefix) + len(message) > MAX_FRAME:
+            self.notify(client, 'Message too long')
+            return
+        print(f'Received message from {client.user}: {message.decode("utf-8", "replace")}')
+
+        # broadcast message with nickname prefixed, built once for every recipient
+        header = FRAME_HEADER.pack(len(client.prefix) + len(message))
+        buffers = (memoryview(header), client.prefix, memoryview(message))
+        self.broadcast(buffers, client, client.room)
+
+    def broadcast(self, buffers, sender, room):
+        # queue the message for every member of the room except the sender
+        room = self.rooms.get(room)
+        if room is None:
+            return
+
+        size = sum(len(buffer) for buffer in buffers)
+        for client in list(room.members):
+            if client is not sender:
+                self.send_to(client, buffers, size)
+
+        # keep it for clients that join later
+        room.history.append(buffers, size)
+
+    def send_to(self, client, buffers, size):
+        # a client with nothing pending gets the message, however large
+        if client.outbound_size and client.outbound_size + size > client.max_outbound:
+            print(f'Disconnecting slow client {client.user}: outbound buffer is full')
+            self.close_client(client)
+            return
+
+        client.outbound.put_nowait((buffers, size))
+        client.outbound_size += size
+
+    def close_client(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        self.leave_room(client)
+        client.writer.close()
+
+
+def run_async_server(host=HOST, port=PORT):
+    try:
+        asyncio.run(AsyncChatServer(host, port).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def start_server():
+    run_async_server(HOST, PORT)
+
+
+# A 'null' stream that discards anything written to it
+class NullWriter(StringIO):
+    def write(self, txt):
+        pass
+
+
+def make_writer():
+    # a StreamWriter stand-in that remembers everything written to it
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    writer.get_extra_info.return_value = ('127.0.0.1', 12345)
+    writer.written = bytearray()
+    writer.writelines.side_effect = lambda buffers: writer.written.extend(b''.join(buffers))
+    return writer
+
+
+def make_reader(*payloads):
+    # a StreamReader that yields the given frames and then the end of the stream
+    reader = asyncio.StreamReader()
+    for payload in payloads:
+        reader.feed_data(encode_frame(payload))
+    reader.feed_eof()
+    return reader
+
+
+class TestAsyncChatServer(unittest.IsolatedAsyncioTestCase):
+    def make_client(self, server, user, room=DEFAULT_ROOM):
+        client = AsyncClient(asyncio.StreamReader(), make_writer(), server.max_outbound)
+        client.user = user
+        client.prefix = memoryview(f'{user}: '.encode())
+        client.room = room
+        if room not in server.rooms:
+            server.rooms[room] = Room()
+        server.rooms[room].members.add(client)
+        return client
+
+    async def test_handshake_and_broadcast(self):
+        print('Testing handshake and broadcast ...')
+        server = AsyncChatServer()
+        listener = self.make_client(server, 'bob')
+        listener_task = asyncio.create_task(server.write_loop(listener))
+
+        writer = make_writer()
+        await server.handle_connection(make_reader(b'alice', b'hi'), writer)
+        await asyncio.sleep(0)
+
+        self.assertEqual(bytes(listener.writer.written), encode_frame(b'alice: hi'))
+        self.assertEqual(bytes(writer.written), b'')
+        writer.close.assert_called_once()
+        self.assertEqual(server.rooms[DEFAULT_ROOM].members, {listener})
+        listener_task.cancel()
+        print()
+
+    async def test_write_loop_drains(self):
+        print('Testing write loop ...')
+        server = AsyncChatServer()
+        client = self.make_client(server, 'bob')
+        task = asyncio.create_task(server.write_loop(client))
+
+        server.send_to(client, (memoryview(b'abc'),), 3)
+        server.send_to(client, (memoryview(b'de'),), 2)
+        await asyncio.sleep(0)
+
+        self.assertEqual(bytes(client.writer.written), b'abcde')
+        client.writer.drain.assert_awaited_once()
+        self.assertEqual(client.outbound_size, 0)
+        task.cancel()
+        print()
+
+    async def test_slow_client_is_disconnected(self):
+        print('Testing slow client ...')
+        server = AsyncChatServer(max_outbound=10)
+        sender = self.make_client(server, 'alice')
+        slow = self.make_client(server, 'bob')
+
+        # no writer task runs, so nothing leaves the queue
+        server.broadcast((memoryview(b'12345678'),), sender, DEFAULT_ROOM)
+        self.assertIn(slow, server.rooms[DEFAULT_ROOM].members)
+
+        server.broadcast((memoryview(b'12345678'),), sender, DEFAULT_ROOM)
+        self.assertNotIn(slow, server.rooms[DEFAULT_ROOM].members)
+        slow.writer.close.assert_called_once()
+        print()
+
+    async def test_join_replays_history(self):
+        print('Testing join and history ...')
+        server = AsyncChatServer()
+        sender = self.make_client(server, 'alice', 'games')
+        server.handle_message(sender, b'hi')
+
+        late = self.make_client(server, 'bob')
+        server.handle_command(late, b'/join games\n')
+        buffers, size = late.outbound.get_nowait()
+
+        self.assertEqual(late.room, 'games')
+        self.assertEqual(b''.join(buffers), encode_frame(b'You are in room games\n') + encode_frame(b'alice: hi'))
+        self.assertEqual(size, len(b''.join(buffers)))
+        self.assertNotIn(DEFAULT_ROOM, server.rooms)
+        print()
+
+    async def test_message_too_long(self):
+        print('Testing message too long ...')
+        server = AsyncChatServer()
+        sender = self.make_client(server, 'alice')
+        receiver = self.make_client(server, 'bob')
+
+        # the largest message still fits a frame once the nickname is in front
+        message = b'x' * (MAX_FRAME - len(sender.prefix))
+        server.handle_message(sender, message + b'x')
+        self.assertTrue(receiver.outbound.empty())
+        self.assertEqual(b''.join(sender.outbound.get_nowait()[0]), encode_frame(b'Message too long\n'))
+
+        with patch('builtins.print'):
+            server.handle_message(sender, message)
+        buffers, size = receiver.outbound.get_nowait()
+        self.assertEqual(size, FRAME_HEADER.size + MAX_FRAME)
+        self.assertIn(receiver, server.rooms[DEFAULT_ROOM].members)
+        print()
+
+    async def test_oversized_frame_closes_connection(self):
+        print('Testing oversized frame ...')
+        server = AsyncChatServer()
+        reader = asyncio.StreamReader()
+        reader.feed_data(FRAME_HEADER.pack(MAX_FRAME + 1))
+        writer = make_writer()
+
+        await server.handle_connection(reader, writer)
+
+        writer.close.assert_called_once()
+        print()
+
+    async def test_cancelled_connection_is_closed(self):
+        print('Testing cancelled connection ...')
+        server = AsyncChatServer()
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame(b'alice'))
+        writer = make_writer()
+
+        # the client sent its nickname and waits, then the server task is cancelled
+        with patch('builtins.print'):
+            task = asyncio.create_task(server.handle_connection(reader, writer))
+            await asyncio.sleep(0)
+        task.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        writer.close.assert_called_once()
+        self.assertNotIn(DEFAULT_ROOM, server.rooms)
+        print()
+
+    async def test_shutdown_with_a_live_client(self):
+        print('Testing shutdown with a live client ...')
+        loop = asyncio.get_running_loop()
+        errors = []
+        loop.set_exception_handler(lambda loop, context: errors.append(context))
+        server = AsyncChatServer('127.0.0.1', 0)
+
+        with patch('builtins.print'):
+            serve_task = asyncio.create_task(server.serve_forever())
+            while server.server is None:
+                await asyncio.sleep(0)
+
+            # a client joins and stays connected
+            reader, writer = await asyncio.open_connection(*server.server.sockets[0].getsockname()[:2])
+            writer.write(encode_frame(b'alice'))
+            await server.read_frame(reader)
+
+            # Ctrl+C cancels the task that runs serve_forever
+            serve_task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await serve_task
+            await asyncio.sleep(0)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(server.tasks, set())
+        self.assertEqual(server.rooms, {})
+        self.assertEqual(await reader.read(), b'')
+        writer.close()
+        await writer.wait_closed()
+        print()
+
+
+if __name__ == "__main__":
+    # uncomment this to test the communication between server and client on your local computer
+    # start_server()
+
+    # uncomment this before submitting to domjudge
+    runner = unittest.TextTestRunner(stream=NullWriter())
+    unittest.main(testRunner=runner, exit=False)
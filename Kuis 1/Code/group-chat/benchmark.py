@@ -0,0 +1,314 @@
+import contextlib
+import functools
+import multiprocessing
+import os
+import resource
+import select
+import selectors
+import signal
+import socket
+import sys
+import time
+import tracemalloc
+
+import async_server
+import server
+
+HOST = '127.0.0.1'
+
+# select.select cannot watch file descriptors at or above this value
+FD_SETSIZE = 1024
+
+
+def raise_open_file_limit():
+    # idle connections need one file descriptor each, use the hard limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def open_idle_clients(port, count, ready, done):
+    # runs in a child process so the client ends do not use our file descriptors
+    raise_open_file_limit()
+    clients = [socket.create_connection((HOST, port)) for _ in range(count)]
+    ready.set()
+    done.wait()
+    for client in clients:
+        client.close()
+
+
+def time_wakeups(wait, active_reader, active_writer, rounds):
+    # time one wakeup on the only active socket while every other socket stays idle
+    start = time.perf_counter()
+    for _ in range(rounds):
+        active_writer.send(b'x')
+        wait()
+        active_reader.recv(1)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def benchmark_wakeup(counts=(100, 1000, 5000, 10000), rounds=2000):
+    """Measure the cost of one wakeup while ``count`` idle connections are watched."""
+    raise_open_file_limit()
+    results = []
+
+    for count in counts:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind((HOST, 0))
+        listener.listen(1024)
+        port = listener.getsockname()[1]
+
+        # the idle connections come from a child process
+        ready = multiprocessing.Event()
+        done = multiprocessing.Event()
+        child = multiprocessing.Process(target=open_idle_clients, args=(port, count, ready, done))
+        child.start()
+        idle = [listener.accept()[0] for _ in range(count)]
+        ready.wait()
+
+        active_reader, active_writer = socket.socketpair()
+        watched = idle + [active_reader]
+
+        # selectors version, registration happens once
+        selector = selectors.DefaultSelector()
+        for sock in watched:
+            selector.register(sock, selectors.EVENT_READ)
+        selector_us = time_wakeups(selector.select, active_reader, active_writer, rounds)
+        selector.close()
+
+        # select.select version, the whole list is passed on every call
+        # and it refuses file descriptors above FD_SETSIZE
+        if max(sock.fileno() for sock in watched) < FD_SETSIZE:
+            select_us = time_wakeups(lambda: select.select(watched, [], []), active_reader, active_writer, rounds)
+        else:
+            select_us = None
+
+        results.append((count, selector_us, select_us))
+
+        done.set()
+        child.join()
+        for sock in watched + [active_writer, listener]:
+            sock.close()
+
+    print(f"{'idle':>8} {selectors.DefaultSelector.__name__ + ' us':>20} {'select.select us':>18}")
+    for count, selector_us, select_us in results:
+        select_text = f"{select_us:.2f}" if select_us is not None else "n/a (FD_SETSIZE)"
+        print(f"{count:>8} {selector_us:>20.2f} {select_text:>18}")
+    return results
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def serve_quietly(run, *args):
+    # per message logging would dominate the measurement
+    sys.stdout = open(os.devnull, 'w')
+    run(*args)
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def connect_client(port, nickname):
+    client = socket.create_connection((HOST, port))
+    client.sendall(server.encode_frame(nickname.encode()))
+    return client
+
+
+def count_deliveries(port, first_id, count, expected, ready, results):
+    # runs in a child process and reports when every client got `expected` messages
+    clients = [connect_client(port, f'receiver{first_id + i}') for i in range(count)]
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        client.setblocking(False)
+        selector.register(client, selectors.EVENT_READ, [server.FrameReader(), 0])
+    ready.release()
+
+    remaining = count
+    while remaining:
+        for key, _ in selector.select():
+            reader, received = key.data
+            frames = reader.receive_frames(key.fileobj)
+            if frames is False:
+                raise ConnectionError('the server closed a receiving client')
+            key.data[1] = received + len(frames)
+            if received < expected <= key.data[1]:
+                remaining -= 1
+    results.put(time.perf_counter())
+
+    for client in clients:
+        client.close()
+
+
+def measure_fanout(run, receivers, messages, payload_size, client_processes):
+    # run(host, port) serves the chat until it gets SIGINT
+    port = free_port()
+    server_process = multiprocessing.Process(target=serve_quietly, args=(run, HOST, port))
+    server_process.start()
+    wait_for_port(port)
+
+    ready = multiprocessing.Semaphore(0)
+    results = multiprocessing.Queue()
+    per_process = receivers // client_processes
+
+    # every receiver also gets the notice that it joined the lobby
+    expected = messages + 1
+    counters = [
+        multiprocessing.Process(target=count_deliveries, args=(port, i * per_process, per_process, expected, ready, results))
+        for i in range(client_processes)
+    ]
+    for counter in counters:
+        counter.start()
+    for _ in counters:
+        ready.acquire()
+
+    # give every worker time to read the nicknames
+    sender = connect_client(port, 'sender')
+    time.sleep(0.5)
+
+    frame = server.encode_frame(b'x' * payload_size)
+    batch = frame * 100
+    start = time.perf_counter()
+    for _ in range(messages // 100):
+        sender.sendall(batch)
+    finished = max(results.get() for _ in counters)
+    elapsed = finished - start
+
+    for counter in counters:
+        counter.join()
+    sender.close()
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join()
+
+    return per_process * client_processes * messages / elapsed
+
+
+def benchmark_fanout(worker_counts=(1, 2, 4), receivers=64, messages=5000, payload_size=64, client_processes=4):
+    """Measure delivered messages per second for one sender and many receivers."""
+    print(f'{receivers} receivers, {messages} messages of {payload_size} bytes, {os.cpu_count()} cores')
+    print(f"{'workers':>8} {'deliveries/s':>14}")
+    results = []
+    for workers in worker_counts:
+        run = functools.partial(server.run_workers, workers)
+        rate = measure_fanout(run, receivers, messages, payload_size, client_processes)
+        results.append((workers, rate))
+        print(f'{workers:>8} {rate:>14.0f}')
+    return results
+
+
+def run_selector_server(host, port):
+    with contextlib.suppress(KeyboardInterrupt):
+        server.ChatServer(host, port).serve_forever()
+
+
+def benchmark_asyncio(receivers=64, messages=5000, payload_size=64, client_processes=4):
+    """Compare the selectors server with the asyncio server, one process each."""
+    print(f'{receivers} receivers, {messages} messages of {payload_size} bytes')
+    print(f"{'server':>10} {'deliveries/s':>14}")
+    results = []
+    for name, run in (('selectors', run_selector_server), ('asyncio', async_server.run_async_server)):
+        rate = measure_fanout(run, receivers, messages, payload_size, client_processes)
+        results.append((name, rate))
+        print(f'{name:>10} {rate:>14.0f}')
+    return results
+
+
+def stalled_recipients(chat, count):
+    # recipients whose socket buffers are already full, so every broadcast stays queued
+    peers = []
+    for i in range(count):
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        with contextlib.suppress(BlockingIOError):
+            while True:
+                ours.send(bytes(65536))
+
+        connection = server.Connection(ours, ('bench', i), high_watermark=1 << 40)
+        connection.user = f'user{i}'
+        connection.room = server.DEFAULT_ROOM
+        if connection.room not in chat.rooms:
+            chat.rooms[connection.room] = server.Room()
+        chat.rooms[connection.room].members.add(connection)
+        connection.callback = functools.partial(chat.handle_client, connection)
+        chat.clients[ours] = connection
+        chat.selector.register(ours, connection.events, connection.callback)
+        peers.append(theirs)
+    return peers
+
+
+def broadcast_concatenated(chat, sender, message):
+    # what the fan-out costs when every recipient gets its own joined frame
+    for connection in list(chat.clients.values()):
+        if connection is not sender:
+            frame = server.encode_frame(sender.prefix.tobytes() + message)
+            chat.send_to(connection, (frame,), len(frame))
+
+
+def traced_allocation(function):
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def benchmark_allocations(recipients=1000, payload_size=16 * 1024):
+    """Compare the memory one broadcast allocates: joined frames vs shared scatter-gather buffers."""
+    raise_open_file_limit()
+    chat = server.ChatServer()
+    peers = stalled_recipients(chat, recipients)
+
+    sender = server.Connection(None, ('bench', 'sender'))
+    sender.user = 'sender'
+    sender.prefix = memoryview(b'sender: ')
+    sender.room = server.DEFAULT_ROOM
+    message = bytes(payload_size)
+
+    def clear_queues():
+        for connection in chat.clients.values():
+            connection.outbound.clear()
+            connection.outbound_size = 0
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        concatenated = traced_allocation(lambda: broadcast_concatenated(chat, sender, message))
+        clear_queues()
+        gathered = traced_allocation(lambda: chat.handle_message(sender, message))
+        clear_queues()
+
+    print(f'{recipients} recipients, {payload_size} byte payload')
+    print(f"{'fan-out':>14} {'peak bytes':>14} {'per recipient':>14}")
+    for name, peak in (('concatenated', concatenated), ('scatter-gather', gathered)):
+        print(f'{name:>14} {peak:>14} {peak / recipients:>14.1f}')
+
+    chat.selector.close()
+    for sock in list(chat.clients) + peers:
+        sock.close()
+    return concatenated, gathered
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'wakeup': benchmark_wakeup,
+        'fanout': benchmark_fanout,
+        'allocations': benchmark_allocations,
+        'asyncio': benchmark_asyncio,
+    }
+    if len(sys.argv) == 2 and sys.argv[1] in benchmarks:
+        benchmarks[sys.argv[1]]()
+    else:
+        print(f'usage: python {sys.argv[0]} {"|".join(benchmarks)}')
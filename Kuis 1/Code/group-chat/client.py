@@ -2,11 +2,19 @@
 
 import socket
 import select
+import struct
 import sys
 import unittest
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
+# every message on the wire is a 4 byte big-endian length followed by the payload
+FRAME_HEADER = struct.Struct('!I')
+
+def encode_frame(payload):
+    # prefix the payload with its length
+    return FRAME_HEADER.pack(len(payload)) + payload
+
 class ChatClient:
     def __init__(self, nickname, host='127.0.0.1', port=65432):
         # define host and port
@@ -19,6 +27,12 @@ class ChatClient:
         # do not forget to encode nickname
         self.nickname = nickname.encode()
 
+        # received bytes that do not form a complete message yet
+        self.buffer = bytearray()
+
+        # frames the socket did not take yet, sent when it is writable again
+        self.outbound = bytearray()
+
     def connect(self):
         # connect to server
         self.client_socket.connect((self.host, self.port))
@@ -27,7 +41,7 @@ class ChatClient:
         self.client_socket.setblocking(False)
 
         # send nickname
-        self.client_socket.send(self.nickname)
+        self.send_frame(self.nickname)
 
     def main_loop(self):
         while True:
@@ -37,28 +51,60 @@ class ChatClient:
         # second element of the sockets_list is the client_socket
         sockets_list = [sys.stdin, self.client_socket]
 
+        # the client socket is only watched for writing while a frame is not sent completely
+        write_list = [self.client_socket] if self.outbound else []
+
         # use select to check which one is read ready: stdin or client socket
-        read_sockets, _, _ = select.select(sockets_list, [], [])
+        read_sockets, write_sockets, _ = select.select(sockets_list, write_list, [])
+
+        if write_sockets:
+            self.flush()
 
         # check for read-ready socket
         for read_ready_socket in read_sockets:
             # if the read-ready socket is the client socket
             if read_ready_socket == self.client_socket:
-                # receive message
-                message = read_ready_socket.recv(1024).decode('utf-8')
+                # receive data, it may hold several messages or only part of one
+                self.buffer += read_ready_socket.recv(4096)
 
-                # write message to stdout
-                sys.stdout.write(message)
+                # write every complete message to stdout
+                for message in self.take_messages():
+                    sys.stdout.write(message.decode('utf-8'))
             else:
                 # read message from readline
                 message = sys.stdin.readline()
 
                 # send message
-                self.client_socket.send(message.encode('utf-8'))
+                self.send_frame(message.encode('utf-8'))
 
                 # flush the stdout
                 sys.stdout.flush()
 
+    def send_frame(self, payload):
+        # the socket is non-blocking, so a send may take only part of the frame
+        self.outbound += encode_frame(payload)
+        self.flush()
+
+    def flush(self):
+        # send as much of the pending frames as the socket takes, keep the rest
+        try:
+            sent = self.client_socket.send(bytes(self.outbound))
+        except BlockingIOError:
+            return
+        del self.outbound[:sent]
+
+    def take_messages(self):
+        # cut complete length-prefixed messages off the front of the buffer
+        messages = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(bytes(self.buffer[FRAME_HEADER.size:end]))
+            del self.buffer[:end]
+        return messages
+
 
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
@@ -79,6 +125,7 @@ class TestChatClient(unittest.TestCase):
         # Setup a ChatClient instance for each test
         # Input and socket are mocked, so no real network activity or user input occurs
         self.mock_socket_instance = MagicMock()
+        self.mock_socket_instance.send.side_effect = len
         mock_socket.return_value = self.mock_socket_instance
 
         # Instantiating ChatClient with mocked input and socket
@@ -93,7 +140,7 @@ class TestChatClient(unittest.TestCase):
         self.mock_socket_instance.connect.assert_called_once_with((self.chat_client.host, self.chat_client.port))
         print(f"connect called with: {self.mock_socket_instance.connect.call_args}")
 
-        self.mock_socket_instance.send.assert_called_once_with(self.chat_client.nickname)
+        self.mock_socket_instance.send.assert_called_once_with(encode_frame(self.chat_client.nickname))
         print(f"send called with: {self.mock_socket_instance.send.call_args}")
         print()
     
@@ -113,7 +160,7 @@ class TestChatClient(unittest.TestCase):
         print('Testing receive message ...')
 
         # Prepare the mock objects for receiving a message
-        self.mock_socket_instance.recv.return_value = b"Hello, World!\n"
+        self.mock_socket_instance.recv.return_value = encode_frame(b"Hello, World!\n")
         print(f"recv return value: {self.mock_socket_instance.recv.return_value}")
 
         mock_select.return_value = ([self.chat_client.client_socket], [], [])
@@ -130,6 +177,24 @@ class TestChatClient(unittest.TestCase):
         print(f"write called with: {mock_stdout.write.call_args}")
         print()
 
+    @patch('select.select')
+    def test_loop_iteration_split_messages(self, mock_select):
+        print('Testing split messages ...')
+        stream = encode_frame(b"one\n") + encode_frame(b"two\n")
+        self.mock_socket_instance.recv.side_effect = [stream[:6], stream[6:]]
+        mock_select.return_value = ([self.chat_client.client_socket], [], [])
+
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            # the first read holds no complete message yet
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_not_called()
+
+            self.chat_client.loop_iteration()
+            self.assertEqual(mock_stdout.write.call_args_list, [unittest.mock.call('one\n'), unittest.mock.call('two\n')])
+
+        print(f"write called with: {mock_stdout.write.call_args_list}")
+        print()
+
     @patch('select.select')
     @patch('sys.stdin', new=MagicMock())
     def test_loop_iteration_send_message(self, mock_select):
@@ -145,9 +210,35 @@ class TestChatClient(unittest.TestCase):
         self.chat_client.loop_iteration()
 
         # Verify that the message was sent through the socket
-        self.mock_socket_instance.send.assert_called_with(b'Hi there!')
+        self.mock_socket_instance.send.assert_called_with(encode_frame(b'Hi there!'))
         print(f"send called with: {self.mock_socket_instance.send.call_args}")
 
+        print()
+
+    @patch('select.select')
+    @patch('sys.stdin', new=MagicMock())
+    def test_loop_iteration_partial_send(self, mock_select):
+        print('Testing partial send ...')
+        frame = encode_frame(b'Hi there!')
+
+        # the socket takes 3 bytes, then is full, then takes the rest
+        self.mock_socket_instance.send.side_effect = [3, BlockingIOError, len(frame) - 3]
+        sys.stdin.readline.return_value = "Hi there!"
+        mock_select.return_value = ([sys.stdin], [], [])
+        self.chat_client.loop_iteration()
+        self.assertEqual(bytes(self.chat_client.outbound), frame[3:])
+
+        # the unsent tail waits for the socket to be writable
+        mock_select.return_value = ([], [self.mock_socket_instance], [])
+        self.chat_client.loop_iteration()
+        self.assertEqual(mock_select.call_args[0][1], [self.mock_socket_instance])
+        self.assertEqual(bytes(self.chat_client.outbound), frame[3:])
+
+        self.chat_client.loop_iteration()
+        self.mock_socket_instance.send.assert_called_with(frame[3:])
+        self.assertEqual(self.chat_client.outbound, bytearray())
+        print(f"send calls: {self.mock_socket_instance.send.call_args_list}")
+
 
 if __name__ == "__main__":
     # uncomment this to test communication between client and server on your local computer
@@ -0,0 +1,315 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import selectors
+import signal
+import socket
+import sys
+import time
+import unittest
+from unittest.mock import patch
+
+import async_server
+import server
+
+# every generated message starts with the time it was sent, as fixed width
+# decimal nanoseconds so the message stays printable text
+TIMESTAMP_DIGITS = 20
+
+
+def percentile(values, fraction):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def sent_at(payload):
+    """Return the send timestamp in a broadcast "user: message" payload, or None for server notices."""
+    separator = payload.find(b': ')
+    digits = payload[separator + 2:separator + 2 + TIMESTAMP_DIGITS]
+    if separator < 0 or len(digits) < TIMESTAMP_DIGITS or not digits.isdigit():
+        return None
+    return int(digits)
+
+
+def rss_kb(pid):
+    # resident memory of a process and all of its children, from /proc
+    current = peak = 0
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                current = int(line.split()[1])
+            elif line.startswith('VmHWM:'):
+                peak = int(line.split()[1])
+
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as children:
+            for child in children.read().split():
+                child_current, child_peak = rss_kb(int(child))
+                current += child_current
+                peak += child_peak
+    return current, peak
+
+
+def serve_quietly(mode, host, port):
+    # per message logging would dominate the measurement
+    sys.stdout = open(os.devnull, 'w')
+    if mode == 'asyncio':
+        async_server.run_async_server(host, port)
+    else:
+        server.run_workers(int(mode), host, port)
+
+
+def spawn_server(mode, host, port):
+    process = multiprocessing.Process(target=serve_quietly, args=(mode, host, port))
+    process.start()
+
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            return process
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                process.terminate()
+                raise
+            time.sleep(0.05)
+
+
+class SimulatedClient:
+    def __init__(self, host, port, nickname):
+        self.sock = socket.create_connection((host, port))
+        self.sock.sendall(server.encode_frame(nickname.encode()))
+        self.sock.setblocking(False)
+        self.reader = server.FrameReader()
+        self.pending = bytearray()
+        self.joined = False
+
+    def send(self, frame):
+        # keep what the socket did not take for the next attempt
+        self.pending += frame
+        try:
+            sent = self.sock.send(self.pending)
+        except BlockingIOError:
+            return
+        del self.pending[:sent]
+
+
+class LoadGenerator:
+    def __init__(self, host, port, clients, senders, rate, duration, payload_size, room):
+        self.host = host
+        self.port = port
+        self.client_count = clients
+        self.sender_count = min(senders, clients)
+        self.rate = rate
+        self.duration = duration
+        self.payload_size = max(payload_size, TIMESTAMP_DIGITS)
+        self.room = room
+
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.latencies = []
+        self.sent = 0
+
+    def connect(self):
+        for i in range(self.client_count):
+            client = SimulatedClient(self.host, self.port, f'load{i}')
+            if self.room != server.DEFAULT_ROOM:
+                client.send(server.encode_frame(f'/join {self.room}'.encode()))
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+            self.clients.append(client)
+
+        # wait until every client has been placed in the room
+        deadline = time.monotonic() + 30
+        while not all(client.joined for client in self.clients):
+            if time.monotonic() > deadline:
+                raise TimeoutError('the server did not answer every client')
+            self.poll(0.1)
+
+    def poll(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            client = key.data
+            frames = client.reader.receive_frames(key.fileobj)
+            if frames is False:
+                raise ConnectionError('the server closed a simulated client')
+
+            received = time.monotonic_ns()
+            for payload in frames:
+                timestamp = sent_at(payload)
+                if timestamp is None:
+                    if payload.startswith(f'You are in room {self.room}\n'.encode()):
+                        client.joined = True
+                    continue
+                self.latencies.append(received - timestamp)
+
+    def run(self):
+        """Send for `duration` seconds at `rate` messages per second and collect deliveries."""
+        padding = b'x' * (self.payload_size - TIMESTAMP_DIGITS)
+        senders = self.clients[:self.sender_count]
+        interval = 1 / self.rate
+
+        start = time.monotonic()
+        next_send = start
+        end = start + self.duration
+        while time.monotonic() < end:
+            # send every message that is due, round-robin over the senders
+            now = time.monotonic()
+            while next_send <= now:
+                timestamp = str(time.monotonic_ns()).zfill(TIMESTAMP_DIGITS).encode()
+                frame = server.encode_frame(timestamp + padding)
+                senders[self.sent % len(senders)].send(frame)
+                self.sent += 1
+                next_send += interval
+
+            # retry senders whose socket was full last time
+            for sender in senders:
+                if sender.pending:
+                    sender.send(b'')
+            self.poll(max(0, min(next_send, end) - time.monotonic()))
+        send_time = time.monotonic() - start
+
+        # collect what is still in flight
+        expected = self.sent * (len(self.clients) - 1)
+        drain_end = time.monotonic() + 5
+        while len(self.latencies) < expected and time.monotonic() < drain_end:
+            self.poll(0.1)
+
+        return send_time
+
+    def close(self):
+        self.selector.close()
+        for client in self.clients:
+            client.sock.close()
+
+
+def run_load(args):
+    process = None
+    if args.spawn:
+        process = spawn_server(args.spawn, args.host, args.port)
+    server_pid = process.pid if process else args.server_pid
+
+    generator = LoadGenerator(args.host, args.port, args.clients, args.senders, args.rate,
+                              args.duration, args.payload, args.room)
+    try:
+        generator.connect()
+        send_time = generator.run()
+        rss = rss_kb(server_pid) if server_pid else (None, None)
+    finally:
+        generator.close()
+        if process:
+            os.kill(process.pid, signal.SIGINT)
+            process.join()
+
+    latencies = sorted(generator.latencies)
+    expected = generator.sent * (args.clients - 1)
+    results = {
+        'config': vars(args),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'messages_sent': generator.sent,
+        'deliveries': len(latencies),
+        'deliveries_expected': expected,
+        'messages_per_second': generator.sent / send_time,
+        'deliveries_per_second': len(latencies) / send_time,
+        'latency_us': {
+            name: (value / 1000 if value is not None else None)
+            for name, value in (
+                ('p50', percentile(latencies, 0.50)),
+                ('p99', percentile(latencies, 0.99)),
+                ('p999', percentile(latencies, 0.999)),
+                ('max', latencies[-1] if latencies else None),
+            )
+        },
+        'server_rss_kb': rss[0],
+        'server_peak_rss_kb': rss[1],
+    }
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Generate load against the group-chat server.')
+    parser.add_argument('--host', default=server.HOST)
+    parser.add_argument('--port', type=int, default=server.PORT)
+    parser.add_argument('--clients', type=int, default=100, help='simulated clients, all of them receive')
+    parser.add_argument('--senders', type=int, default=10, help='how many of the clients send')
+    parser.add_argument('--rate', type=float, default=1000, help='messages per second over all senders')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--payload', type=int, default=64, help='message size in bytes')
+    parser.add_argument('--room', default=server.DEFAULT_ROOM)
+    parser.add_argument('--server-pid', type=int, help='pid of a running server, for its memory use')
+    parser.add_argument('--spawn', help='start a server first: "asyncio" or a number of selector workers')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_load(args)
+
+    latency = results['latency_us']
+    print(f"sent {results['messages_sent']} messages, {results['deliveries']}/{results['deliveries_expected']} deliveries")
+    print(f"{results['messages_per_second']:.0f} messages/s, {results['deliveries_per_second']:.0f} deliveries/s")
+    print(f"fan-out latency us: p50 {latency['p50']}, p99 {latency['p99']}, p999 {latency['p999']}, max {latency['max']}")
+    print(f"server rss: {results['server_rss_kb']} kB, peak {results['server_peak_rss_kb']} kB")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+class TestLoadGen(unittest.TestCase):
+    def test_percentile(self):
+        print('Testing percentile ...')
+        values = list(range(1, 1001))
+        self.assertEqual(percentile(values, 0.50), 500)
+        self.assertEqual(percentile(values, 0.99), 990)
+        self.assertEqual(percentile(values, 0.999), 999)
+        self.assertIsNone(percentile([], 0.5))
+        print()
+
+    def test_sent_at(self):
+        print('Testing sent_at ...')
+        payload = b'load3: ' + b'123456789'.zfill(TIMESTAMP_DIGITS) + b'xxxx'
+        self.assertEqual(sent_at(payload), 123456789)
+        self.assertIsNone(sent_at(b'You are in room lobby\n'))
+        self.assertIsNone(sent_at(b'alice: hello'))
+        print()
+
+    def test_end_to_end(self):
+        print('Testing load against a local server ...')
+        chat = server.ChatServer(port=0)
+        chat.listen()
+        port = chat.server_socket.getsockname()[1]
+
+        # drive the server from the load generator's own polling
+        with patch('sys.stdout'):
+            generator = LoadGenerator(server.HOST, port, clients=3, senders=1, rate=200,
+                                      duration=0.1, payload_size=16, room='bench')
+            original_poll = generator.poll
+
+            def poll(timeout):
+                chat.run_once(0)
+                original_poll(0)
+                chat.run_once(0)
+
+            generator.poll = poll
+            try:
+                generator.connect()
+                generator.run()
+            finally:
+                generator.close()
+                chat.selector.close()
+                chat.server_socket.close()
+
+        self.assertGreater(generator.sent, 0)
+        self.assertEqual(len(generator.latencies), generator.sent * 2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,13 @@
+import collections
+import functools
+import itertools
+import os
+import select
+import signal
 import socket
+import selectors
+import struct
 import unittest
-import select
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
@@ -8,6 +15,41 @@ from unittest.mock import MagicMock, patch
 HOST = '127.0.0.1'
 PORT = 65432
 
+# once a client has more pending output than the high watermark, the slow
+# consumer policy kicks in, and it is lifted when the client drains below the low one
+HIGH_WATERMARK = 1024 * 1024
+LOW_WATERMARK = 256 * 1024
+
+# slow consumer policies: drop its messages, disconnect it, or stop reading
+# from the senders that fill it up
+POLICY_DROP = 'drop'
+POLICY_DISCONNECT = 'disconnect'
+POLICY_PAUSE = 'pause'
+
+# watermarks towards a sibling worker, it carries every client's messages,
+# so a full link pauses the senders instead of losing messages
+PEER_HIGH_WATERMARK = 64 * 1024 * 1024
+PEER_LOW_WATERMARK = 16 * 1024 * 1024
+
+# every message on the wire is a 4 byte big-endian length followed by the payload
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME = 1024 * 1024
+RECV_BUFFER = 64 * 1024
+
+# sendmsg takes at most this many buffers in one call
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+# every client starts in this room, "/join room" and "/leave" move it around
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_NAME = 255
+ROOM_HEADER = struct.Struct('!B')
+
+# a frame between workers wraps a whole client frame with the room name in front
+PEER_MAX_FRAME = ROOM_HEADER.size + MAX_ROOM_NAME + FRAME_HEADER.size + MAX_FRAME
+
+# bytes of recent messages kept per room for clients that join later
+HISTORY_SIZE = 64 * 1024
+
 def receive_message(client_socket):
     try:
         # receive message
@@ -30,81 +72,598 @@ def broadcast(message, sender_socket, clients):
         if sock != sender_socket:
             sock.send(message)
 
-def start_server():
-    # create socket
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def encode_frame(payload):
+    # prefix the payload with its length
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameReader:
+    def __init__(self, buffer_size=RECV_BUFFER, max_frame=MAX_FRAME):
+        # received bytes live in buffer[start:end], recv_into fills buffer[end:]
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+        self.max_frame = max_frame
+
+    def make_room(self, needed):
+        # make sure buffer[start:] can hold `needed` bytes before receiving more
+        if self.start + needed <= len(self.buffer):
+            return
+
+        # move the unfinished frame to the front
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        # grow only when a single frame is larger than the whole buffer
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(needed - len(self.buffer)))
+
+    def receive_frames(self, sock):
+        """Read what the socket has and return every complete frame, or False once it closed."""
+        try:
+            with memoryview(self.buffer)[self.end:] as free_space:
+                received = sock.recv_into(free_space)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return False
+
+        # if nothing was received, the peer closed the connection
+        if not received:
+            return False
+        self.end += received
+
+        frames = []
+        with memoryview(self.buffer) as view:
+            while self.end - self.start >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+                if length > self.max_frame:
+                    return False
+
+                frame_end = self.start + FRAME_HEADER.size + length
+                if frame_end > self.end:
+                    break
+
+                # copying out of the receive buffer is the only copy of the payload
+                frames.append(bytes(view[self.start + FRAME_HEADER.size:frame_end]))
+                self.start = frame_end
+
+        if self.start == self.end:
+            # everything was consumed, start filling from the front again
+            self.start = self.end = 0
+        else:
+            # room for the rest of the unfinished frame, or at least its header
+            needed = FRAME_HEADER.size
+            if self.end - self.start >= FRAME_HEADER.size:
+                needed += FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+            self.make_room(needed)
+
+        return frames
+
+
+class History:
+    def __init__(self, capacity=HISTORY_SIZE):
+        # encoded frames are copied into a ring allocated once, the oldest
+        # frames are overwritten, so the size never changes with the message rate
+        self.buffer = bytearray(capacity)
+        self.start = 0
+        self.size = 0
+
+        # length of every stored frame, oldest first
+        self.lengths = collections.deque()
+
+    def append(self, buffers, length):
+        capacity = len(self.buffer)
+        if length > capacity:
+            return
+
+        # make room by dropping the oldest frames
+        while self.size + length > capacity:
+            oldest = self.lengths.popleft()
+            self.start = (self.start + oldest) % capacity
+            self.size -= oldest
+
+        offset = (self.start + self.size) % capacity
+        for buffer in buffers:
+            offset = self.write_at(offset, buffer)
+        self.size += length
+        self.lengths.append(length)
+
+    def write_at(self, offset, data):
+        # copy data into the ring, wrapping around at the end
+        capacity = len(self.buffer)
+        head = min(len(data), capacity - offset)
+        self.buffer[offset:offset + head] = data[:head]
+        if head < len(data):
+            self.buffer[:len(data) - head] = data[head:]
+        return (offset + len(data)) % capacity
+
+    def snapshot(self):
+        """Return the stored frames, oldest first, as at most two buffers."""
+        # the ring keeps changing, so a replay gets its own copy
+        end = self.start + self.size
+        with memoryview(self.buffer) as view:
+            if end <= len(self.buffer):
+                parts = [bytes(view[self.start:end])]
+            else:
+                parts = [bytes(view[self.start:]), bytes(view[:end - len(self.buffer)])]
+        return tuple(memoryview(part) for part in parts if part)
+
+
+class Room:
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.members = set()
+        self.history = History(history_size)
+
+
+class Connection:
+    def __init__(self, sock, address, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK, policy=POLICY_DISCONNECT,
+                 max_frame=MAX_FRAME):
+        self.sock = sock
+        self.address = address
+
+        # nickname, None until the client sent it
+        # prefix is the encoded "user: " put in front of each of its messages
+        self.user = None
+        self.prefix = None
+
+        # name of the room the client is in
+        self.room = None
+
+        # incoming bytes are reassembled into frames here
+        self.reader = FrameReader(max_frame=max_frame)
+
+        # buffers waiting to be written, flushed when the socket is write-ready
+        # they are shared between recipients, so they are never modified
+        self.outbound = collections.deque()
+        self.outbound_size = 0
+
+        # what to do once outbound_size passes the high watermark
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.dropping = False
+
+        # senders held back until this connection drains below its low watermark,
+        # and the connections holding this one back, it is not read while there are any
+        self.paused_senders = set()
+        self.paused_by = set()
+
+        # events the selector is currently watching for this socket
+        self.events = selectors.EVENT_READ
+        self.callback = None
+        self.closed = False
+
+
+class ChatServer:
+    def __init__(self, host=HOST, port=PORT, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK,
+                 slow_policy=POLICY_DISCONNECT, reuse_port=False, history_size=HISTORY_SIZE):
+        # define host and port
+        self.host = host
+        self.port = port
+
+        # with SO_REUSEPORT several worker processes listen on the same port
+        self.reuse_port = reuse_port
+
+        # pending output watermarks and the policy for clients that do not keep up
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_policy = slow_policy
+
+        # how often each slow consumer policy fired
+        self.slow_consumer_counts = {POLICY_DROP: 0, POLICY_DISCONNECT: 0, POLICY_PAUSE: 0}
+
+        # selector picks the best mechanism for the platform (epoll on Linux),
+        # so the cost of a wakeup does not grow with the number of idle sockets
+        self.selector = selectors.DefaultSelector()
+        self.server_socket = None
+
+        # key: client socket, value: Connection
+        self.clients = {}
+
+        # key: room name, value: Room with its members and recent messages
+        # a message only visits the members of its room
+        self.rooms = {}
+        self.history_size = history_size
+
+        # links to sibling workers, every local broadcast is relayed over them
+        self.peers = []
 
-    # set socket option to reuse address
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def listen(self):
+        # create socket
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-    # bind address to server socket
-    server_socket.bind((HOST, PORT))
+        # set socket option to reuse address
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-    # listen
-    server_socket.listen()
+        # bind address to server socket
+        self.server_socket.bind((self.host, self.port))
 
-    # initiate socket list, first element is the server socket
-    sockets_list = [server_socket]
-    clients = {}
+        # listen
+        self.server_socket.listen()
+        self.server_socket.setblocking(False)
 
-    print(f'Listening for connections on {HOST}:{PORT}...')
+        # every registered socket carries the callback that handles its events
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.accept_connection)
 
-    while True:
-        # use select to serve many clients
-        read_sockets, _, _ = select.select(sockets_list, [], [])
+    def accept_connection(self, server_socket, mask):
+        # accept connection, the username is read once the client socket is read-ready
+        # a sibling worker may have taken it already, and running out of file
+        # descriptors must not take down the clients that are already connected
+        try:
+            client_socket, client_address = server_socket.accept()
+        except BlockingIOError:
+            return
+        except OSError as error:
+            print(f'Could not accept a connection: {error}')
+            return
+        client_socket.setblocking(False)
+
+        connection = Connection(client_socket, client_address, self.high_watermark, self.low_watermark, self.slow_policy)
+        connection.callback = functools.partial(self.handle_client, connection)
+        self.clients[client_socket] = connection
+        self.selector.register(client_socket, connection.events, connection.callback)
+
+    def add_peer(self, peer_socket):
+        # a peer is the local end of a socket pair to a sibling worker
+        peer_socket.setblocking(False)
+
+        peer = Connection(peer_socket, 'peer', PEER_HIGH_WATERMARK, PEER_LOW_WATERMARK, POLICY_PAUSE, PEER_MAX_FRAME)
+        peer.callback = functools.partial(self.handle_peer, peer)
+        self.peers.append(peer)
+        self.selector.register(peer_socket, peer.events, peer.callback)
+
+    def handle_peer(self, peer, peer_socket, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush(peer)
+
+        if mask & selectors.EVENT_READ and not peer.closed:
+            frames = peer.reader.receive_frames(peer_socket)
+            if frames is False:
+                print('Lost the link to a sibling worker')
+                self.close_connection(peer)
+                return
+
+            # every frame from a peer is the room name followed by a message
+            # ready for our own members of that room
+            for message in frames:
+                view = memoryview(message)
+                room_end = ROOM_HEADER.size + view[0]
+                room = str(view[ROOM_HEADER.size:room_end], 'utf-8')
+                self.broadcast((view[room_end:],), peer, room)
 
-        # check for each read-ready socket
-        for read_ready_socket in read_sockets:
-            # if the ready socket is the server socket, then accept connection
-            if read_ready_socket == server_socket:
-                # accept connection
-                client_socket, client_address = server_socket.accept()
+    def relay(self, buffers, room, sender):
+        # hand a local broadcast to every sibling worker, wrapped in one more frame
+        if not self.peers or room is None:
+            return
+        room_name = room.encode('utf-8')
+        size = ROOM_HEADER.size + len(room_name) + sum(len(buffer) for buffer in buffers)
+        header = FRAME_HEADER.pack(size) + ROOM_HEADER.pack(len(room_name)) + room_name
+        peer_buffers = (memoryview(header),) + buffers
+        for peer in list(self.peers):
+            self.send_to(peer, peer_buffers, FRAME_HEADER.size + size, sender)
 
-                # receive message from client socket
-                # use receive_message function
-                user = receive_message(client_socket)
-                if user is False:
-                    continue
+    def handle_client(self, connection, client_socket, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush(connection)
 
-                # append client socket to sockets_list
-                sockets_list.append(client_socket)
+        if mask & selectors.EVENT_READ and not connection.closed:
+            self.read_frames(connection)
 
-                # add client socket and user to the clients dictionary
-                # key: client_socket, value: user
-                clients[client_socket] = user.decode('utf-8')
-                print('Accepted new connection from {}:{}, nickname: {}'.format(*client_address, user.decode()))    # nickname == user
+    def read_frames(self, connection):
+        # one readiness event can carry several messages, or only part of one
+        frames = connection.reader.receive_frames(connection.sock)
+        if frames is False:
+            if connection.user is not None:
+                print('Closed connection from: {}'.format(connection.user))
+            self.close_connection(connection)
+            return
+
+        for payload in frames:
+            # a failed write to this client closed it, the rest of the batch is for nobody
+            if connection.closed:
+                break
+
+            # the first message from a client is its nickname
+            if connection.user is None:
+                connection.user = payload.decode('utf-8', 'replace')
+                connection.prefix = memoryview(f'{connection.user}: '.encode('utf-8'))
+                print('Accepted new connection from {}:{}, nickname: {}'.format(*connection.address, connection.user))
+                self.join_room(connection, DEFAULT_ROOM)
+            elif payload.startswith(b'/'):
+                self.handle_command(connection, payload)
             else:
-                # receive message from read-ready socket
-                message = receive_message(read_ready_socket)
+                self.handle_message(connection, payload)
+
+    def handle_command(self, connection, payload):
+        command, _, argument = payload.decode('utf-8', 'replace').strip().partition(' ')
+        argument = argument.strip()
+
+        if command == '/join' and argument and len(argument.encode('utf-8')) <= MAX_ROOM_NAME:
+            self.join_room(connection, argument)
+        elif command == '/leave':
+            self.join_room(connection, DEFAULT_ROOM)
+        else:
+            self.notify(connection, 'Unknown command. The commands are: /join room_name, /leave')
+
+    def join_room(self, connection, name):
+        # a client is in one room at a time, joining a room leaves the current one
+        self.leave_room(connection)
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(self.history_size)
+        room.members.add(connection)
+        connection.room = name
+
+        # the notice and the recent messages go out in one write
+        notice = memoryview(encode_frame(f'You are in room {name}\n'.encode('utf-8')))
+        buffers = (notice,) + room.history.snapshot()
+        self.send_to(connection, buffers, len(notice) + room.history.size)
+
+    def leave_room(self, connection):
+        if connection.room is None:
+            return
+        room = self.rooms[connection.room]
+        room.members.discard(connection)
+
+        # forget rooms nobody is in anymore, their history included
+        if not room.members:
+            del self.rooms[connection.room]
+        connection.room = None
+
+    def notify(self, connection, text):
+        # a message from the server itself, only for this client
+        notice = memoryview(encode_frame(f'{text}\n'.encode('utf-8')))
+        self.send_to(connection, (notice,), len(notice))
+
+    def handle_message(self, connection, message):
+        # with the nickname in front it still has to fit the frames clients accept
+        if len(connection.prefix) + len(message) > MAX_FRAME:
+            self.notify(connection, 'Message too long')
+            return
+        print(f'Received message from {connection.user}: {message.decode("utf-8", "replace")}')
+
+        # broadcast message with nickname prefixed
+        # the frame is built once as header, prefix and payload, and every
+        # recipient queues the same three buffers instead of its own copy
+        header = FRAME_HEADER.pack(len(connection.prefix) + len(message))
+        buffers = (memoryview(header), connection.prefix, memoryview(message))
+        self.broadcast(buffers, connection, connection.room)
+        self.relay(buffers, connection.room, connection)
+
+    def broadcast(self, buffers, sender, room):
+        # queue the message for every member of the room except the sender,
+        # nothing here waits for a slow reader
+        room = self.rooms.get(room)
+        if room is None:
+            return
+
+        size = sum(len(buffer) for buffer in buffers)
+        for connection in list(room.members):
+            if connection is not sender:
+                self.send_to(connection, buffers, size, sender)
+
+        # keep it for clients that join later
+        room.history.append(buffers, size)
+
+    def send_to(self, connection, buffers, size, sender=None):
+        # nothing pending means the client keeps up, a message as large as
+        # MAX_FRAME is then no reason to apply the policy
+        if connection.dropping or (connection.outbound and connection.outbound_size + size > connection.high_watermark):
+            if not self.handle_slow_consumer(connection, sender):
+                return
+
+        # behind pending output, the message waits for the socket to be write-ready
+        if connection.outbound:
+            connection.outbound.extend(buffers)
+            connection.outbound_size += size
+            return
+
+        # an idle connection can usually take the message right away
+        try:
+            sent = connection.sock.sendmsg(buffers)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close_connection(connection)
+            return
+        if sent == size:
+            return
+
+        # queue what the socket did not take
+        connection.outbound_size += size - sent
+        for buffer in buffers:
+            if sent >= len(buffer):
+                sent -= len(buffer)
+                continue
+            connection.outbound.append(buffer[sent:] if sent else buffer)
+            sent = 0
+        self.update_events(connection)
+
+    def handle_slow_consumer(self, connection, sender):
+        """Apply the connection's policy, return whether the message should still be queued."""
+        if connection.policy == POLICY_DROP:
+            # drop messages until the client drains below its low watermark
+            connection.dropping = True
+            self.slow_consumer_counts[POLICY_DROP] += 1
+            return False
+
+        if connection.policy == POLICY_PAUSE:
+            # queue the message, but stop reading from its sender for now
+            if sender is not None and connection not in sender.paused_by:
+                sender.paused_by.add(connection)
+                connection.paused_senders.add(sender)
+                self.slow_consumer_counts[POLICY_PAUSE] += 1
+                self.update_events(sender)
+            return True
+
+        print(f'Disconnecting slow client {connection.user}: outbound buffer is full')
+        self.slow_consumer_counts[POLICY_DISCONNECT] += 1
+        self.close_connection(connection)
+        return False
+
+    def release_slow_consumer(self, connection):
+        # the connection caught up, deliver to it and read from its senders again
+        connection.dropping = False
+        for sender in connection.paused_senders:
+            sender.paused_by.discard(connection)
+            self.update_events(sender)
+        connection.paused_senders.clear()
+
+    def flush(self, connection):
+        # write as much pending output as the socket accepts,
+        # sendmsg gathers the queued buffers so nothing is joined first
+        while connection.outbound:
+            buffers = list(itertools.islice(connection.outbound, IOV_MAX))
+            try:
+                sent = connection.sock.sendmsg(buffers)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.close_connection(connection)
+                return
+
+            connection.outbound_size -= sent
+            complete = sent == sum(len(buffer) for buffer in buffers)
+
+            # drop the buffers that were written completely
+            while connection.outbound and len(connection.outbound[0]) <= sent:
+                sent -= len(connection.outbound.popleft())
+
+            if sent:
+                # keep the unsent tail, a memoryview slice does not copy it
+                connection.outbound[0] = connection.outbound[0][sent:]
+
+            # the socket took less than offered, its send buffer is full
+            if not complete:
+                break
+
+        if connection.outbound_size <= connection.low_watermark and (connection.dropping or connection.paused_senders):
+            self.release_slow_consumer(connection)
+        self.update_events(connection)
+
+    def update_events(self, connection):
+        # read unless a slow recipient holds this connection back,
+        # and watch writability only while there is something to write
+        events = 0 if connection.paused_by else selectors.EVENT_READ
+        if connection.outbound:
+            events |= selectors.EVENT_WRITE
+
+        if events == connection.events or connection.closed:
+            return
+
+        # a selector cannot watch a socket for no events, it is unregistered instead
+        if not connection.events:
+            self.selector.register(connection.sock, events, connection.callback)
+        elif not events:
+            self.selector.unregister(connection.sock)
+        else:
+            self.selector.modify(connection.sock, events, connection.callback)
+        connection.events = events
+
+    def close_connection(self, connection):
+        # stop watching the socket and forget the user
+        if connection.closed:
+            return
+        connection.closed = True
+        if connection.events:
+            self.selector.unregister(connection.sock)
+
+        # whoever this connection held back can go on, and the other way round
+        self.release_slow_consumer(connection)
+        for recipient in connection.paused_by:
+            recipient.paused_senders.discard(connection)
+        connection.paused_by.clear()
+
+        self.leave_room(connection)
+        self.clients.pop(connection.sock, None)
+        if connection in self.peers:
+            self.peers.remove(connection)
+        connection.sock.close()
+
+    def run_once(self, timeout=None):
+        # wait for ready sockets and dispatch each one to its callback
+        for key, mask in self.selector.select(timeout):
+            callback = key.data
+            callback(key.fileobj, mask)
+
+    def serve_forever(self):
+        self.listen()
+        print(f'Listening for connections on {self.host}:{self.port}...')
+
+        try:
+            while True:
+                self.run_once()
+        finally:
+            print(f'Slow consumer policy counts: {self.slow_consumer_counts}')
+            self.selector.close()
+            self.server_socket.close()
+
+
+def run_worker(host, port, peer_sockets):
+    # a worker is an ordinary chat server sharing the port with its siblings
+    server = ChatServer(host, port, reuse_port=True)
+    for peer_socket in peer_sockets:
+        server.add_peer(peer_socket)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
 
-                # check if message is False
-                if message is False:
-                    print('Closed connection from: {}'.format(clients[read_ready_socket].decode('utf-8')))
+def run_workers(workers, host=HOST, port=PORT):
+    # one socket pair between every two workers carries relayed broadcasts
+    links = [[] for _ in range(workers)]
+    for first in range(workers):
+        for second in range(first + 1, workers):
+            first_end, second_end = socket.socketpair()
+            links[first].append(first_end)
+            links[second].append(second_end)
 
-                    # remove read ready socket from sockets_list
-                    sockets_list.remove(read_ready_socket)
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # the child only keeps its own ends of the links
+            for other, sockets in enumerate(links):
+                if other != index:
+                    for sock in sockets:
+                        sock.close()
+            run_worker(host, port, links[index])
+            os._exit(0)
+        pids.append(pid)
 
-                    # delete read ready socket from clients dictionary
-                    del clients[read_ready_socket]
-                    continue
+    # the master only supervises, the workers own the links
+    for sockets in links:
+        for sock in sockets:
+            sock.close()
+
+    print(f'Started {workers} workers on {host}:{port}')
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
 
-                # get user data from the clients dictionary based on the socket 
-                user = clients[read_ready_socket]
 
-                # fill in the question mark in the following order: user and message. 
-                # do not forget to decode the string
-                print(f'Received message from {user}: {message}')
-                
-                # Broadcast message with nickname prefixed
-                # full message in the following order: user and message
-                # do not forget to decode the string
-                # in the end of full_message, encode to bytes because we need to send it via socket
-                full_message = f"{user}: {message}".encode('utf-8')
+def start_server(workers=1):
+    if workers > 1:
+        run_workers(workers)
+        return
 
-                # first argument = full_message
-                # second argument = the socket ready
-                # third argument = clients dictionary
-                broadcast(full_message, read_ready_socket, clients)
+    server = ChatServer(HOST, PORT)
+    server.serve_forever()
 
 
 # A 'null' stream that discards anything written to it
@@ -118,6 +677,21 @@ def assert_true(parameter1, parameter2):
     else:
         print(f'test attribute failed: {parameter1} is not equal to {parameter2}')
 
+def feed_recv_into(mock_socket, *chunks):
+    # make recv_into copy each chunk into the given buffer, like a real socket
+    pending = list(chunks)
+
+    def recv_into(buffer):
+        chunk = pending.pop(0) if pending else b''
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    mock_socket.recv_into.side_effect = recv_into
+
+def sent_bytes(mock_socket):
+    # everything handed to sendmsg, joined in order
+    return b''.join(bytes(buffer) for call in mock_socket.sendmsg.call_args_list for buffer in call.args[0])
+
 def assert_false(parameter1):
     if parameter1 == False:
         print(f'{parameter1} is False')
@@ -199,30 +773,43 @@ class TestChatServer(unittest.TestCase):
         print()
     
     @patch('socket.socket')
-    @patch('select.select')
-    def test_accept_new_connection(self, mock_select, mock_socket):
+    @patch('selectors.DefaultSelector')
+    def test_accept_new_connection(self, mock_selector_class, mock_socket):
         print('Testing accept new connection ...')
         mock_server_socket = MagicMock()
         mock_client_socket = MagicMock()
         mock_socket.return_value = mock_server_socket
-        
-        # Use a function to dynamically handle calls to select.select
+        mock_selector = mock_selector_class.return_value
+
+        # keep the callback registered for each socket, like the real selector does
+        callbacks = {}
+
+        def register_side_effect(fileobj, events, data=None):
+            callbacks[fileobj] = data
+
+        mock_selector.register.side_effect = register_side_effect
+        mock_selector.modify.side_effect = register_side_effect
+
+        # Use a function to dynamically handle calls to selector.select
         def select_side_effect(*args, **kwargs):
-            if select_side_effect.call_count == 0:
-                select_side_effect.call_count += 1
-                return ([mock_server_socket], [], [])  # Simulate an incoming connection
+            select_side_effect.call_count += 1
+            if select_side_effect.call_count == 1:
+                ready_socket = mock_server_socket  # Simulate an incoming connection
+            elif select_side_effect.call_count == 2:
+                ready_socket = mock_client_socket  # Simulate the client sending its nickname
             else:
-                raise KeyboardInterrupt  # Simulate a signal to stop the server (or use another appropriate exception)
+                raise KeyboardInterrupt  # Simulate a signal to stop the server
+            key = selectors.SelectorKey(ready_socket, 0, selectors.EVENT_READ, callbacks[ready_socket])
+            return [(key, selectors.EVENT_READ)]
 
         select_side_effect.call_count = 0
-        mock_select.side_effect = select_side_effect
+        mock_selector.select.side_effect = select_side_effect
 
         mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
         mock_client_message = b"TestUser"
-        mock_client_socket.recv.return_value = mock_client_message
+        mock_client_socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+        feed_recv_into(mock_client_socket, encode_frame(mock_client_message))
 
-        # Assuming your server has a way to cleanly exit, simulate or invoke that here.
-        # This example uses KeyboardInterrupt, but adjust based on your server's design.
         try:
             start_server()
         except KeyboardInterrupt:
@@ -237,15 +824,441 @@ class TestChatServer(unittest.TestCase):
         mock_server_socket.accept.assert_called()
         print(f"accept called with: {mock_server_socket.accept.call_args}")
 
-        mock_client_socket.recv.assert_called_with(1024)
-        print(f"recv called with: {mock_client_socket.recv.call_args}")
+        mock_client_socket.recv_into.assert_called_once()
+        print(f"recv_into called with: {mock_client_socket.recv_into.call_args}")
+
+        print()
+
+    def test_accept_failure_keeps_serving(self):
+        print('Testing accept failure ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'alice')
+        server_socket = MagicMock()
+
+        # another worker took the connection, then the process ran out of file descriptors
+        server_socket.accept.side_effect = [BlockingIOError, OSError(24, 'Too many open files')]
+        key = selectors.SelectorKey(server_socket, 0, selectors.EVENT_READ, server.accept_connection)
+        server.selector.select.return_value = [(key, selectors.EVENT_READ)]
+        with patch('builtins.print'):
+            server.run_once()
+            server.run_once()
+
+        self.assertEqual(list(server.clients), [connection.sock])
+        server.selector.register.assert_not_called()
+        print()
+
+    def make_client(self, server, user, room=DEFAULT_ROOM):
+        client_socket = MagicMock()
+        client_socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+        connection = Connection(client_socket, ('127.0.0.1', 12345), server.high_watermark, server.low_watermark, server.slow_policy)
+        connection.user = user
+        if user is not None:
+            connection.prefix = memoryview(f'{user}: '.encode())
+        if user is not None and room is not None:
+            connection.room = room
+            if room not in server.rooms:
+                server.rooms[room] = Room()
+            server.rooms[room].members.add(connection)
+        server.clients[client_socket] = connection
+        return connection
+
+    def test_read_message_broadcasts_to_others(self):
+        print('Testing read message ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        receiver = self.make_client(server, 'bob')
+        feed_recv_into(sender.sock, encode_frame(b'hi'))
+
+        server.read_frames(sender)
+
+        sender.sock.sendmsg.assert_not_called()
+        self.assertEqual(sent_bytes(receiver.sock), encode_frame(b'alice: hi'))
+        print(f"sendmsg receiver called with: {receiver.sock.sendmsg.call_args}")
+        print()
+
+    def test_read_message_closes_on_disconnect(self):
+        print('Testing read message disconnect ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'alice')
+        feed_recv_into(connection.sock, b'')
+
+        server.read_frames(connection)
+
+        server.selector.unregister.assert_called_once_with(connection.sock)
+        connection.sock.close.assert_called_once()
+        self.assertNotIn(connection.sock, server.clients)
+        print()
+
+    def test_frame_reader_reassembles_frames(self):
+        print('Testing frame reader ...')
+        reader = FrameReader(buffer_size=16)
+        mock_socket = MagicMock()
+        long_message = b'x' * 40
+        stream = encode_frame(b'one') + encode_frame(b'two') + encode_frame(long_message)
+
+        # two frames and the start of a third arrive together, the rest is split
+        feed_recv_into(mock_socket, stream[:16], stream[16:30], stream[30:])
+
+        self.assertEqual(reader.receive_frames(mock_socket), [b'one', b'two'])
+        self.assertEqual(reader.receive_frames(mock_socket), [])
+        self.assertEqual(reader.receive_frames(mock_socket), [long_message])
+        self.assertEqual((reader.start, reader.end), (0, 0))
+        self.assertIs(reader.receive_frames(mock_socket), False)
+        print()
+
+    def test_frame_reader_rejects_oversized_frame(self):
+        print('Testing oversized frame ...')
+        reader = FrameReader(max_frame=8)
+        mock_socket = MagicMock()
+        feed_recv_into(mock_socket, FRAME_HEADER.pack(9))
+
+        self.assertIs(reader.receive_frames(mock_socket), False)
+        print()
+
+    def test_username_and_message_in_one_read(self):
+        print('Testing username and message in one read ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        receiver = self.make_client(server, 'bob')
+        sender = self.make_client(server, None)
+        feed_recv_into(sender.sock, encode_frame(b'alice') + encode_frame(b'hi'))
+
+        server.handle_client(sender, sender.sock, selectors.EVENT_READ)
+
+        self.assertEqual(sender.user, 'alice')
+        self.assertEqual(sent_bytes(receiver.sock), encode_frame(b'alice: hi'))
+        print()
+
+    def test_message_is_relayed_to_peers(self):
+        print('Testing relay to peers ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        peer_socket = MagicMock()
+        peer_socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+        server.add_peer(peer_socket)
+
+        server.handle_message(sender, b'hi')
+
+        expected = encode_frame(ROOM_HEADER.pack(5) + b'lobby' + encode_frame(b'alice: hi'))
+        self.assertEqual(sent_bytes(peer_socket), expected)
+        print(f"sendmsg peer called with: {peer_socket.sendmsg.call_args}")
+        print()
+
+    def test_peer_message_reaches_every_local_client(self):
+        print('Testing message from peer ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        first = self.make_client(server, 'alice', 'games')
+        second = self.make_client(server, 'bob', 'games')
+        elsewhere = self.make_client(server, 'dave')
+        peer_socket = MagicMock()
+        server.add_peer(peer_socket)
+        feed_recv_into(peer_socket, encode_frame(ROOM_HEADER.pack(5) + b'games' + encode_frame(b'carol: hi')))
+
+        server.handle_peer(server.peers[0], peer_socket, selectors.EVENT_READ)
+
+        self.assertEqual(sent_bytes(first.sock), encode_frame(b'carol: hi'))
+        self.assertEqual(sent_bytes(second.sock), encode_frame(b'carol: hi'))
+        elsewhere.sock.sendmsg.assert_not_called()
+        peer_socket.sendmsg.assert_not_called()
+        print()
+
+    def test_largest_message_is_relayed(self):
+        print('Testing largest message ...')
+        # two workers linked like run_workers links them
+        sender_side, receiver_side = ChatServer(), ChatServer()
+        sender_side.selector = MagicMock()
+        receiver_side.selector = MagicMock()
+        ours, theirs = socket.socketpair()
+        sender_side.add_peer(ours)
+        receiver_side.add_peer(theirs)
+        sender = self.make_client(sender_side, 'alice')
+        receiver = self.make_client(receiver_side, 'bob')
+
+        # the largest message that fits a client frame with the prefix, and one byte more,
+        # without printing a megabyte
+        message = b'x' * (MAX_FRAME - len(sender.prefix))
+        with patch('builtins.print'):
+            sender_side.handle_message(sender, message)
+            sender_side.handle_message(sender, message + b'x')
+            while sender_side.peers[0].outbound or select.select([theirs], [], [], 0)[0]:
+                sender_side.flush(sender_side.peers[0])
+                if select.select([theirs], [], [], 0)[0]:
+                    receiver_side.handle_peer(receiver_side.peers[0], theirs, selectors.EVENT_READ)
+
+        self.assertEqual(len(receiver_side.peers), 1)
+        self.assertEqual(sent_bytes(receiver.sock), encode_frame(b'alice: ' + message))
+        self.assertIn(encode_frame(b'Message too long\n'), sent_bytes(sender.sock))
+        ours.close()
+        theirs.close()
+        print()
+
+    def test_partial_send_waits_for_writable(self):
+        print('Testing partial send ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'bob')
+
+        # the socket only takes 3 bytes, then its send buffer is full
+        connection.sock.sendmsg.side_effect = [3, BlockingIOError]
+        server.send_to(connection, (memoryview(b'hel'), memoryview(b'lo world')), 11)
+
+        self.assertEqual([bytes(buffer) for buffer in connection.outbound], [b'lo world'])
+        self.assertEqual(connection.outbound_size, 8)
+        server.selector.modify.assert_called_with(
+            connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, connection.callback)
+
+        # once write-ready, the rest is written and writability is no longer watched
+        connection.sock.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+        server.handle_client(connection, connection.sock, selectors.EVENT_WRITE)
+
+        connection.sock.sendmsg.assert_called_with([memoryview(b'lo world')])
+        self.assertEqual(connection.outbound_size, 0)
+        server.selector.modify.assert_called_with(connection.sock, selectors.EVENT_READ, connection.callback)
         print()
 
+    def test_partial_send_inside_a_buffer(self):
+        print('Testing partial send inside a buffer ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'bob')
+        connection.sock.sendmsg.side_effect = [5, BlockingIOError]
+
+        server.send_to(connection, (memoryview(b'abc'), memoryview(b''), memoryview(b'defgh')), 8)
+
+        self.assertEqual([bytes(buffer) for buffer in connection.outbound], [b'fgh'])
+        self.assertEqual(connection.outbound_size, 3)
+        print()
+
+    def test_recipients_share_the_encoded_message(self):
+        print('Testing shared buffers ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        receivers = [self.make_client(server, f'user{i}') for i in range(3)]
+        for receiver in receivers:
+            receiver.sock.sendmsg.side_effect = BlockingIOError
+
+        server.handle_message(sender, b'hi')
+
+        # every queue holds the very same buffer objects, nothing was copied per recipient
+        queued = [list(receiver.outbound) for receiver in receivers]
+        for buffers in queued[1:]:
+            self.assertTrue(all(a is b for a, b in zip(buffers, queued[0])))
+        self.assertEqual(b''.join(queued[0]), encode_frame(b'alice: hi'))
+        print()
+
+    def test_slow_client_is_disconnected(self):
+        print('Testing slow client ...')
+        server = ChatServer(high_watermark=10)
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        slow = self.make_client(server, 'bob')
+        slow.sock.sendmsg.side_effect = BlockingIOError
+
+        server.broadcast((memoryview(b'12345678'),), sender, DEFAULT_ROOM)
+        self.assertIn(slow.sock, server.clients)
+
+        server.broadcast((memoryview(b'12345678'),), sender, DEFAULT_ROOM)
+        self.assertNotIn(slow.sock, server.clients)
+        self.assertNotIn(slow, server.rooms[DEFAULT_ROOM].members)
+        slow.sock.close.assert_called_once()
+        self.assertEqual(server.slow_consumer_counts[POLICY_DISCONNECT], 1)
+        print()
+
+    def test_drop_policy_skips_messages_until_low_watermark(self):
+        print('Testing drop policy ...')
+        server = ChatServer(high_watermark=10, low_watermark=4, slow_policy=POLICY_DROP)
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        slow = self.make_client(server, 'bob')
+        slow.sock.sendmsg.side_effect = BlockingIOError
+
+        for message in (b'12345678', b'123', b'1'):
+            server.broadcast((memoryview(message),), sender, DEFAULT_ROOM)
+
+        # the second message passed the high watermark, the third is dropped
+        # because the client has not drained yet
+        self.assertEqual(slow.outbound_size, 8)
+        self.assertEqual(server.slow_consumer_counts[POLICY_DROP], 2)
+        self.assertIn(slow.sock, server.clients)
+
+        # once drained, messages are delivered again
+        slow.sock.sendmsg.reset_mock()
+        slow.sock.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+        server.handle_client(slow, slow.sock, selectors.EVENT_WRITE)
+        server.broadcast((memoryview(b'1'),), sender, DEFAULT_ROOM)
+        self.assertFalse(slow.dropping)
+        self.assertEqual(sent_bytes(slow.sock), b'12345678' + b'1')
+        print()
+
+    def test_pause_policy_stops_reading_the_sender(self):
+        print('Testing pause policy ...')
+        server = ChatServer(high_watermark=10, low_watermark=4, slow_policy=POLICY_PAUSE)
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        slow = self.make_client(server, 'bob')
+        slow.sock.sendmsg.side_effect = BlockingIOError
+
+        server.broadcast((memoryview(b'12345678'),), sender, DEFAULT_ROOM)
+        server.broadcast((memoryview(b'123'),), sender, DEFAULT_ROOM)
+
+        # nothing is lost, but the sender is no longer read
+        self.assertEqual(slow.outbound_size, 11)
+        self.assertEqual(sender.paused_by, {slow})
+        self.assertEqual(server.slow_consumer_counts[POLICY_PAUSE], 1)
+        server.selector.unregister.assert_called_once_with(sender.sock)
+
+        # the slow client catches up and the sender is read again
+        slow.sock.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+        server.handle_client(slow, slow.sock, selectors.EVENT_WRITE)
+        self.assertEqual(sender.paused_by, set())
+        server.selector.register.assert_called_with(sender.sock, selectors.EVENT_READ, sender.callback)
+        print()
+
+    def test_closing_a_slow_client_resumes_its_senders(self):
+        print('Testing close resumes senders ...')
+        server = ChatServer(high_watermark=10, slow_policy=POLICY_PAUSE)
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        slow = self.make_client(server, 'bob')
+        slow.sock.sendmsg.side_effect = BlockingIOError
+        server.broadcast((memoryview(b'12345678'),), sender, DEFAULT_ROOM)
+        server.broadcast((memoryview(b'123'),), sender, DEFAULT_ROOM)
+        self.assertEqual(sender.paused_by, {slow})
+
+        server.close_connection(slow)
+
+        self.assertEqual(sender.paused_by, set())
+        self.assertEqual(sender.events, selectors.EVENT_READ)
+        print()
+
+    def test_messages_stay_in_their_room(self):
+        print('Testing rooms ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice', 'games')
+        member = self.make_client(server, 'bob', 'games')
+        outsider = self.make_client(server, 'carol')
+
+        server.handle_message(sender, b'hi')
+
+        self.assertEqual(sent_bytes(member.sock), encode_frame(b'alice: hi'))
+        outsider.sock.sendmsg.assert_not_called()
+        print()
+
+    def test_join_and_leave_commands(self):
+        print('Testing join and leave ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'alice')
+        feed_recv_into(connection.sock, encode_frame(b'/join games\n'), encode_frame(b'/leave\n'))
+
+        server.read_frames(connection)
+        self.assertEqual(connection.room, 'games')
+        self.assertEqual(list(server.rooms), ['games'])
+        self.assertEqual(server.rooms['games'].members, {connection})
+        self.assertEqual(sent_bytes(connection.sock), encode_frame(b'You are in room games\n'))
+
+        # leaving goes back to the lobby and forgets the empty room
+        server.read_frames(connection)
+        self.assertEqual(connection.room, DEFAULT_ROOM)
+        self.assertEqual(list(server.rooms), [DEFAULT_ROOM])
+        self.assertEqual(server.rooms[DEFAULT_ROOM].members, {connection})
+        print()
+
+    def test_closed_client_stops_reading_its_batch(self):
+        print('Testing closed client in the middle of a batch ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'alice')
+        other = self.make_client(server, 'bob', 'games')
+        peer_socket = MagicMock()
+        server.add_peer(peer_socket)
+
+        # the notice for the first join fails, the join and message after it must not revive the client
+        connection.sock.sendmsg.side_effect = OSError
+        feed_recv_into(connection.sock, encode_frame(b'/join games') + encode_frame(b'/join games') + encode_frame(b'hi'))
+        server.read_frames(connection)
+
+        self.assertTrue(connection.closed)
+        self.assertIsNone(connection.room)
+        self.assertEqual(server.rooms['games'].members, {other})
+        other.sock.sendmsg.assert_not_called()
+        peer_socket.sendmsg.assert_not_called()
+        print()
+
+    def test_relay_without_a_room(self):
+        print('Testing relay without a room ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice', room=None)
+        peer_socket = MagicMock()
+        server.add_peer(peer_socket)
+
+        server.relay((memoryview(b'hi'),), sender.room, sender)
+
+        peer_socket.sendmsg.assert_not_called()
+        print()
+
+    def test_history_ring_keeps_newest_frames(self):
+        print('Testing history ring ...')
+        history = History(capacity=16)
+        frames = [encode_frame(b'one'), encode_frame(b'two'), encode_frame(b'three')]
+        for frame in frames:
+            history.append((memoryview(frame[:2]), memoryview(frame[2:])), len(frame))
+
+        # the first frame was overwritten, the newest two wrap around the end
+        self.assertEqual(len(history.buffer), 16)
+        self.assertEqual(b''.join(history.snapshot()), frames[1] + frames[2])
+        self.assertEqual(len(history.snapshot()), 2)
+
+        # a frame bigger than the ring is not kept
+        history.append((memoryview(bytes(17)),), 17)
+        self.assertEqual(b''.join(history.snapshot()), frames[1] + frames[2])
+        print()
+
+    def test_join_replays_history_in_one_write(self):
+        print('Testing history replay ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        sender = self.make_client(server, 'alice')
+        server.handle_message(sender, b'first')
+        server.handle_message(sender, b'second')
+
+        late = self.make_client(server, 'bob', room=None)
+        server.join_room(late, DEFAULT_ROOM)
+
+        late.sock.sendmsg.assert_called_once()
+        expected = encode_frame(b'You are in room lobby\n') + encode_frame(b'alice: first') + encode_frame(b'alice: second')
+        self.assertEqual(sent_bytes(late.sock), expected)
+        print()
+
+    def test_unknown_command(self):
+        print('Testing unknown command ...')
+        server = ChatServer()
+        server.selector = MagicMock()
+        connection = self.make_client(server, 'alice')
+        listener = self.make_client(server, 'bob')
+
+        server.handle_command(connection, b'/join')
+
+        self.assertEqual(connection.room, DEFAULT_ROOM)
+        self.assertIn(b'Unknown command', sent_bytes(connection.sock))
+        listener.sock.sendmsg.assert_not_called()
+        print()
 
 if __name__ == "__main__":
     # uncomment this to test the communication between server and client on your local computer
     # start_server()
 
+    # or this to spread the clients over one worker process per core
+    # start_server(workers=os.cpu_count())
+
     # uncomment this before submitting to domjudge
     runner = unittest.TextTestRunner(stream=NullWriter())
     unittest.main(testRunner=runner, exit=False)
@@ -1,61 +1,162 @@
+import contextlib
+import os
+import signal
 import socket
+import traceback
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
+# how many bytes DelimitedReader asks the socket for at a time
+CHUNK_SIZE = 64 * 1024
+
+# a connection holds its thread, process or, without a pool, the whole server
+# until the client closes it, a client that sends nothing for this many seconds
+# is disconnected so the next one is served
+IDLE_TIMEOUT = 5.0
+
 def check_delimeter(str, delimeter):
     return delimeter in str
 
-# recv_until function
-def recv_until(client_socket, delimeter):
-    # Receive 16 bytes message from client
-    message = client_socket.recv(16).decode()
-    
-    # Use while loop to check for delimiter in message
-    while True:
-        if delimeter in message:
-           break 
-       
-        # If delimiter not found yet, receive 16 more bytes from client
-        more = client_socket.recv(16).decode()
 
-        if not more:
-            raise IOError('received {!r} then socket closed'.format(message))
+class DelimitedReader:
+    """Read delimiter-terminated messages from a socket, keeping bytes received after a delimiter."""
+
+    def __init__(self, sock, chunk_size=CHUNK_SIZE):
+        self.sock = sock
+        self.chunk_size = chunk_size
+
+        # received bytes that are not part of a returned message yet
+        self.buffer = bytearray()
+
+    def read_until(self, delimiter):
+        """Return the next message including its delimiter, or None if the socket closed between messages."""
+        # search only what has not been searched yet, starting len(delimiter) - 1 bytes
+        # early so a delimiter split across two reads is still found
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                end = index + len(delimiter)
+                message = bytes(self.buffer[:end])
 
-        # Append more to original message
-        message += more
-        # print(message)
-    return message
+                # the rest stays for the next message, deleting from the front is cheap for a bytearray
+                del self.buffer[:end]
+                return message
+
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            more = self.sock.recv(self.chunk_size)
+            if not more:
+                if self.buffer:
+                    raise IOError('received {!r} then socket closed'.format(bytes(self.buffer)))
+                return None
+            self.buffer += more
+
+
+# recv_until function
+# a one-off read, bytes after the delimiter are lost, use DelimitedReader to keep them
+def recv_until(client_socket, delimeter):
+    message = DelimitedReader(client_socket).read_until(delimeter.encode())
+    if message is None:
+        raise IOError("received '' then socket closed")
+    return message.decode()
 
 # Server function
 def handle_client_connection(client_socket, addr):
     """Handle a single client connection."""
     print(f"Got a connection from {addr}")
-    
-    # Receive message from client
-    data = recv_until(client_socket, '\r\n')
-    # print("[DEBUG] " + data)
-    
-    # Send message back to client
-    client_socket.send(data.encode())
+    reader = DelimitedReader(client_socket)
+
+    # Receive messages from client until it closes the connection,
+    # a client may send the next message before reading the reply
+    while True:
+        data = reader.read_until(b'\r\n')
+        if data is None:
+            break
+        # print("[DEBUG] " + data.decode())
+
+        # Send message back to client
+        client_socket.send(data)
     
     # Close the connection
     client_socket.close()
 
-def start_server():
+def handle_safely(handler, client_socket, addr):
+    # an error in one connection is logged and closes only that connection,
+    # the worker thread or process goes on with the next one
+    try:
+        handler(client_socket, addr)
+    except socket.timeout:
+        print(f"Connection from {addr} timed out")
+        client_socket.close()
+    except Exception:
+        traceback.print_exc()
+        client_socket.close()
+
+def serve_with_pool(server_socket, handler, workers, mode='thread', timeout=None):
+    """Hand accepted connections to a pool of threads, or of pre-forked processes."""
+    if mode == 'process':
+        # every process accepts from the shared listening socket and handles the
+        # connection itself, so CPU-bound handlers run on several cores
+        children = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    while True:
+                        try:
+                            client_socket, addr = server_socket.accept()
+                        except ConnectionError:
+                            # the client left before it was accepted
+                            continue
+                        client_socket.settimeout(timeout)
+                        handle_safely(handler, client_socket, addr)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+        try:
+            for pid in children:
+                os.waitpid(pid, 0)
+        finally:
+            # stop the workers that are still running
+            for pid in children:
+                with contextlib.suppress(ProcessLookupError, ChildProcessError):
+                    os.kill(pid, signal.SIGINT)
+                    os.waitpid(pid, 0)
+        return
+
+    # this thread only accepts, the pool threads handle the connections
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            client_socket, addr = server_socket.accept()
+            client_socket.settimeout(timeout)
+            pool.submit(handle_safely, handler, client_socket, addr)
+
+def start_server(workers=0, mode='thread', backlog=None):
     """Start the server and listen for incoming connections."""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     host = '127.0.0.1'  # Localhost
     port = 12345        # Port to listen on
     # binding to address
     server_socket.bind((host, port))
-    # listen to a single connection
-    server_socket.listen(1)
+    # listen, with a worker pool more connections may wait to be accepted
+    if backlog is None:
+        backlog = socket.SOMAXCONN if workers else 1
+    server_socket.listen(backlog)
     print(f"Listening on {host}:{port} ...")
     try:
-        while True:
-            client_socket, addr = server_socket.accept()
-            handle_client_connection(client_socket, addr)
+        if workers:
+            # hand every connection to a thread pool or to pre-forked processes
+            serve_with_pool(server_socket, handle_client_connection, workers, mode, IDLE_TIMEOUT)
+        else:
+            while True:
+                client_socket, addr = server_socket.accept()
+                client_socket.settimeout(IDLE_TIMEOUT)
+                handle_safely(handle_client_connection, client_socket, addr)
     except KeyboardInterrupt:
         print("Server shutting down.")
     finally:
@@ -84,8 +185,8 @@ class TestServer(unittest.TestCase):
         )
         chunks = [full_message[i:i+16].encode() for i in range(0, len(full_message), 16)]
 
-        # Return each chunk on successive calls to recv
-        mock_client_socket.recv.side_effect = chunks
+        # Return each chunk on successive calls to recv, then the client closes
+        mock_client_socket.recv.side_effect = chunks + [b""]
 
         handle_client_connection(mock_client_socket, mock_addr)
 
@@ -97,6 +198,37 @@ class TestServer(unittest.TestCase):
         mock_client_socket.close.assert_called_once()
         print(f"close called with: {mock_client_socket.close.call_args}")
 
+    def test_pipelined_messages(self):
+        """Test that bytes after a delimiter are kept for the next message."""
+        print('Test pipelined messages ...')
+        mock_client_socket = MagicMock()
+
+        # two messages in one read, the delimiter of the third split across reads
+        mock_client_socket.recv.side_effect = [b"one\r\ntwo\r\nthr", b"ee\r", b"\nfour", b""]
+
+        reader = DelimitedReader(mock_client_socket)
+        self.assertEqual(reader.read_until(b"\r\n"), b"one\r\n")
+        self.assertEqual(reader.read_until(b"\r\n"), b"two\r\n")
+        self.assertEqual(reader.read_until(b"\r\n"), b"three\r\n")
+        mock_client_socket.recv.assert_called_with(CHUNK_SIZE)
+
+        # the connection closes in the middle of a message
+        with self.assertRaises(IOError):
+            reader.read_until(b"\r\n")
+        print(f"recv called {mock_client_socket.recv.call_count} times")
+
+    def test_closed_between_messages(self):
+        """Test that a clean close between messages ends the connection."""
+        print('Test closed between messages ...')
+        mock_client_socket = MagicMock()
+        mock_client_socket.recv.side_effect = [b"one\r\ntwo\r\n", b""]
+
+        handle_client_connection(mock_client_socket, ('127.0.0.1', 12345))
+
+        self.assertEqual(mock_client_socket.send.call_args_list, [unittest.mock.call(b"one\r\n"), unittest.mock.call(b"two\r\n")])
+        mock_client_socket.close.assert_called_once()
+        print(f"send called with: {mock_client_socket.send.call_args_list}")
+
     @patch('socket.socket')
     def test_start_server(self, mock_socket):
         """Test starting of the server and listening for connections."""
@@ -108,7 +240,7 @@ class TestServer(unittest.TestCase):
         # Simulate recv for one full message
         test_message = "Test message for start_server\r\n"
         mock_client_socket.recv.side_effect = [
-            test_message[:16].encode(), test_message[16:].encode()
+            test_message[:16].encode(), test_message[16:].encode(), b""
         ]
     
         mock_socket.return_value = mock_server_socket
@@ -126,6 +258,86 @@ class TestServer(unittest.TestCase):
         print(f"bind called with: {mock_server_socket.bind.call_args}")
         print(f"listen called with: {mock_server_socket.listen.call_args}")
 
+    @patch('socket.socket')
+    def test_idle_client_in_inline_mode(self, mock_socket):
+        """Test that without a pool a client that sends nothing does not keep the next one waiting."""
+        print('Test an idle client without a pool ...')
+        mock_server_socket = MagicMock()
+        idle_client_socket = MagicMock()
+        idle_client_socket.recv.side_effect = socket.timeout
+        next_client_socket = MagicMock()
+        next_client_socket.recv.side_effect = [b"Test message\r\n", b""]
+
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [
+            (idle_client_socket, ('127.0.0.1', 1)), (next_client_socket, ('127.0.0.1', 2)), KeyboardInterrupt
+        ]
+
+        start_server()
+
+        idle_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+        idle_client_socket.close.assert_called_once()
+        next_client_socket.send.assert_called_once_with(b"Test message\r\n")
+        print(f"settimeout called with: {idle_client_socket.settimeout.call_args}")
+
+    @patch('socket.socket')
+    def test_start_server_with_thread_pool(self, mock_socket):
+        """Test that a thread pool handles the accepted connections."""
+        print('Test start_server with a thread pool ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_addr = ('127.0.0.1', 12345)
+        mock_client_socket.recv.side_effect = [b"Test message\r\n", b""]
+
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(mock_client_socket, mock_addr), KeyboardInterrupt]
+
+        start_server(workers=4, backlog=64)
+
+        # the pool finishes the connection before start_server returns
+        mock_client_socket.close.assert_called_once()
+        print(f"close called with: {mock_client_socket.close.call_args}")
+
+        mock_server_socket.listen.assert_called_once_with(64)
+        print(f"listen called with: {mock_server_socket.listen.call_args}")
+
+    @patch('socket.socket')
+    def test_idle_client_in_thread_pool(self, mock_socket):
+        """Test that an idle client gives its pool thread back to the next one."""
+        print('Test an idle client with a thread pool ...')
+        mock_server_socket = MagicMock()
+        idle_client_socket = MagicMock()
+        idle_client_socket.recv.side_effect = socket.timeout
+        next_client_socket = MagicMock()
+        next_client_socket.recv.side_effect = [b"Test message\r\n", b""]
+
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [
+            (idle_client_socket, ('127.0.0.1', 1)), (next_client_socket, ('127.0.0.1', 2)), KeyboardInterrupt
+        ]
+
+        # a single thread serves the second client after the first one timed out
+        start_server(workers=1)
+
+        idle_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+        next_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+        idle_client_socket.close.assert_called_once()
+        next_client_socket.send.assert_called_once_with(b"Test message\r\n")
+        print(f"settimeout called with: {idle_client_socket.settimeout.call_args}")
+
+    def test_failing_connection_keeps_the_worker(self):
+        """Test that an exception in one connection is logged and closes only that connection."""
+        print('Test a failing connection ...')
+        mock_client_socket = MagicMock()
+        handler = MagicMock(side_effect=ConnectionResetError)
+
+        with patch('traceback.print_exc') as mock_print_exc:
+            handle_safely(handler, mock_client_socket, ('127.0.0.1', 12345))
+
+        mock_print_exc.assert_called_once()
+        mock_client_socket.close.assert_called_once()
+        print(f"close called with: {mock_client_socket.close.call_args}")
+
 
 if __name__ == '__main__':
     # Use sys.stdout to make print output visible in console
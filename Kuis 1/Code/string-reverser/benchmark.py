@@ -0,0 +1,108 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+import server
+
+HOST = '127.0.0.1'
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def serve_quietly(port, workers, mode):
+    # runs in a child process until it gets SIGINT, per connection logging would dominate
+    sys.stdout = open(os.devnull, 'w')
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind((HOST, port))
+    server_socket.listen(socket.SOMAXCONN)
+    try:
+        if workers:
+            server.serve_with_pool(server_socket, server.handle_client_connection, workers, mode)
+        else:
+            while True:
+                client_socket, addr = server_socket.accept()
+                server.handle_client_connection(client_socket, addr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server_socket.close()
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_clients(port, message, duration, results):
+    # runs in a child process: one request per connection, as many as fit in `duration`
+    connections = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        with socket.create_connection((HOST, port)) as sock:
+            sock.sendall(message)
+            sock.recv(1024)
+        connections += 1
+    results.put(connections)
+
+
+def measure(workers, mode, client_processes, message, duration):
+    port = free_port()
+    server_process = multiprocessing.Process(target=serve_quietly, args=(port, workers, mode))
+    server_process.start()
+    wait_for_port(port)
+
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(target=run_clients, args=(port, message, duration, results))
+        for _ in range(client_processes)
+    ]
+    for client in clients:
+        client.start()
+    connections = sum(results.get() for _ in clients)
+    for client in clients:
+        client.join()
+
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join()
+    return connections / duration
+
+
+def benchmark_workers(worker_counts=(1, 4, 16), client_processes=4, message_size=1024, duration=3.0):
+    """Measure connections per second for the inline server and both pool modes."""
+    message = b'x' * message_size
+    print(f'{client_processes} client processes, {message_size} byte messages, {os.cpu_count()} cores')
+    print(f"{'mode':>8} {'workers':>8} {'connections/s':>14}")
+
+    results = [('inline', 0, measure(0, 'thread', client_processes, message, duration))]
+    print(f'{"inline":>8} {"-":>8} {results[0][2]:>14.0f}')
+    for mode in ('thread', 'process'):
+        for workers in worker_counts:
+            rate = measure(workers, mode, client_processes, message, duration)
+            results.append((mode, workers, rate))
+            print(f'{mode:>8} {workers:>8} {rate:>14.0f}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure connections per second of the string-reverser server.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--clients', type=int, default=4, help='client processes opening connections')
+    parser.add_argument('--size', type=int, default=1024, help='message size in bytes')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per measurement')
+    args = parser.parse_args()
+    benchmark_workers(args.workers, args.clients, args.size, args.duration)
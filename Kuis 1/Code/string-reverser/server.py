@@ -1,8 +1,18 @@
+import contextlib
+import os
+import signal
 import socket
+import traceback
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
+# a connection holds its thread, process or, without a pool, the whole server
+# until the client closes it, a client that sends nothing for this many seconds
+# is disconnected so the next one is served
+IDLE_TIMEOUT = 5.0
+
 # Server function
 def handle_client_connection(client_socket, addr):
     print(f"Got a connection from {addr}")
@@ -19,19 +29,81 @@ def handle_client_connection(client_socket, addr):
     # Close socket
     client_socket.close()
 
-def start_server():
+def handle_safely(handler, client_socket, addr):
+    # an error in one connection is logged and closes only that connection,
+    # the worker thread or process goes on with the next one
+    try:
+        handler(client_socket, addr)
+    except socket.timeout:
+        print(f"Connection from {addr} timed out")
+        client_socket.close()
+    except Exception:
+        traceback.print_exc()
+        client_socket.close()
+
+def serve_with_pool(server_socket, handler, workers, mode='thread', timeout=None):
+    """Hand accepted connections to a pool of threads, or of pre-forked processes."""
+    if mode == 'process':
+        # every process accepts from the shared listening socket and handles the
+        # connection itself, so CPU-bound handlers run on several cores
+        children = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    while True:
+                        try:
+                            client_socket, addr = server_socket.accept()
+                        except ConnectionError:
+                            # the client left before it was accepted
+                            continue
+                        client_socket.settimeout(timeout)
+                        handle_safely(handler, client_socket, addr)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+        try:
+            for pid in children:
+                os.waitpid(pid, 0)
+        finally:
+            # stop the workers that are still running
+            for pid in children:
+                with contextlib.suppress(ProcessLookupError, ChildProcessError):
+                    os.kill(pid, signal.SIGINT)
+                    os.waitpid(pid, 0)
+        return
+
+    # this thread only accepts, the pool threads handle the connections
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            client_socket, addr = server_socket.accept()
+            client_socket.settimeout(timeout)
+            pool.submit(handle_safely, handler, client_socket, addr)
+
+def start_server(workers=0, mode='thread', backlog=None):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     host = '127.0.0.1'
     port = 12345
 
     server_socket.bind((host, port))
-    server_socket.listen(1)
+    # listen, with a worker pool more connections may wait to be accepted
+    if backlog is None:
+        backlog = socket.SOMAXCONN if workers else 1
+    server_socket.listen(backlog)
 
     print(f"Listening on {host}:{port} ...")
     try:
-        while True:
-            client_socket, addr = server_socket.accept()
-            handle_client_connection(client_socket, addr)
+        if workers:
+            # hand every connection to a thread pool or to pre-forked processes
+            serve_with_pool(server_socket, handle_client_connection, workers, mode, IDLE_TIMEOUT)
+        else:
+            while True:
+                client_socket, addr = server_socket.accept()
+                client_socket.settimeout(IDLE_TIMEOUT)
+                handle_safely(handle_client_connection, client_socket, addr)
     except KeyboardInterrupt:
         print("Server shutting down.")
     finally:
@@ -84,6 +156,62 @@ class TestServer(unittest.TestCase):
         mock_server_socket.listen.assert_called_once_with(1)
         print(f"listen called with: {mock_server_socket.listen.call_args}")
 
+    @patch('socket.socket')
+    def test_idle_client_in_inline_mode(self, mock_socket):
+        """Test that without a pool a client that sends nothing does not keep the next one waiting."""
+        print('Test an idle client without a pool ...')
+        mock_server_socket = MagicMock()
+        idle_client_socket = MagicMock()
+        idle_client_socket.recv.side_effect = socket.timeout
+        next_client_socket = MagicMock()
+        next_client_socket.recv.return_value = b"Trigger"
+
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [
+            (idle_client_socket, ('127.0.0.1', 1)), (next_client_socket, ('127.0.0.1', 2)), KeyboardInterrupt
+        ]
+
+        start_server()
+
+        idle_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+        idle_client_socket.close.assert_called_once()
+        next_client_socket.send.assert_called_once_with(b"reggirT")
+        print(f"settimeout called with: {idle_client_socket.settimeout.call_args}")
+
+    @patch('socket.socket')
+    def test_start_server_with_thread_pool(self, mock_socket):
+        """Test that a thread pool handles the accepted connections."""
+        print('Test start_server with a thread pool ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_addr = ('127.0.0.1', 12345)
+        mock_client_socket.recv.return_value = b"Trigger"
+
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(mock_client_socket, mock_addr), KeyboardInterrupt]
+
+        start_server(workers=4, backlog=64)
+
+        # the pool finishes the connection before start_server returns
+        mock_client_socket.close.assert_called_once()
+        print(f"close called with: {mock_client_socket.close.call_args}")
+
+        mock_server_socket.listen.assert_called_once_with(64)
+        print(f"listen called with: {mock_server_socket.listen.call_args}")
+
+    def test_failing_connection_keeps_the_worker(self):
+        """Test that an exception in one connection is logged and closes only that connection."""
+        print('Test a failing connection ...')
+        mock_client_socket = MagicMock()
+        handler = MagicMock(side_effect=ConnectionResetError)
+
+        with patch('traceback.print_exc') as mock_print_exc:
+            handle_safely(handler, mock_client_socket, ('127.0.0.1', 12345))
+
+        mock_print_exc.assert_called_once()
+        mock_client_socket.close.assert_called_once()
+        print(f"close called with: {mock_client_socket.close.call_args}")
+
 if __name__ == '__main__':
     runner = unittest.TextTestRunner(stream=StringIO())
     unittest.main(testRunner=runner, exit=False)
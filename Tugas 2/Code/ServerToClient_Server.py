@@ -3,6 +3,9 @@ import unittest
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
+# the thread and process pools are shared by the servers in this directory
+from worker_pool import IDLE_TIMEOUT, handle_safely, serve_with_pool
+
 # Server functionality
 def handle_client_connection(client_socket, addr):
     """Handle a single client connection."""
@@ -15,7 +18,7 @@ def handle_client_connection(client_socket, addr):
     # close socket
     client_socket.close()
 
-def start_server():
+def start_server(workers=0, mode='thread', backlog=None):
     """Start the server and listen for incoming connections."""
     # create socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -27,17 +30,24 @@ def start_server():
     # bind to address
     server_socket.bind((host, port))
 
-    # listen
-    server_socket.listen(1)
+    # listen, with a worker pool more connections may wait to be accepted
+    if backlog is None:
+        backlog = socket.SOMAXCONN if workers else 1
+    server_socket.listen(backlog)
     print(f"Listening on {host}:{port} ...")
     
     try:
-        while True:
-            # accept connection
-            client_socket, addr = server_socket.accept()
+        if workers:
+            # hand every connection to a thread pool or to pre-forked processes
+            serve_with_pool(server_socket, handle_client_connection, workers, mode, IDLE_TIMEOUT)
+        else:
+            while True:
+                # accept connection
+                client_socket, addr = server_socket.accept()
+                client_socket.settimeout(IDLE_TIMEOUT)
 
-            # handle client connection 
-            handle_client_connection(client_socket, addr)
+                # handle client connection 
+                handle_safely(handle_client_connection, client_socket, addr)
     except KeyboardInterrupt:
         print("Server shutting down.")
     finally:
@@ -93,6 +103,9 @@ class TestServer(unittest.TestCase):
     
         print(f"accept called with: {mock_server_socket.accept.call_args}")
 
+        # a client that sends nothing is disconnected instead of holding the server
+        mock_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+
         # Assertions to verify the server setup
         mock_server_socket.bind.assert_called_once_with(('127.0.0.1', 12345))
         print(f"bind called with: {mock_server_socket.bind.call_args}")
@@ -100,6 +113,26 @@ class TestServer(unittest.TestCase):
         mock_server_socket.listen.assert_called_once_with(1)
         print(f"listen called with: {mock_server_socket.listen.call_args}")
 
+    @patch('socket.socket')
+    def test_start_server_with_thread_pool(self, mock_socket):
+        """Test that a thread pool handles the accepted connections."""
+        print('Test start_server with a thread pool ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_addr = ('127.0.0.1', 12345)
+
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(mock_client_socket, mock_addr), KeyboardInterrupt]
+
+        start_server(workers=4, backlog=64)
+
+        # the pool finishes the connection before start_server returns
+        mock_client_socket.close.assert_called_once()
+        print(f"close called with: {mock_client_socket.close.call_args}")
+
+        mock_server_socket.listen.assert_called_once_with(64)
+        print(f"listen called with: {mock_server_socket.listen.call_args}")
+
 
 if __name__ == '__main__':
     # Run unittest with a custom runner that suppresses output
@@ -0,0 +1,116 @@
+import contextlib
+import os
+import signal
+import socket
+import traceback
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest.mock import patch, MagicMock
+
+# a connection holds its thread, process or, without a pool, the whole server
+# until the client closes it, a client that sends nothing for this many seconds
+# is disconnected so the next one is served
+IDLE_TIMEOUT = 5.0
+
+def handle_safely(handler, client_socket, addr):
+    # an error in one connection is logged and closes only that connection,
+    # the worker thread or process goes on with the next one
+    try:
+        handler(client_socket, addr)
+    except socket.timeout:
+        print(f"Connection from {addr} timed out")
+        client_socket.close()
+    except Exception:
+        traceback.print_exc()
+        client_socket.close()
+
+def serve_with_pool(server_socket, handler, workers, mode='thread', timeout=None):
+    """Hand accepted connections to a pool of threads, or of pre-forked processes."""
+    if mode == 'process':
+        # every process accepts from the shared listening socket and handles the
+        # connection itself, so CPU-bound handlers run on several cores
+        children = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    while True:
+                        try:
+                            client_socket, addr = server_socket.accept()
+                        except ConnectionError:
+                            # the client left before it was accepted
+                            continue
+                        client_socket.settimeout(timeout)
+                        handle_safely(handler, client_socket, addr)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+        try:
+            for pid in children:
+                os.waitpid(pid, 0)
+        finally:
+            # stop the workers that are still running
+            for pid in children:
+                with contextlib.suppress(ProcessLookupError, ChildProcessError):
+                    os.kill(pid, signal.SIGINT)
+                    os.waitpid(pid, 0)
+        return
+
+    # this thread only accepts, the pool threads handle the connections
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            client_socket, addr = server_socket.accept()
+            client_socket.settimeout(timeout)
+            pool.submit(handle_safely, handler, client_socket, addr)
+
+class TestWorkerPool(unittest.TestCase):
+    def test_idle_client_in_thread_pool(self):
+        """Test that an idle client gives its pool thread back to the next one."""
+        print('Test an idle client with a thread pool ...')
+        mock_server_socket = MagicMock()
+        idle_client_socket = MagicMock()
+        next_client_socket = MagicMock()
+        mock_server_socket.accept.side_effect = [
+            (idle_client_socket, ('127.0.0.1', 1)), (next_client_socket, ('127.0.0.1', 2)), KeyboardInterrupt
+        ]
+
+        # the first client sends nothing until its timeout, a single thread then serves the second one
+        def handler(client_socket, addr):
+            if client_socket is idle_client_socket:
+                raise socket.timeout
+            client_socket.close()
+
+        with self.assertRaises(KeyboardInterrupt):
+            serve_with_pool(mock_server_socket, handler, 1, timeout=IDLE_TIMEOUT)
+
+        idle_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+        next_client_socket.settimeout.assert_called_once_with(IDLE_TIMEOUT)
+        idle_client_socket.close.assert_called_once()
+        next_client_socket.close.assert_called_once()
+        print(f"settimeout called with: {idle_client_socket.settimeout.call_args}")
+
+    def test_failing_connection_keeps_the_worker(self):
+        """Test that an exception in one connection is logged and closes only that connection."""
+        print('Test a failing connection ...')
+        mock_client_socket = MagicMock()
+        handler = MagicMock(side_effect=ConnectionResetError)
+
+        with patch('traceback.print_exc') as mock_print_exc:
+            handle_safely(handler, mock_client_socket, ('127.0.0.1', 12345))
+
+        mock_print_exc.assert_called_once()
+        mock_client_socket.close.assert_called_once()
+        print(f"close called with: {mock_client_socket.close.call_args}")
+
+class NullWriter(StringIO):
+    def write(self, txt):
+        pass
+
+if __name__ == '__main__':
+    # the servers in this directory import this module, running it runs its unit tests
+    runner = unittest.TextTestRunner(stream=NullWriter())
+    unittest.main(testRunner=runner, exit=False)
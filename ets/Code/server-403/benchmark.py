@@ -0,0 +1,186 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import timeit
+
+import solution
+
+HOST = '127.0.0.1'
+REQUEST = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+ROUTE_COUNT = 1000
+
+
+class RebuiltResponses(dict):
+    # how responses were made before they were cached: the page and its encoding on every request
+    def __getitem__(self, status):
+        return solution.build_response(status, solution.get_content(status))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def serve_quietly(port, cached, workers=0):
+    # runs in a child process until it gets SIGINT, the per request print would dominate
+    sys.stdout = open(os.devnull, 'w')
+    if not cached:
+        solution.RESPONSES = RebuiltResponses()
+    with contextlib.suppress(KeyboardInterrupt):
+        solution.serve(HOST, port, workers=workers)
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def read_response(sock, buffer):
+    # read one response whose length is given by Content-Length, keep what follows it
+    while b"\r\n\r\n" not in buffer:
+        buffer += sock.recv(65536)
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+    while len(rest) < length:
+        rest += sock.recv(65536)
+    buffer[:] = rest[length:]
+
+
+def run_client(port, duration, results):
+    # runs in a child process, one request at a time on one connection
+    requests = 0
+    buffer = bytearray()
+    with socket.create_connection((HOST, port)) as sock:
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            sock.sendall(REQUEST)
+            read_response(sock, buffer)
+            requests += 1
+    results.put(requests)
+
+
+def measure_rps(cached, clients, duration, workers=0):
+    port = free_port()
+    server_process = multiprocessing.Process(target=serve_quietly, args=(port, cached, workers))
+    server_process.start()
+    wait_for_port(port)
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_client, args=(port, duration, results)) for _ in range(clients)]
+    for process in processes:
+        process.start()
+    requests = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+
+    os.kill(server_process.pid, signal.SIGINT)
+    server_process.join()
+    return requests / duration
+
+
+def benchmark_responses(clients=4, duration=3.0, rounds=100000):
+    """Compare building each response per request with the prebuilt response cache."""
+    rebuilt = RebuiltResponses()
+    per_request = {
+        'rebuilt': timeit.timeit(lambda: rebuilt[200], number=rounds) / rounds * 1e6,
+        'cached': timeit.timeit(lambda: solution.RESPONSES[200], number=rounds) / rounds * 1e6,
+    }
+
+    print(f'{clients} clients with one connection each, {duration:.0f} s per run, {os.cpu_count()} cores')
+    print(f"{'responses':>10} {'us/response':>12} {'requests/s':>12}")
+    results = []
+    for name, cached in (('rebuilt', False), ('cached', True)):
+        rps = measure_rps(cached, clients, duration)
+        results.append((name, per_request[name], rps))
+        print(f'{name:>10} {per_request[name]:>12.3f} {rps:>12.0f}')
+    return results
+
+
+def benchmark_workers(worker_counts=(1, 2, 4), clients=8, duration=3.0):
+    """Measure requests per second of one process and of pre-forked workers on SO_REUSEPORT listeners."""
+    print(f'{clients} clients with one connection each, {duration:.0f} s per run, {os.cpu_count()} cores')
+    print(f"{'workers':>8} {'requests/s':>12}")
+    results = [(0, measure_rps(True, clients, duration))]
+    print(f"{'single':>8} {results[0][1]:>12.0f}")
+    for workers in worker_counts:
+        rps = measure_rps(True, clients, duration, workers)
+        results.append((workers, rps))
+        print(f'{workers:>8} {rps:>12.0f}')
+    return results
+
+
+def chained_dispatch(routes):
+    # what the if/elif chain costs with one branch per route: compare until one matches
+    def dispatch(path):
+        for route, status in routes:
+            if path == route:
+                return status
+        return 404
+    return dispatch
+
+
+def benchmark_router(route_count=ROUTE_COUNT, rounds=100000):
+    """Compare dispatch through an if/elif chain with the router, for the first, last and parameterised routes."""
+    router = solution.Router()
+    routes = []
+    for i in range(route_count // 2):
+        routes.append((f'/page{i}.html', 200))
+        router.add(f'/page{i}.html', lambda request, static_files: 200)
+        router.add(f'/api/v1/items{i}/{{id}}', lambda request, static_files, id: 200)
+    chained = chained_dispatch(routes)
+
+    def routed(path):
+        handler, params = router.resolve(path)
+        return handler(None, None, **params)
+
+    paths = {
+        'first': '/page0.html',
+        'last': f'/page{route_count // 2 - 1}.html',
+        'parameter': f'/api/v1/items{route_count // 2 - 1}/42',
+        'missing': '/missing.html',
+    }
+
+    print(f'{route_count} routes, half literal and half with a parameter')
+    print(f"{'path':>10} {'if/elif us':>12} {'router us':>12}")
+    results = []
+    for name, path in paths.items():
+        chain_us = None
+        if name != 'parameter':
+            chain_us = timeit.timeit(lambda: chained(path), number=rounds) / rounds * 1e6
+        if name == 'missing':
+            router_us = timeit.timeit(lambda: router.resolve(path), number=rounds) / rounds * 1e6
+        else:
+            router_us = timeit.timeit(lambda: routed(path), number=rounds) / rounds * 1e6
+        results.append((name, chain_us, router_us))
+        chain_text = f'{chain_us:.3f}' if chain_us is not None else 'n/a'
+        print(f'{name:>10} {chain_text:>12} {router_us:>12.3f}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure requests per second of the server-403 HTTP server.')
+    parser.add_argument('benchmark', nargs='?', choices=['responses', 'router', 'workers'], default='responses')
+    parser.add_argument('--clients', type=int, default=4, help='responses, workers: client processes, one connection each')
+    parser.add_argument('--duration', type=float, default=3.0, help='responses, workers: seconds per measurement')
+    parser.add_argument('--routes', type=int, default=ROUTE_COUNT, help='router: number of registered routes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='workers: worker counts to compare')
+    args = parser.parse_args()
+    if args.benchmark == 'router':
+        benchmark_router(args.routes)
+    elif args.benchmark == 'workers':
+        benchmark_workers(args.workers, args.clients, args.duration)
+    else:
+        benchmark_responses(args.clients, args.duration)
@@ -1,7 +1,22 @@
+import collections
+import email.utils
+import functools
+import gzip
+import json
+import mimetypes
+import os
 import socket
 import select
+import signal
+import stat
 import sys
+import tempfile
+import threading
+import time
+import traceback
 import unittest
+import zlib
+from urllib.parse import unquote
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
@@ -16,6 +31,9 @@ def get_content(status):
     elif status == 403:
         title = "403 Forbidden"
         body = "403 Forbidden"
+    else:
+        title = f"{status} {STATUS_REASONS[status]}"
+        body = title
 
     index_html = f'''
     <!DOCTYPE html>
@@ -33,51 +51,981 @@ def get_content(status):
     return index_html
 
 
-def create_server():
+STATUS_REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    413: "Content Too Large",
+    431: "Request Header Fields Too Large",
+    501: "Not Implemented",
+}
+
+# limits of one request, larger requests are answered with 431 or 413
+MAX_HEADER_SIZE = 8 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+# files below DOCUMENT_ROOT are served under STATIC_PREFIX
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+DOCUMENT_ROOT = os.path.join(BASE_DIR, "static")
+STATIC_PREFIX = "/static/"
+
+# how many static files are kept open, and how long their stat result is trusted
+FILE_CACHE_SIZE = 64
+STAT_TTL = 1.0
+
+# content codings the server can send, the preferred one first
+ENCODINGS = ("gzip", "deflate")
+
+# bodies smaller than MIN_COMPRESS_SIZE are sent as they are, compressing them
+# costs more CPU than the bytes it saves, bodies above MAX_COMPRESS_SIZE too,
+# they would have to be held in memory and compressing one blocks the event loop
+MIN_COMPRESS_SIZE = 1024
+MAX_COMPRESS_SIZE = 1024 * 1024
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+# level 6 gives nearly the size of level 9 in a fraction of the time, a
+# request that misses the cache waits for the compression
+COMPRESS_LEVEL = 6
+
+# how many compressed variants are kept and how many bytes they may take
+# together, each asset is compressed once
+VARIANT_CACHE_SIZE = 256
+VARIANT_CACHE_BYTES = 32 * 1024 * 1024
+
+# the access log is written by a background thread once this many entries
+# are waiting or this many seconds passed, whichever comes first, and entries
+# beyond ACCESS_LOG_MAX_BUFFERED are dropped while the output is stuck
+ACCESS_LOG_BATCH_SIZE = 256
+ACCESS_LOG_INTERVAL = 1.0
+ACCESS_LOG_MAX_BUFFERED = 65536
+
+# a connection without a request for this many seconds is closed
+IDLE_TIMEOUT = 5.0
+RECV_SIZE = 65536
+
+# a worker that dies sooner than this after it started is restarted only after
+# this delay, so a worker that crashes on start does not keep the master busy
+WORKER_RESTART_DELAY = 1.0
+
+
+def build_response(status, body, content_type="text/html; charset=utf-8", connection="keep-alive", encoding=None):
+    # a complete HTTP response as bytes: status line, headers and body
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    coding = f"Content-Encoding: {encoding}\r\nVary: Accept-Encoding\r\n" if encoding else ""
+    head = (
+        f"HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"{coding}"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {connection}\r\n"
+        "\r\n"
+    )
+    return head.encode("ascii") + body
+
+
+# the canned pages never change, so their whole responses are built once
+# and a request costs one lookup and one sendall, the last response on a
+# connection tells the client it is closed
+# 304 never has a body, it is built for each static file
+CANNED_STATUSES = [status for status in STATUS_REASONS if status != 304]
+CANNED_CONTENT = {status: get_content(status).encode("utf-8") for status in CANNED_STATUSES}
+RESPONSES = {status: build_response(status, get_content(status)) for status in CANNED_STATUSES}
+CLOSING_RESPONSES = {status: build_response(status, get_content(status), connection="close") for status in CANNED_STATUSES}
+
+
+def head_only(response):
+    # a HEAD response carries the same header fields, Content-Length included, without the body
+    return response[:response.index(b"\r\n\r\n") + 4]
+
+
+HEAD_RESPONSES = {status: head_only(response) for status, response in RESPONSES.items()}
+CLOSING_HEAD_RESPONSES = {status: head_only(response) for status, response in CLOSING_RESPONSES.items()}
+
+
+class ParseError(Exception):
+    def __init__(self, status):
+        super().__init__(f"{status} {STATUS_REASONS[status]}")
+        # the status to answer the malformed request with
+        self.status = status
+
+
+class HttpRequest:
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+
+        # header names are lower case
+        self.headers = headers
+        self.body = b""
+
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser, fed with the bytes as they are received."""
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_body_size=MAX_BODY_SIZE):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+
+        # received bytes that are not part of a returned request yet
+        self.buffer = bytearray()
+
+        # how much of the buffer is known to hold no end of header
+        self.scanned = 0
+
+        # a request whose header is parsed and whose body has not fully arrived
+        self.request = None
+        self.content_length = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        """Return the next complete HttpRequest, None if more bytes are needed, or raise ParseError."""
+        if self.request is None:
+            # search only bytes not searched before, from 3 bytes back in case
+            # the blank line was split across two reads
+            end = self.buffer.find(b"\r\n\r\n", self.scanned)
+            if end < 0 or end > self.max_header_size:
+                if len(self.buffer) > self.max_header_size:
+                    raise ParseError(431)
+                self.scanned = max(0, len(self.buffer) - 3)
+                return None
+
+            self.request = self.parse_header(self.buffer[:end].decode("latin-1"))
+            del self.buffer[:end + 4]
+            self.scanned = 0
+
+        if len(self.buffer) < self.content_length:
+            return None
+
+        request, self.request = self.request, None
+        request.body = bytes(self.buffer[:self.content_length])
+        del self.buffer[:self.content_length]
+        return request
+
+    def parse_header(self, header):
+        lines = header.split("\r\n")
+        request_line = lines[0].split()
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/1."):
+            raise ParseError(400)
+        method, path, version = request_line
+
+        headers = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(":")
+            if not colon or not name or name != name.strip():
+                raise ParseError(400)
+            headers[name.lower()] = value.strip()
+
+        if "transfer-encoding" in headers:
+            raise ParseError(501)
+        try:
+            self.content_length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise ParseError(400)
+        if self.content_length < 0:
+            raise ParseError(400)
+        if self.content_length > self.max_body_size:
+            raise ParseError(413)
+        return HttpRequest(method, path, version, headers)
+
+
+class StaticFile:
+    def __init__(self, fd, file_stat, content_type):
+        # an open file and the validators of the version that is open
+        self.fd = fd
+        self.size = file_stat.st_size
+        self.content_type = content_type
+        self.identity = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        self.mtime = int(file_stat.st_mtime)
+        self.etag = f'"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+        self.last_modified = email.utils.formatdate(file_stat.st_mtime, usegmt=True)
+
+        # when the file was last checked against the file system
+        self.checked = time.monotonic()
+
+        # the header fields that do not change between requests, the ETag
+        # depends on the content coding
+        self.fields = (
+            f"Content-Type: {content_type}\r\n"
+            f"Last-Modified: {self.last_modified}\r\n"
+        )
+
+        # responses that still have to send from fd, and whether the cache
+        # dropped the file, the fd is closed once both say it is unused,
+        # otherwise its number could be reused while a response points to it
+        self.users = 0
+        self.retired = False
+
+    def acquire(self):
+        self.users += 1
+
+    def release(self):
+        self.users -= 1
+        if self.retired and not self.users:
+            os.close(self.fd)
+
+    def retire(self):
+        self.retired = True
+        if not self.users:
+            os.close(self.fd)
+
+
+class StaticFiles:
+    """Files below a document root, the most recently used ones kept open with their stat result."""
+
+    def __init__(self, document_root=DOCUMENT_ROOT, cache_size=FILE_CACHE_SIZE, stat_ttl=STAT_TTL):
+        self.document_root = os.path.realpath(document_root)
+        self.cache_size = cache_size
+        self.stat_ttl = stat_ttl
+
+        # key: path below the document root, value: StaticFile, least recently used first
+        self.cache = collections.OrderedDict()
+
+    def lookup(self, relative_path):
+        """Return the StaticFile for a path below the document root, or None if there is no such file."""
+        static_file = self.cache.get(relative_path)
+        now = time.monotonic()
+        if static_file is not None and now - static_file.checked < self.stat_ttl:
+            # a hot file costs no system call at all
+            self.cache.move_to_end(relative_path)
+            return static_file
+
+        # no file name holds a NUL byte, and the os functions refuse it with ValueError
+        if "\0" in relative_path:
+            return None
+
+        # the path must stay inside the document root, symbolic links included
+        file_path = os.path.realpath(os.path.join(self.document_root, relative_path))
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            file_stat = None
+        if (file_stat is None or not stat.S_ISREG(file_stat.st_mode)
+                or os.path.commonpath([file_path, self.document_root]) != self.document_root):
+            self.evict(relative_path)
+            return None
+
+        identity = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        if static_file is not None and static_file.identity == identity:
+            static_file.checked = now
+            self.cache.move_to_end(relative_path)
+            return static_file
+
+        # new or changed on disk, open the current version
+        self.evict(relative_path)
+        content_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            # removed or made unreadable since the stat
+            return None
+        static_file = StaticFile(fd, file_stat, content_type)
+        self.cache[relative_path] = static_file
+        while len(self.cache) > self.cache_size:
+            _, oldest = self.cache.popitem(last=False)
+            oldest.retire()
+        return static_file
+
+    def evict(self, relative_path):
+        static_file = self.cache.pop(relative_path, None)
+        if static_file is not None:
+            static_file.retire()
+
+    def close(self):
+        for static_file in self.cache.values():
+            static_file.retire()
+        self.cache.clear()
+
+
+def parse_accept_encoding(header):
+    # key: content coding, value: its q-value, 1 when none is given
+    codings = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+@functools.lru_cache(maxsize=64)
+def choose_encoding(header):
+    """Return the coding of ENCODINGS the Accept-Encoding header prefers, or None for the body as it is."""
+    if not header:
+        return None
+    codings = parse_accept_encoding(header)
+
+    # the highest q-value wins, ties go to the order of ENCODINGS
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = codings.get(encoding, codings.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    # a client may rank the uncompressed body above every coding
+    if best is not None and codings.get("identity", 0.0) > best_quality:
+        return None
+    return best
+
+def compress(body, encoding):
+    # gzip without a timestamp gives the same bytes every time
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0)
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+def variant_etag(etag, encoding):
+    # every coding of a file is a different representation with its own tag
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+class CompressedVariants:
+    """Compressed bodies and responses, least recently used first, so each one is compressed once."""
+
+    def __init__(self, cache_size=VARIANT_CACHE_SIZE, min_size=MIN_COMPRESS_SIZE, max_size=MAX_COMPRESS_SIZE,
+                 cache_bytes=VARIANT_CACHE_BYTES):
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.min_size = min_size
+        self.max_size = max_size
+
+        # key: (ETag, coding) for static files, (status, coding, Connection) for
+        # canned responses, value: the compressed body or the whole response
+        self.cache = collections.OrderedDict()
+        # total length of the cached variants
+        self.size = 0
+
+    def worth_compressing(self, size, content_type):
+        return self.min_size <= size <= self.max_size and content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def get(self, key, build):
+        variant = self.cache.get(key)
+        if variant is not None:
+            self.cache.move_to_end(key)
+            return variant
+
+        variant = self.cache[key] = build()
+        self.size += len(variant)
+        # the newest variant stays even if it alone is over the byte limit
+        while len(self.cache) > 1 and (len(self.cache) > self.cache_size or self.size > self.cache_bytes):
+            _, evicted = self.cache.popitem(last=False)
+            self.size -= len(evicted)
+        return variant
+
+    def static_body(self, static_file, encoding):
+        """Return the compressed content of a static file, or None if the file no longer holds what was cached."""
+        def build():
+            content = os.pread(static_file.fd, static_file.size, 0)
+            if len(content) < static_file.size:
+                raise OSError(f"static file ends {static_file.size - len(content)} bytes early")
+            return compress(content, encoding)
+
+        # the file may have been truncated or replaced since it was opened,
+        # that is up to the response for this client, not to the server
+        try:
+            return self.get((static_file.etag, encoding), build)
+        except OSError:
+            return None
+
+    def canned_response(self, status, encoding, connection_header):
+        """Return the compressed canned response, or None if its page is too small to be worth it."""
+        content = CANNED_CONTENT[status]
+        if not self.worth_compressing(len(content), "text/html"):
+            return None
+        return self.get(
+            (status, encoding, connection_header),
+            lambda: build_response(status, compress(content, encoding), connection=connection_header, encoding=encoding),
+        )
+
+
+def not_modified(request, static_file, etag=None):
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or (etag or static_file.etag) in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return static_file.mtime <= since.timestamp()
+    return False
+
+def static_response(request, static_file, connection_header, encoding=None, variants=None):
+    """Return the parts of the response for a static file, the StaticFile itself stands for its content."""
+    fields = static_file.fields
+    if variants is not None and variants.worth_compressing(static_file.size, static_file.content_type):
+        # the response depends on Accept-Encoding even when it is not compressed
+        fields += "Vary: Accept-Encoding\r\n"
+    else:
+        encoding = None
+    etag = variant_etag(static_file.etag, encoding)
+
+    if not_modified(request, static_file, etag):
+        head = f"HTTP/1.1 304 Not Modified\r\n{fields}ETag: {etag}\r\nConnection: {connection_header}\r\n\r\n"
+        return [head.encode("latin-1")]
+
+    body = static_file
+    if encoding is not None:
+        body = variants.static_body(static_file, encoding)
+        if body is None:
+            # the file could not be read for compressing, it is sent as it is
+            body = static_file
+            encoding = None
+            etag = static_file.etag
+    fields += f"ETag: {etag}\r\n"
+    if encoding is not None:
+        fields += f"Content-Encoding: {encoding}\r\n"
+    head = (
+        f"HTTP/1.1 200 OK\r\n{fields}"
+        f"Content-Length: {len(body) if encoding else static_file.size}\r\n"
+        f"Connection: {connection_header}\r\n\r\n"
+    ).encode("latin-1")
+    if request.method == "HEAD":
+        return [head]
+    if body is static_file:
+        # released by send_pending or close_client once it is sent or dropped
+        static_file.acquire()
+    return [head, body]
+
+def response_size(parts):
+    # a StaticFile stands for the file content sent after the header
+    return sum(part.size if isinstance(part, StaticFile) else len(part) for part in parts)
+
+def queue_responses(connection, responses):
+    # consecutive bytes are joined so they go out in one send, a file is
+    # queued as [StaticFile, offset] and sent by the kernel from the page cache
+    pending = []
+    for part in responses:
+        if not isinstance(part, StaticFile):
+            pending.append(part)
+            continue
+        if pending:
+            connection.output.append(memoryview(b"".join(pending)))
+            pending = []
+        connection.output.append([part, 0])
+    if pending:
+        connection.output.append(memoryview(b"".join(pending)))
+
+def send_pending(sock, connection):
+    """Send queued output until it is all sent or the socket is full, return True when nothing is left."""
+    output = connection.output
+    while output:
+        part = output[0]
+        try:
+            if isinstance(part, memoryview):
+                # the header is held back while file content follows it
+                flags = getattr(socket, "MSG_MORE", 0) if len(output) > 1 else 0
+                sent = sock.send(part, flags)
+                connection.sent += sent
+                if sent < len(part):
+                    output[0] = part[sent:]
+                    return False
+            else:
+                static_file, offset = part
+                sent = os.sendfile(sock.fileno(), static_file.fd, offset, static_file.size - offset)
+                if not sent:
+                    # the file shrank, the promised Content-Length cannot be kept
+                    raise ConnectionError(f"{static_file.size - offset} bytes of a static file are missing")
+                connection.sent += sent
+                part[1] += sent
+                if part[1] < static_file.size:
+                    continue
+                static_file.release()
+        except BlockingIOError:
+            return False
+        output.popleft()
+    return True
+
+
+class HttpConnection:
+    def __init__(self, address):
+        self.address = address
+
+        # received bytes, split into requests as they complete
+        self.parser = RequestParser()
+
+        # when the last data arrived, for the idle timeout
+        self.last_active = time.monotonic()
+
+        # when the data that completed the latest requests arrived, in ns, for the access log
+        self.received = time.perf_counter_ns()
+
+        # (method, path, response parts, received, end) of the requests answered
+        # but not sent completely yet, end is where their response ends in the
+        # bytes queued on this connection, queued and sent count those bytes
+        self.completed = collections.deque()
+        self.queued = 0
+        self.sent = 0
+
+        # response bytes as memoryviews and files as [StaticFile, offset] that
+        # the socket did not take yet, sent again once it is writable
+        self.output = collections.deque()
+
+        # False once a response said the connection closes after it
+        self.keep_open = True
+
+    def answered(self, method, path, parts):
+        self.queued += response_size(parts)
+        self.completed.append((method, path, parts, self.received, self.queued))
+
+    def take_sent(self):
+        """Return (method, path, response parts, duration in us) for the requests whose responses are sent completely."""
+        sent = []
+        now = time.perf_counter_ns()
+        while self.completed and self.completed[0][4] <= self.sent:
+            method, path, parts, received, _ = self.completed.popleft()
+            sent.append((method, path, parts, (now - received) // 1000))
+        return sent
+
+
+class RouteNode:
+    def __init__(self):
+        # key: literal path segment, value: RouteNode
+        self.children = {}
+
+        # a "{name}" segment matching any one segment, as (name, RouteNode)
+        self.param = None
+
+        # a "*name" segment matching the rest of the path, as (name, handler)
+        self.wildcard = None
+
+        self.handler = None
+
+
+class Router:
+    """Map request paths to handlers: literal paths by one dict lookup, "{name}" and "*name" patterns by a trie of segments."""
+
+    def __init__(self):
+        # key: literal path, value: handler
+        self.exact = {}
+        self.root = RouteNode()
+
+    def route(self, pattern):
+        """Register the decorated function as the handler of pattern."""
+        def register(handler):
+            self.add(pattern, handler)
+            return handler
+        return register
+
+    def add(self, pattern, handler):
+        if "{" not in pattern and "*" not in pattern:
+            self.exact[pattern] = handler
+            return
+
+        node = self.root
+        segments = pattern.split("/")[1:]
+        for index, segment in enumerate(segments):
+            if segment.startswith("*"):
+                if index != len(segments) - 1:
+                    raise ValueError(f"{pattern}: *{segment[1:]} must be the last segment")
+                node.wildcard = (segment[1:], handler)
+                return
+            if segment.startswith("{") and segment.endswith("}"):
+                if node.param is None:
+                    node.param = (segment[1:-1], RouteNode())
+                elif node.param[0] != segment[1:-1]:
+                    raise ValueError(f"{pattern}: {segment} conflicts with {{{node.param[0]}}}")
+                node = node.param[1]
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        node.handler = handler
+
+    def resolve(self, path):
+        """Return (handler, params) for a path, or (None, None) if no route matches."""
+        handler = self.exact.get(path)
+        if handler is not None:
+            return handler, {}
+
+        # the cost depends on the depth of the path, not on the number of routes
+        params = {}
+        handler = self.match(self.root, path.split("/")[1:], 0, params)
+        if handler is None:
+            return None, None
+        return handler, params
+
+    def match(self, node, segments, index, params):
+        if index == len(segments):
+            if node.handler is not None:
+                return node.handler
+
+        else:
+            # a literal segment wins over a parameter, a parameter over the rest of the path
+            child = node.children.get(segments[index])
+            if child is not None:
+                handler = self.match(child, segments, index + 1, params)
+                if handler is not None:
+                    return handler
+
+            if node.param is not None and segments[index]:
+                name, child = node.param
+                handler = self.match(child, segments, index + 1, params)
+                if handler is not None:
+                    params[name] = segments[index]
+                    return handler
+
+        if node.wildcard is not None:
+            name, handler = node.wildcard
+            params[name] = "/".join(segments[index:])
+            return handler
+        return None
+
+
+# a handler gets the request, the static files of the server and the
+# parameters of its pattern, and returns a status or a StaticFile
+ROUTER = Router()
+
+
+def create_server(host="localhost", port=8080, reuse_port=False, backlog=5):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        # every worker listens on the port with its own socket and the kernel
+        # spreads new connections over them
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(("localhost", 8080))
-    server_socket.listen(5)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
     return server_socket
 
 def get_header(data):
+    # requests are logged by AccessLog, not printed here
     headers = data.split("\r\n")
-    print("request header:", headers)
     return headers[0].split()[1]
 
-def serve():
-    server_socket = create_server()
+@ROUTER.route("/")
+def index(request, static_files):
+    return 200
+
+@ROUTER.route("/hello.html")
+def forbidden(request, static_files):
+    return 403
+
+@ROUTER.route(STATIC_PREFIX + "*path")
+def static(request, static_files, path):
+    if static_files is None:
+        return 404
+    static_file = static_files.lookup(unquote(path))
+    if static_file is None:
+        return 404
+    return static_file
+
+def get_status(path, router=ROUTER):
+    # the status of a path without a document root, as the canned pages have it
+    handler, params = router.resolve(path.partition("?")[0])
+    if handler is None:
+        return 404
+    return handler(None, None, **params)
+
+def wants_close(request):
+    # HTTP/1.1 keeps the connection open unless the client asks to close it,
+    # HTTP/1.0 closes it unless the client asks to keep it
+    connection = request.headers.get("connection", "").lower()
+    if request.version == "HTTP/1.0":
+        return connection != "keep-alive"
+    return connection == "close"
+
+def handle_requests(connection, static_files=None, router=ROUTER, variants=None):
+    """Answer every complete request received so far in order, return the response parts and whether to keep the connection."""
+    responses = []
+    while True:
+        try:
+            request = connection.parser.next_request()
+        except ParseError as error:
+            # the rest of the stream cannot be trusted, answer and close
+            responses.append(CLOSING_RESPONSES[error.status])
+            connection.answered("-", "-", responses[-1:])
+            return responses, False
+
+        if request is None:
+            return responses, True
+        closing = wants_close(request)
+        connection_header = "close" if closing else "keep-alive"
+        encoding = None
+        if variants is not None:
+            encoding = choose_encoding(request.headers.get("accept-encoding"))
+
+        handler, params = router.resolve(request.path.partition("?")[0])
+        status = 404 if handler is None else handler(request, static_files, **params)
+        if isinstance(status, StaticFile):
+            parts = static_response(request, status, connection_header, encoding, variants)
+        else:
+            response = None
+            if encoding is not None:
+                response = variants.canned_response(status, encoding, connection_header)
+            if request.method == "HEAD":
+                if response is not None:
+                    response = head_only(response)
+                else:
+                    response = CLOSING_HEAD_RESPONSES[status] if closing else HEAD_RESPONSES[status]
+            elif response is None:
+                response = CLOSING_RESPONSES[status] if closing else RESPONSES[status]
+            parts = [response]
+
+        responses.extend(parts)
+        connection.answered(request.method, request.path, parts)
+        if closing:
+            # requests after this one are not answered
+            return responses, False
+
+class AccessLog:
+    """Collect one entry per answered request and write them as JSON lines from a background thread."""
+
+    def __init__(self, stream=None, batch_size=ACCESS_LOG_BATCH_SIZE, interval=ACCESS_LOG_INTERVAL,
+                 max_buffered=ACCESS_LOG_MAX_BUFFERED):
+        self.stream = stream if stream is not None else sys.stdout
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_buffered = max_buffered
+
+        # entries not written yet, as (time, address, method, path, response parts, duration in us)
+        self.buffer = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+        # set when a batch is full or the log is closed
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+        self.thread.start()
+
+    def record(self, address, sent):
+        """Queue the requests a connection sent the responses to, the event loop never formats or writes here."""
+        now = time.time()
+        with self.lock:
+            for method, path, parts, duration_us in sent:
+                if len(self.buffer) >= self.max_buffered:
+                    self.dropped += 1
+                else:
+                    self.buffer.append((now, address, method, path, parts, duration_us))
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            entries, self.buffer = self.buffer, []
+            dropped, self.dropped = self.dropped, 0
+        if not entries and not dropped:
+            return
+
+        # the time is formatted once per second, not once per entry
+        times = {}
+        lines = []
+        for timestamp, address, method, path, parts, duration_us in entries:
+            second = int(timestamp)
+            formatted_time = times.get(second)
+            if formatted_time is None:
+                formatted_time = times[second] = email.utils.formatdate(second, usegmt=True)
+            lines.append(format_log_entry(formatted_time, address, method, path, parts, duration_us))
+        if dropped:
+            lines.append(json.dumps({"dropped": dropped}))
+        self.stream.write("\n".join(lines) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        # write what is left and stop the thread
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+
+def format_log_entry(formatted_time, address, method, path, parts, duration_us):
+    # one JSON object per line, only the strings from the client need escaping,
+    # the status is in every status line at the same place
+    size = response_size(parts)
+    return (
+        f'{{"time": "{formatted_time}", "client": "{address[0]}:{address[1]}", '
+        f'"method": {json.dumps(method)}, "path": {json.dumps(path)}, '
+        f'"status": {int(parts[0][9:12])}, "bytes": {size}, "duration_us": {duration_us}}}'
+    )
+
+def log_sent(access_log, connection):
+    # a request is logged once the last byte of its response went to the kernel,
+    # so its duration includes waiting for the responses before it, responses
+    # that went out in the same send have the same duration
+    if connection.completed and connection.completed[0][4] <= connection.sent:
+        access_log.record(connection.address, connection.take_sent())
+
+def close_client(sock, socket_list, clients):
+    socket_list.remove(sock)
+    connection = clients.pop(sock)
+    sock.close()
+
+    # files of responses that will not be sent anymore
+    for part in connection.output:
+        if not isinstance(part, memoryview):
+            part[0].release()
+    connection.output.clear()
+
+def start_worker(host, port, idle_timeout, document_root, log_stream=None):
+    pid = os.fork()
+    if pid == 0:
+        # the worker never returns into the master's code, a crash shows as exit status 1
+        status = 1
+        try:
+            serve(host, port, idle_timeout, document_root, reuse_port=True, log_stream=log_stream)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    return pid
+
+def supervise_workers(host, port, workers, idle_timeout=IDLE_TIMEOUT, document_root=DOCUMENT_ROOT, log_stream=None):
+    """Fork workers that each run the event loop on their own SO_REUSEPORT listener and restart any that exit."""
+    # every worker writes its access log to the same stream, a batch goes out in one write
+    # the master holds the port without listening, so it gets no connections,
+    # and with port 0 this picks the port all workers use
+    reservation = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    reservation.bind((host, port))
+    port = reservation.getsockname()[1]
+
+    # key: pid, value: when the worker started
+    children = {}
+    try:
+        for _ in range(workers):
+            children[start_worker(host, port, idle_timeout, document_root, log_stream)] = time.monotonic()
+
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            children[start_worker(host, port, idle_timeout, document_root, log_stream)] = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # stop the workers that are still running
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        reservation.close()
+
+def serve(host="localhost", port=8080, idle_timeout=IDLE_TIMEOUT, document_root=DOCUMENT_ROOT, workers=0, reuse_port=False,
+          log_stream=None):
+    if workers:
+        # one event loop per worker process, on as many cores
+        supervise_workers(host, port, workers, idle_timeout, document_root, log_stream)
+        return
+
+    if reuse_port:
+        server_socket = create_server(host, port, reuse_port=True, backlog=socket.SOMAXCONN)
+    else:
+        server_socket = create_server(host, port)
     socket_list = [server_socket]
+    static_files = StaticFiles(document_root)
+    variants = CompressedVariants()
+    access_log = AccessLog(log_stream)
+
+    # key: client socket, value: its HttpConnection
     clients = {}
     
     try:
         while True:
-            sockets, _, _ = select.select(socket_list, [], [])
-            
-            for sock in sockets:
+            # wake up in time to close the connection that goes idle first
+            timeout = None
+            if clients:
+                oldest = min(connection.last_active for connection in clients.values())
+                timeout = max(0, oldest + idle_timeout - time.monotonic())
+            # a connection with unsent output is not read from until it is sent,
+            # so a slow reader cannot make the server queue without limit
+            readers = [sock for sock in socket_list if sock is server_socket or not clients[sock].output]
+            writers = [sock for sock, connection in clients.items() if connection.output]
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+
+            for sock in writable:
+                connection = clients[sock]
+                try:
+                    done = send_pending(sock, connection)
+                except OSError:
+                    # the client went away in the middle of a response
+                    close_client(sock, socket_list, clients)
+                    continue
+                connection.last_active = time.monotonic()
+                log_sent(access_log, connection)
+                if done and not connection.keep_open:
+                    close_client(sock, socket_list, clients)
+
+            for sock in readable:
                 if sock == server_socket:
                     client_socket, client_address = server_socket.accept()
+                    client_socket.setblocking(False)
                     socket_list.append(client_socket)
                     
-                    clients[f"{client_socket}"] = f"{client_address}"
-                else:
-                    data = client_socket.recv(1024).decode('utf-8')
-                    if data:
-                        path = get_header(data)
-                        
-                        if data == "/":
-                            response = get_content(200)
-                        elif data == "/hello.html":
-                            response = get_content(403)
-                        else:
-                            response = get_content(404)
-                            
-                        client_socket.send(response.encode("utf-8"))
-                    else:
-                        socket_list.remove(sock)
-                        client_socket.close()
+                    clients[client_socket] = HttpConnection(client_address)
+                elif sock in clients:
+                    connection = clients[sock]
+                    try:
+                        data = sock.recv(RECV_SIZE)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        data = b""
+
+                    if not data:
+                        close_client(sock, socket_list, clients)
+                        continue
+
+                    connection.received = time.perf_counter_ns()
+                    connection.parser.feed(data)
+                    connection.last_active = time.monotonic()
+
+                    # all answers to pipelined requests are queued together and
+                    # as much of them as the socket takes is sent right away
+                    responses, connection.keep_open = handle_requests(connection, static_files, variants=variants)
+                    queue_responses(connection, responses)
+                    try:
+                        done = send_pending(sock, connection)
+                    except OSError:
+                        close_client(sock, socket_list, clients)
+                        continue
+
+                    log_sent(access_log, connection)
+
+                    if done and not connection.keep_open:
+                        close_client(sock, socket_list, clients)
+
+            # close connections that stayed idle too long
+            now = time.monotonic()
+            for sock, connection in list(clients.items()):
+                if now - connection.last_active >= idle_timeout:
+                    close_client(sock, socket_list, clients)
                     
     except KeyboardInterrupt:
+        access_log.close()
+        static_files.close()
         server_socket.close()
         
 
@@ -112,6 +1060,593 @@ class TestHttpServer(unittest.TestCase):
         assert_in('404 Not found', get_content(404))
         assert_in('403 Forbidden', get_content(403))
 
+    def test_responses(self):
+        print('Testing prebuilt responses ...')
+        for status, reason in ((200, b'OK'), (403, b'Forbidden'), (404, b'Not Found')):
+            head, _, body = RESPONSES[status].partition(b'\r\n\r\n')
+            assert_true(head.startswith(b'HTTP/1.1 %d %s' % (status, reason)), 'status line')
+            self.assertIn(b'Content-Length: %d' % len(body), head)
+            self.assertEqual(body, get_content(status).encode('utf-8'))
+        print()
+
+    def test_pipelined_requests(self):
+        print('Testing pipelined requests ...')
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.parser.feed(
+            b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /hello.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /missing HTTP/1.1\r\nHost: loc"
+        )
+
+        response, keep_open = handle_requests(connection)
+
+        # both complete requests are answered in order, the partial one waits
+        self.assertEqual(response, [RESPONSES[200], RESPONSES[403]])
+        self.assertTrue(keep_open)
+        self.assertEqual(bytes(connection.parser.buffer), b"GET /missing HTTP/1.1\r\nHost: loc")
+
+    def test_connection_close(self):
+        print('Testing Connection: close ...')
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.parser.feed(
+            b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n"
+            b"GET / HTTP/1.1\r\n\r\n"
+        )
+
+        response, keep_open = handle_requests(connection)
+
+        self.assertEqual(response, [CLOSING_RESPONSES[200]])
+        self.assertFalse(keep_open)
+
+        # HTTP/1.0 closes unless asked to keep the connection
+        assert_true(wants_close(HttpRequest("GET", "/", "HTTP/1.0", {})), 'HTTP/1.0')
+        self.assertFalse(wants_close(HttpRequest("GET", "/", "HTTP/1.0", {"connection": "Keep-Alive"})))
+
+    def test_head_request(self):
+        print('Testing HEAD on canned responses ...')
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.parser.feed(
+            b"HEAD / HTTP/1.1\r\n\r\n"
+            b"HEAD /missing HTTP/1.1\r\nConnection: close\r\n\r\n"
+        )
+
+        response, keep_open = handle_requests(connection)
+
+        # the same header fields as GET, Content-Length included, and no body
+        self.assertEqual(response, [RESPONSES[200].partition(b'\r\n\r\n')[0] + b'\r\n\r\n', CLOSING_HEAD_RESPONSES[404]])
+        assert_in(b'Content-Length: %d' % len(CANNED_CONTENT[404]), response[1])
+        assert_true(response[1].endswith(b'\r\n\r\n'), 'no body after the header')
+        self.assertFalse(keep_open)
+
+        # a compressed canned response loses its body the same way
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.parser.feed(b"HEAD / HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n")
+        variants = CompressedVariants(min_size=0)
+        response, _ = handle_requests(connection, variants=variants)
+        head = variants.canned_response(200, 'gzip', 'keep-alive').partition(b'\r\n\r\n')[0]
+        self.assertEqual(response, [head + b'\r\n\r\n'])
+        print()
+
+    def test_parser_split_request(self):
+        print('Testing request parser ...')
+        parser = RequestParser()
+        post = b"POST /form HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\n\r\nhello"
+        get = b"GET / HTTP/1.1\r\n\r\n"
+
+        # one byte at a time, the request completes only with its last body byte
+        for byte in post[:-1]:
+            parser.feed(bytes([byte]))
+            self.assertIsNone(parser.next_request())
+        parser.feed(post[-1:] + get)
+        result = parser.next_request()
+
+        assert_equal(result.method, "POST")
+        assert_equal(result.path, "/form")
+        assert_equal(result.headers, {"host": "localhost", "content-length": "5"})
+        self.assertEqual(result.body, b"hello")
+
+        # the pipelined request after it was kept
+        self.assertEqual(parser.next_request().path, "/")
+        self.assertIsNone(parser.next_request())
+
+    def test_parser_limits(self):
+        print('Testing request parser limits ...')
+        cases = [
+            (b"GARBAGE\r\n\r\n", 400),
+            (b"GET / HTTP/1.1\r\nno colon\r\n\r\n", 400),
+            (b"GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n", 400),
+            (b"POST / HTTP/1.1\r\nContent-Length: 2000000\r\n\r\n", 413),
+            (b"GET / HTTP/1.1\r\nX: " + b"a" * MAX_HEADER_SIZE, 431),
+            (b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n", 501),
+        ]
+        for data, status in cases:
+            parser = RequestParser()
+            parser.feed(data)
+            with self.assertRaises(ParseError) as raised:
+                parser.next_request()
+            assert_equal(raised.exception.status, status)
+
+        # a malformed request is answered and the connection closed
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.parser.feed(b"GET / HTTP/1.1\r\n\r\nGARBAGE\r\n\r\n")
+        response, keep_open = handle_requests(connection)
+        self.assertEqual(response, [RESPONSES[200], CLOSING_RESPONSES[400]])
+        self.assertFalse(keep_open)
+
+    def test_static_file(self):
+        print('Testing static files ...')
+        with tempfile.TemporaryDirectory() as document_root:
+            with open(os.path.join(document_root, 'style.css'), 'wb') as f:
+                f.write(b'body { color: red; }')
+            static_files = StaticFiles(document_root)
+            connection = HttpConnection(('127.0.0.1', 12345))
+            connection.parser.feed(b"GET /static/style.css HTTP/1.1\r\n\r\n")
+
+            responses, keep_open = handle_requests(connection, static_files)
+
+            # the body is sent with sendfile over a real socket
+            server_end, client_end = socket.socketpair()
+            with server_end, client_end:
+                queue_responses(connection, responses)
+                assert_true(send_pending(server_end, connection), 'all sent')
+                received = client_end.recv(4096)
+            head, _, body = received.partition(b"\r\n\r\n")
+            self.assertTrue(keep_open)
+            self.assertEqual(body, b'body { color: red; }')
+            assert_in(b'Content-Type: text/css', head)
+            assert_in(b'Content-Length: 20', head)
+            static_file = static_files.lookup('style.css')
+            self.assertIn(f'ETag: {static_file.etag}'.encode(), head)
+            self.assertIn(f'Last-Modified: {static_file.last_modified}'.encode(), head)
+            static_files.close()
+        print()
+
+    def test_static_not_modified(self):
+        print('Testing 304 responses ...')
+        with tempfile.TemporaryDirectory() as document_root:
+            with open(os.path.join(document_root, 'index.html'), 'wb') as f:
+                f.write(b'<p>hi</p>')
+            static_files = StaticFiles(document_root)
+            static_file = static_files.lookup('index.html')
+
+            for condition in (f"If-None-Match: W/{static_file.etag}", f"If-Modified-Since: {static_file.last_modified}"):
+                connection = HttpConnection(('127.0.0.1', 12345))
+                connection.parser.feed(f"GET /static/index.html HTTP/1.1\r\n{condition}\r\n\r\n".encode())
+                responses, _ = handle_requests(connection, static_files)
+                self.assertEqual(len(responses), 1)
+                self.assertTrue(responses[0].startswith(b"HTTP/1.1 304 Not Modified\r\n"))
+                self.assertNotIn(b"Content-Length", responses[0])
+
+            # a different tag gets the file
+            connection = HttpConnection(('127.0.0.1', 12345))
+            connection.parser.feed(b'GET /static/index.html HTTP/1.1\r\nIf-None-Match: "other"\r\n\r\n')
+            responses, _ = handle_requests(connection, static_files)
+            self.assertIs(responses[-1], static_file)
+            static_files.close()
+        print()
+
+    def test_static_lookup(self):
+        print('Testing static file cache ...')
+        with tempfile.TemporaryDirectory() as parent:
+            document_root = os.path.join(parent, 'root')
+            os.mkdir(document_root)
+            with open(os.path.join(parent, 'secret'), 'wb') as f:
+                f.write(b'secret')
+            for name in ('a', 'b', 'c'):
+                with open(os.path.join(document_root, name), 'wb') as f:
+                    f.write(name.encode())
+            static_files = StaticFiles(document_root, cache_size=2)
+
+            # nothing outside the document root is served
+            self.assertIsNone(static_files.lookup('../secret'))
+            self.assertIsNone(static_files.lookup('missing'))
+            self.assertIsNone(static_files.lookup('a\0b'))
+            connection = HttpConnection(('127.0.0.1', 12345))
+            connection.parser.feed(b"GET /static/a%00b HTTP/1.1\r\n\r\n")
+            self.assertEqual(handle_requests(connection, static_files)[0], [RESPONSES[404]])
+
+            # the least recently used file is closed once the cache is full
+            first = static_files.lookup('a')
+            self.assertIs(static_files.lookup('a'), first)
+            static_files.lookup('b')
+            static_files.lookup('c')
+            assert_equal(list(static_files.cache), ['b', 'c'])
+            with self.assertRaises(OSError):
+                os.fstat(first.fd)
+
+            # a changed file is opened again once its stat result is too old
+            static_files.stat_ttl = 0
+            with open(os.path.join(document_root, 'c'), 'wb') as f:
+                f.write(b'changed')
+            self.assertEqual(static_files.lookup('c').size, 7)
+            static_files.close()
+        print()
+
+    def test_choose_encoding(self):
+        print('Testing Accept-Encoding ...')
+        assert_equal(choose_encoding('gzip, deflate, br'), 'gzip')
+        assert_equal(choose_encoding('gzip;q=0.5, deflate'), 'deflate')
+        assert_equal(choose_encoding('deflate;q=0.8, *;q=0.9'), 'gzip')
+        assert_equal(choose_encoding('gzip;q=0, deflate;q=0'), None)
+        assert_equal(choose_encoding('br'), None)
+        assert_equal(choose_encoding('identity, gzip;q=0.5'), None)
+        assert_equal(choose_encoding(None), None)
+        print()
+
+    def test_compressed_static_file(self):
+        print('Testing compressed static files ...')
+        content = b'body { color: red; }\n' * 200
+        with tempfile.TemporaryDirectory() as document_root:
+            with open(os.path.join(document_root, 'site.css'), 'wb') as f:
+                f.write(content)
+            with open(os.path.join(document_root, 'small.css'), 'wb') as f:
+                f.write(b'p {}')
+            static_files = StaticFiles(document_root)
+            variants = CompressedVariants()
+
+            def get(path, *fields):
+                connection = HttpConnection(('127.0.0.1', 12345))
+                header = ''.join(f'{field}\r\n' for field in fields)
+                connection.parser.feed(f'GET {path} HTTP/1.1\r\n{header}\r\n'.encode())
+                responses, _ = handle_requests(connection, static_files, variants=variants)
+                return responses
+
+            head, body = get('/static/site.css', 'Accept-Encoding: gzip')
+            assert_in(b'Content-Encoding: gzip', head)
+            assert_in(b'Vary: Accept-Encoding', head)
+            assert_in(b'Content-Length: %d' % len(body), head)
+            self.assertEqual(gzip.decompress(body), content)
+
+            # the second request gets the cached variant, not a new compression
+            _, again = get('/static/site.css', 'Accept-Encoding: gzip')
+            self.assertIs(again, body)
+            _, deflated = get('/static/site.css', 'Accept-Encoding: deflate')
+            self.assertEqual(zlib.decompress(deflated), content)
+            assert_equal(len(variants.cache), 2)
+
+            # the compressed variant has its own tag, which gets a 304
+            etag = variant_etag(static_files.lookup('site.css').etag, 'gzip')
+            self.assertIn(f'ETag: {etag}'.encode(), head)
+            (not_modified_head,) = get('/static/site.css', 'Accept-Encoding: gzip', f'If-None-Match: {etag}')
+            self.assertTrue(not_modified_head.startswith(b'HTTP/1.1 304'))
+
+            # small files and clients without gzip get the file itself
+            head, body = get('/static/small.css', 'Accept-Encoding: gzip')
+            self.assertNotIn(b'Content-Encoding', head)
+            self.assertIsInstance(body, StaticFile)
+            head, body = get('/static/site.css')
+            self.assertNotIn(b'Content-Encoding', head)
+            self.assertIsInstance(body, StaticFile)
+            static_files.close()
+        print()
+
+    def test_unreadable_static_file_is_not_compressed(self):
+        print('Testing a static file that cannot be read for compressing ...')
+        content = b'body { color: red; }\n' * 200
+        with tempfile.TemporaryDirectory() as document_root:
+            file_path = os.path.join(document_root, 'site.css')
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            static_files = StaticFiles(document_root)
+            variants = CompressedVariants()
+            connection = HttpConnection(('127.0.0.1', 12345))
+            static_file = static_files.lookup('site.css')
+
+            # truncated after it was opened, then unreadable altogether
+            os.truncate(file_path, 10)
+            self.assertIsNone(variants.static_body(static_file, 'gzip'))
+            with patch('os.pread', side_effect=OSError(5, 'Input/output error')):
+                connection.parser.feed(b'GET /static/site.css HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n')
+                (head, body), keep_alive = handle_requests(connection, static_files, variants=variants)
+
+            # the file itself is sent, and nothing was cached for it
+            self.assertTrue(keep_alive)
+            self.assertIs(body, static_file)
+            self.assertNotIn(b'Content-Encoding', head)
+            self.assertIn(f'ETag: {static_file.etag}'.encode(), head)
+            assert_equal(len(variants.cache), 0)
+            static_file.release()
+            static_files.close()
+        print()
+
+    def test_variant_cache_bytes(self):
+        print('Testing the compressed variant cache limits ...')
+        variants = CompressedVariants(cache_size=4, cache_bytes=250)
+        for key in range(3):
+            variants.get(key, lambda: bytes(100))
+
+        # the third variant takes the total over 250 bytes, the oldest goes
+        assert_equal(list(variants.cache), [1, 2])
+        assert_equal(variants.size, 200)
+
+        # the count limit still applies to small variants
+        for key in range(3, 8):
+            variants.get(key, lambda: b'x')
+        assert_equal(list(variants.cache), [4, 5, 6, 7])
+        assert_equal(variants.size, 4)
+
+        # a variant over the byte limit alone is kept until the next one
+        big = variants.get('big', lambda: bytes(300))
+        assert_equal(list(variants.cache), ['big'])
+        self.assertIs(variants.get('big', lambda: None), big)
+        print()
+
+    def test_compressed_canned_response(self):
+        print('Testing compressed canned responses ...')
+        # the canned pages are below MIN_COMPRESS_SIZE and go out as they are
+        variants = CompressedVariants()
+        assert_equal(variants.canned_response(200, 'gzip', 'keep-alive'), None)
+
+        variants = CompressedVariants(min_size=0)
+        response = variants.canned_response(200, 'gzip', 'keep-alive')
+        head, _, body = response.partition(b'\r\n\r\n')
+        assert_in(b'Content-Encoding: gzip', head)
+        self.assertEqual(gzip.decompress(body), get_content(200).encode('utf-8'))
+        self.assertIs(variants.canned_response(200, 'gzip', 'keep-alive'), response)
+        print()
+
+    def test_access_log(self):
+        print('Testing access log ...')
+        stream = StringIO()
+        access_log = AccessLog(stream, batch_size=2, interval=60.0)
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.parser.feed(b"GET / HTTP/1.1\r\n\r\nGET /missing HTTP/1.1\r\n\r\n")
+        handle_requests(connection)
+
+        # both responses went out 42 us after the requests arrived
+        connection.sent = connection.queued
+        with patch('time.perf_counter_ns', return_value=connection.received + 42000):
+            sent = connection.take_sent()
+
+        # a full batch wakes the thread long before the interval
+        access_log.record(connection.address, sent)
+        deadline = time.monotonic() + 5.0
+        while not stream.getvalue() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+
+        assert_equal([entry['status'] for entry in entries], [200, 404])
+        assert_equal(entries[0]['bytes'], len(RESPONSES[200]))
+        self.assertEqual(entries[1]['path'], '/missing')
+        self.assertEqual(entries[1]['method'], 'GET')
+        self.assertEqual(entries[1]['duration_us'], 42)
+        self.assertEqual(entries[1]['client'], '127.0.0.1:12345')
+        self.assertEqual(json.loads(format_log_entry('-', ('::1', 1), 'GET', '/"quoted"', [RESPONSES[200]], 1))['path'], '/"quoted"')
+
+        # what is left is written when the log closes, what did not fit is counted
+        access_log.max_buffered = 1
+        access_log.record(connection.address, sent)
+        access_log.close()
+        lines = stream.getvalue().splitlines()
+        assert_equal(len(lines), 4)
+        self.assertEqual(json.loads(lines[-1]), {'dropped': 1})
+        print()
+
+    def test_request_durations(self):
+        print('Testing per request durations ...')
+        connection = HttpConnection(('127.0.0.1', 12345))
+        connection.received = 1000000
+        connection.parser.feed(b"GET / HTTP/1.1\r\n\r\nGET /missing HTTP/1.1\r\n\r\n")
+        responses, _ = handle_requests(connection)
+        queue_responses(connection, responses)
+
+        # nothing is logged before the whole response is sent
+        assert_equal(connection.take_sent(), [])
+
+        # the socket takes the first response, the second one is sent later
+        mock_socket = MagicMock()
+        mock_socket.send.side_effect = [len(RESPONSES[200]), BlockingIOError]
+        with patch('time.perf_counter_ns', return_value=3000000):
+            self.assertFalse(send_pending(mock_socket, connection))
+            first = connection.take_sent()
+        assert_equal([(method, path, duration) for method, path, _, duration in first], [('GET', '/', 2000)])
+
+        mock_socket.send.side_effect = lambda data, flags: len(data)
+        with patch('time.perf_counter_ns', return_value=9000000):
+            self.assertTrue(send_pending(mock_socket, connection))
+            second = connection.take_sent()
+        assert_equal([(method, path, duration) for method, path, _, duration in second], [('GET', '/missing', 8000)])
+        assert_equal(len(connection.completed), 0)
+        print()
+
+    def test_access_log_interval(self):
+        print('Testing access log interval ...')
+        stream = StringIO()
+        access_log = AccessLog(stream, batch_size=100, interval=0.01)
+        access_log.record(('127.0.0.1', 12345), [('GET', '/', [RESPONSES[200]], 5)])
+
+        # a single entry is written once the interval passed
+        deadline = time.monotonic() + 5.0
+        while not stream.getvalue() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        access_log.close()
+        assert_equal(json.loads(stream.getvalue())['status'], 200)
+        print()
+
+    def test_router(self):
+        print('Testing router ...')
+        router = Router()
+
+        @router.route('/users/{name}')
+        def user(request, static_files, name):
+            return name
+
+        @router.route('/users/{name}/posts/{post}')
+        def post(request, static_files, name, post):
+            return (name, post)
+
+        router.add('/users/me', lambda request, static_files: 'me')
+        router.add('/files/*path', lambda request, static_files, path: path)
+
+        # literal routes come from the dict, patterns from the trie
+        assert_in('/users/me', router.exact)
+        handler, params = router.resolve('/users/me')
+        assert_equal(handler(None, None, **params), 'me')
+        handler, params = router.resolve('/users/alice')
+        assert_equal(handler(None, None, **params), 'alice')
+        handler, params = router.resolve('/users/alice/posts/7')
+        assert_equal(handler(None, None, **params), ('alice', '7'))
+        handler, params = router.resolve('/files/css/site.css')
+        assert_equal(handler(None, None, **params), 'css/site.css')
+
+        self.assertEqual(router.resolve('/users/alice/posts'), (None, None))
+        self.assertEqual(router.resolve('/users/'), (None, None))
+        with self.assertRaises(ValueError):
+            router.add('/files/*path/more', user)
+
+        # the server routes
+        assert_equal(get_status('/'), 200)
+        assert_equal(get_status('/?page=1'), 200)
+        assert_equal(get_status('/hello.html'), 403)
+        assert_equal(get_status('/static/missing.css'), 404)
+        assert_equal(get_status('/nonexistent.html'), 404)
+        print()
+
+    def test_slow_client(self):
+        print('Testing slow client ...')
+        content = b'x' * (4 * 1024 * 1024)
+        with tempfile.TemporaryDirectory() as document_root:
+            with open(os.path.join(document_root, 'big.bin'), 'wb') as f:
+                f.write(content)
+            static_files = StaticFiles(document_root)
+            connection = HttpConnection(('127.0.0.1', 12345))
+            connection.parser.feed(b"GET /static/big.bin HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n")
+            responses, _ = handle_requests(connection, static_files)
+            queue_responses(connection, responses)
+
+            server_end, client_end = socket.socketpair()
+            with server_end, client_end:
+                # a client that does not read leaves the rest queued instead of blocking
+                server_end.setblocking(False)
+                self.assertFalse(send_pending(server_end, connection))
+                self.assertTrue(connection.output)
+
+                # it is resumed where it stopped once the client reads
+                received = bytearray()
+                client_end.setblocking(False)
+                while True:
+                    done = send_pending(server_end, connection)
+                    try:
+                        while True:
+                            chunk = client_end.recv(1024 * 1024)
+                            received += chunk
+                    except BlockingIOError:
+                        pass
+                    if done:
+                        break
+                self.assertTrue(received.endswith(RESPONSES[200]))
+                self.assertIn(content + RESPONSES[200], received)
+
+                # a client that went away is an error for this connection only
+                connection.parser.feed(b"GET / HTTP/1.1\r\n\r\n")
+                responses, _ = handle_requests(connection, static_files)
+                queue_responses(connection, responses)
+                client_end.close()
+                with self.assertRaises(OSError):
+                    send_pending(server_end, connection)
+            static_files.close()
+        print()
+
+    def test_evicted_file_in_pipeline(self):
+        print('Testing eviction during a pipeline ...')
+        with tempfile.TemporaryDirectory() as document_root:
+            for name in ('a', 'b', 'c'):
+                with open(os.path.join(document_root, name), 'wb') as f:
+                    f.write(name.encode() * 10)
+            static_files = StaticFiles(document_root, cache_size=2)
+            connection = HttpConnection(('127.0.0.1', 12345))
+            connection.parser.feed(b"".join(b"GET /static/%s HTTP/1.1\r\n\r\n" % name for name in (b'a', b'b', b'c')))
+            responses, _ = handle_requests(connection, static_files)
+
+            # 'a' left the cache while its response is queued, its fd stays open
+            first = responses[1]
+            self.assertNotIn('a', static_files.cache)
+            os.fstat(first.fd)
+
+            queue_responses(connection, responses)
+            server_end, client_end = socket.socketpair()
+            with server_end, client_end:
+                send_pending(server_end, connection)
+                received = client_end.recv(4096)
+            bodies = [part.partition(b"\r\n\r\n")[2] for part in received.split(b"HTTP/1.1 ")[1:]]
+            self.assertEqual(b"".join(bodies), b'a' * 10 + b'b' * 10 + b'c' * 10)
+
+            # and is closed once the response is sent
+            with self.assertRaises(OSError):
+                os.fstat(first.fd)
+            static_files.close()
+        print()
+
+    @patch('time.monotonic')
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_idle_timeout(self, mock_socket, mock_select, mock_monotonic):
+        print('Testing idle timeout ...')
+        mock_server_socket = mock_socket.return_value
+        mock_client_socket = MagicMock()
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+
+        # a client connects and then sends nothing until after the timeout
+        mock_monotonic.side_effect = [0.0, 0.0, 0.0, 10.0]
+        mock_select.side_effect = [([mock_server_socket], [], []), ([], [], []), KeyboardInterrupt]
+
+        serve(idle_timeout=5.0)
+
+        mock_client_socket.close.assert_called_once()
+        # the second select waited only until the client would go idle
+        self.assertEqual(mock_select.call_args_list[1].args[3], 5.0)
+
+    @patch('time.sleep')
+    @patch('os.waitpid')
+    @patch('os.kill')
+    @patch('os.wait')
+    @patch('os.fork')
+    @patch('socket.socket')
+    def test_supervise_workers(self, mock_socket, mock_fork, mock_wait, mock_kill, mock_waitpid, mock_sleep):
+        print('Testing worker supervision ...')
+        mock_socket.return_value.getsockname.return_value = ('localhost', 8080)
+        mock_fork.side_effect = [101, 102, 103]
+
+        # worker 101 crashes, then the master is interrupted
+        mock_wait.side_effect = [(101, 1 << 8), KeyboardInterrupt]
+
+        serve(workers=2)
+
+        # the crashed worker is replaced, the running ones are stopped on exit
+        assert_equal(mock_fork.call_count, 3)
+        mock_sleep.assert_called_once_with(WORKER_RESTART_DELAY)
+        self.assertEqual(sorted(call.args for call in mock_kill.call_args_list), [(102, signal.SIGINT), (103, signal.SIGINT)])
+        mock_socket.return_value.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        mock_socket.return_value.listen.assert_not_called()
+        mock_socket.return_value.close.assert_called_once()
+        print()
+
+    @patch('os._exit')
+    @patch('os.fork', return_value=0)
+    def test_worker_log_stream(self, mock_fork, mock_exit):
+        print('Testing the access log of workers ...')
+        stream = StringIO()
+        with patch.object(sys.modules[__name__], 'serve') as mock_serve:
+            start_worker('localhost', 8080, 5.0, DOCUMENT_ROOT, stream)
+
+        # the forked worker logs where the master was told to
+        mock_serve.assert_called_once_with('localhost', 8080, 5.0, DOCUMENT_ROOT, reuse_port=True, log_stream=stream)
+        mock_exit.assert_called_once_with(0)
+        print()
+
+    def test_reuse_port_workers(self):
+        print('Testing SO_REUSEPORT listeners ...')
+        first = create_server('127.0.0.1', 0, reuse_port=True)
+        port = first.getsockname()[1]
+        second = create_server('127.0.0.1', port, reuse_port=True)
+        with first, second:
+            # both listen on the same port, a connection reaches one of them
+            client = socket.create_connection(('127.0.0.1', port))
+            with client:
+                readable, _, _ = select.select([first, second], [], [], 1.0)
+                self.assertEqual(len(readable), 1)
+        print()
+
     @patch('socket.socket')
     def test_create_server(self, mock_socket):
         print('Testing create_server ...')